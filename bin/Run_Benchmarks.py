@@ -0,0 +1,33 @@
+# Run this module to time the numpy engines on synthetic data and add the results
+# to the benchmark history.  Change the settings below as needed.  Results that are
+# more than 20% slower than earlier runs on this computer are marked as regressions.
+#
+
+import sys, os
+
+#Where's the package located?
+sys.path.append('')
+import gapanalysis as ga
+
+workDir = '/GAPAnalysis/benchmarks'
+history = os.path.join(workDir, 'history.json')
+speciesCounts = [10, 50]
+gridSizes = [(2000, 3000), (4000, 6000)]
+workers = 4
+
+if __name__ == '__main__':
+    results = ga.benchmark.BenchmarkPipelines(workDir, speciesCounts, gridSizes,
+                                              history=history, workers=workers)
+    # RATStats only reads the attribute tables, so its rate is table rows
+    print('Peak memory (MB) is what each step added to the memory its process '
+          'started with')
+    for r in results:
+        if r['cellsPerSecond'] is None:
+            rate = '{0:14,.0f} rows/s '.format(r['rowsPerSecond'])
+        else:
+            rate = '{0:14,.0f} cells/s'.format(r['cellsPerSecond'])
+        print('{0:15} {1:4} species {2:6}x{3:<6} {4:9.1f} s {5} '
+              '{6:8.1f} species/min {7:8.1f} MB{8}'.format(
+              r['stage'], r['species'], r['height'], r['width'], r['seconds'],
+              rate, r['speciesPerMinute'], r['peakRSSMB'] or 0,
+              '  REGRESSION' if r['regression'] else ''))
@@ -1,3 +1,4 @@
-import landcover, misc, richness, data, habitat, docs
+import landcover, misc, richness, data, habitat, docs, blocks, stack, cache, benchmark, runlog
 
-__all__ = ['landcover', 'misc', 'richness', 'data', 'habitat', 'docs']
\ No newline at end of file
+__all__ = ['landcover', 'misc', 'richness', 'data', 'habitat', 'docs',
+           'blocks', 'stack', 'cache', 'benchmark', 'runlog']
\ No newline at end of file
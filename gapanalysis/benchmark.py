@@ -0,0 +1,313 @@
+# -*- coding: utf-8 -*-
+"""
+A module of functions for timing the package's processing steps on synthetic data,
+so that changes can be checked for speed before they're used in production.
+"""
+
+
+def BenchmarkOverlayResults(speciesCounts=[100, 1000], zoneCounts=[10, 100],
+                            repeat=3, seed=42):
+    '''
+    (list, list, [integer], [integer]) -> list
+
+    Times the building of PercentOverlay's results table from synthetic counts for
+        each combination of a number of species and a number of zones.  Returns a
+        list of dictionaries with the number of species, zones, and rows, the
+        fastest time in seconds, and rows per second.
+
+    Arguments:
+    speciesCounts -- A list of numbers of species to time.
+    zoneCounts -- A list of numbers of zones to time.
+    repeat -- Number of times to build each table; the fastest time is kept.
+    seed -- Seed for the random counts.
+
+    Example:
+    >>> BenchmarkOverlayResults([1000], [100])
+    [{'species': 1000, 'zones': 100, 'rows': 100000, 'seconds': 0.41,
+      'rowsPerSecond': 243902.4}]
+    '''
+    import time, numpy as np
+    from gapanalysis.habitat import _OverlayResults
+    rng = np.random.RandomState(seed)
+    results = []
+    for nSp in speciesCounts:
+        spp = ["b{0:04d}x".format(i) for i in range(nSp)]
+        for nZones in zoneCounts:
+            zoneValues = list(range(1, nZones + 1))
+            counts = rng.randint(0, 100000, (nSp, nZones, 4)).astype(np.int64)
+            dates = ["2017-01-01-00"]*nSp
+            runtimes = ["0:00:01"]*nSp
+            best = None
+            for r in range(repeat):
+                start = time.time()
+                _OverlayResults(spp, zoneValues, counts, dates, runtimes)
+                seconds = time.time() - start
+                best = seconds if best is None else min(best, seconds)
+            results.append({"species": nSp, "zones": nZones, "rows": nSp*nZones,
+                            "seconds": best,
+                            "rowsPerSecond": nSp*nZones/max(best, 1e-9)})
+    return results
+
+
+def MakeSyntheticData(dataDir, height=2000, width=3000, nSpecies=20, nZones=10,
+                      seed=42):
+    '''
+    (string, [integer], [integer], [integer], [integer], [integer]) -> dictionary
+
+    Saves a synthetic GAP dataset on a small CONUS-like grid (30 m Albers cells) to
+        benchmark with.  Makes a CONUS extent raster with counter pixels 
+        ("conus_ext_cnt.tif"), a range extent habitat map of values 1-3 and nodata 
+        for each species ("range/"), and a zone raster ("zones.tif") with a RAT.  
+        Range sizes vary from a few percent of the grid to all of it, as GAP ranges 
+        do, and habitat is patchy rather than random noise.  Returns a dictionary 
+        of the paths ("CONUSExtent", "rangeDir", "zones") and the species codes 
+        ("species").
+
+    Arguments:
+    dataDir -- Directory to save the dataset in.  It will be created if it doesn't
+        exist.
+    height -- Number of rows in the grid.
+    width -- Number of columns in the grid.
+    nSpecies -- Number of species to make habitat maps for.
+    nZones -- Number of zones in the zone raster.
+    seed -- Seed for the random maps, so that datasets can be made again.
+
+    Example:
+    >>> MakeSyntheticData("C:/bench/data", 2000, 3000, nSpecies=5)
+    {'CONUSExtent': 'C:/bench/data/conus_ext_cnt.tif', 'rangeDir': 
+     'C:/bench/data/range/', 'zones': 'C:/bench/data/zones.tif', 'species': 
+     ['bSYN000x', 'bSYN001x', 'bSYN002x', 'bSYN003x', 'bSYN004x']}
+    '''
+    import os, numpy as np
+    from rasterio.crs import CRS
+    from gapanalysis import blocks
+    rng = np.random.RandomState(seed)
+    rangeDir = os.path.join(dataDir, "range") + "/"
+    if not os.path.exists(rangeDir):
+        os.makedirs(rangeDir)
+    # Albers grid with the CONUS extent's top left corner
+    grid = blocks.Grid(-2361915.0, 3177735.0, 30.0, height, width,
+                       CRS.from_epsg(5070).to_wkt(), (0, 0, 3, 3))
+    
+    # CONUS extent, zeros with 3x3 counter pixels
+    CONUSExtent = os.path.join(dataDir, "conus_ext_cnt.tif")
+    counter = np.zeros((min(3, height), min(3, width)), dtype=np.uint8) + 1
+    dst = blocks.CreateRaster(CONUSExtent, grid, "uint8", nbits=1)
+    try:
+        blocks.WriteWindow(dst, grid, (0, 0) + counter.shape, counter)
+    finally:
+        dst.close()
+    blocks.WriteVAT(CONUSExtent, np.array([0, 1]), 
+                    np.array([height*width - counter.size, counter.size]))
+    
+    # Zones are patches of about 256x256 cells
+    zones = os.path.join(dataDir, "zones.tif")
+    patches = rng.randint(1, nZones + 1, (height//256 + 1, width//256 + 1))
+    _WriteSynthetic(zones, grid, patches, 256, "uint16", None, rng)
+    
+    # Habitat maps
+    spp = ["bSYN{0:03d}x".format(i) for i in range(nSpecies)]
+    for sp in spp:
+        # Log-normal range sizes, as a fraction of the grid's side
+        side = min(1., max(0.02, np.exp(rng.normal(np.log(0.3), 0.8))))
+        h, w = max(1, int(height*side)), max(1, int(width*side))
+        row, col = rng.randint(0, height - h + 1), rng.randint(0, width - w + 1)
+        rangeGrid = blocks.SubGrid(grid, (row, col, h, w))
+        # Patches of 32x32 cells: 40% nodata, the rest summer, winter, or year round
+        patches = rng.choice([255, 1, 2, 3], (h//32 + 1, w//32 + 1),
+                             p=[.4, .15, .15, .3]).astype(np.uint8)
+        _WriteSynthetic(rangeDir + sp + ".tif", rangeGrid, patches, 32, "uint8", 255,
+                        rng)
+    return {"CONUSExtent": CONUSExtent, "rangeDir": rangeDir, "zones": zones,
+            "species": spp}
+
+
+def _WriteSynthetic(raster, grid, patches, patchSize, dtype, nodata, rng):
+    '''
+    Saves a raster of patches (each value of patches covers patchSize x patchSize
+        cells), with a few percent of cells changed to random values of the patches
+        for texture, and its RAT.
+    '''
+    import numpy as np
+    from gapanalysis import blocks
+    hist = None
+    choices = np.unique(patches)
+    dst = blocks.CreateRaster(raster, grid, dtype, nodata=nodata)
+    try:
+        for window in blocks.BlockWindows(grid, 1024):
+            row, col, h, w = window
+            rows = np.arange(row, row + h)//patchSize
+            cols = np.arange(col, col + w)//patchSize
+            data = patches[rows[:, None], cols[None, :]].astype(dtype)
+            noise = rng.random_sample((h, w)) < 0.05
+            data[noise] = rng.choice(choices, noise.sum())
+            blocks.WriteWindow(dst, grid, window, data)
+            hist = blocks.AddHistogram(hist, data)
+    finally:
+        dst.close()
+    values = np.nonzero(hist)[0]
+    values = values[values != nodata] if nodata is not None else values
+    blocks.WriteVAT(raster, values, hist[values])
+
+
+def BenchmarkPipelines(workDir, speciesCounts=[10, 50], gridSizes=[(2000, 3000)],
+                       history=None, workers=1, blockSize=1024, tolerance=0.2, 
+                       seed=42):
+    '''
+    (string, [list], [list], [string], [integer], [integer], [number], [integer]) ->
+        list
+
+    Times the numpy engines of data.Make01Seasonal, richness.MapRichness, 
+        habitat.PercentOverlay, and misc.RATStats on synthetic data (see 
+        MakeSyntheticData) for each combination of a number of species and a grid 
+        size.  RATStats summarizes the species' range map attribute tables, so it
+        doesn't depend on the other steps' outputs.  Each step runs in its own 
+        process so that its peak memory use can be measured.  Returns a list of 
+        dictionaries, one per step and combination, with the step ("stage"), number
+        of species, grid height and width, seconds, grid cells per second (grid 
+        cells times species; None for RATStats, which doesn't read cells), table
+        rows per second (RATStats only, otherwise None), species per minute, and 
+        peak resident memory in MB (None where the resource module isn't available, 
+        as on Windows).  The peak is what the step added to the memory its process
+        started with, since a forked process starts with this one's memory.
+
+    If a history file is given, the results are appended to it, with the date, 
+        host, and settings, so that runs can be compared over time.  Each result 
+        also gets the fastest time of earlier runs on the same host with the same
+        settings ("baseline") and whether it's more than tolerance slower than that
+        ("regression").
+
+    Arguments:
+    workDir -- Directory to save the synthetic data and outputs in.
+    speciesCounts -- A list of numbers of species to time.
+    gridSizes -- A list of (height, width) grid sizes, in cells, to time.
+    history -- Path to a JSON file of benchmark runs to add this one to.
+    workers -- Number of processes for the steps that can use more than one.
+    blockSize -- Height and width, in cells, of the blocks the steps read.
+    tolerance -- Fraction slower than the baseline that counts as a regression.
+    seed -- Seed for the synthetic data.
+
+    Example:
+    >>> results = BenchmarkPipelines("C:/bench", [10], [(2000, 3000)], 
+                                     history="C:/bench/history.json")
+    >>> [(r["stage"], round(r["speciesPerMinute"])) for r in results]
+    [('Make01Seasonal', 42.0), ('MapRichness', 310.0), ('PercentOverlay', 95.0),
+     ('RATStats', 60000.0)]
+    
+    On Windows, call BenchmarkPipelines from under "if __name__ == '__main__':".
+    '''
+    import os, json, socket, platform, datetime, multiprocessing
+    results = []
+    for height, width in gridSizes:
+        runDir = os.path.join(workDir, "{0}x{1}".format(height, width))
+        data = MakeSyntheticData(os.path.join(runDir, "data"), height, width,
+                                 max(speciesCounts), seed=seed)
+        for nSp in speciesCounts:
+            outDir = os.path.join(runDir, "{0}_species".format(nSp))
+            settings = {"data": data, "species": data["species"][:nSp], 
+                        "outDir": outDir, "workers": workers, "blockSize": blockSize}
+            for stage in ["Make01Seasonal", "MapRichness", "PercentOverlay",
+                          "RATStats"]:
+                parent, child = multiprocessing.Pipe(False)
+                p = multiprocessing.Process(target=_TimeStage,
+                                            args=(child, stage, settings))
+                p.start()
+                child.close()
+                outcome = parent.recv()
+                p.join()
+                if isinstance(outcome, Exception):
+                    raise outcome
+                seconds, peak, rows = outcome
+                seconds = max(seconds, 1e-9)
+                cells = None if stage == "RATStats" else height*width*nSp
+                results.append({"stage": stage, "species": nSp, "height": height,
+                                "width": width, "seconds": seconds,
+                                "cellsPerSecond": cells and cells/seconds,
+                                "rowsPerSecond": rows and rows/seconds,
+                                "speciesPerMinute": nSp*60./seconds,
+                                "peakRSSMB": peak})
+    
+    if history is not None:
+        runs = []
+        if os.path.exists(history):
+            with open(history) as f:
+                runs = json.load(f)
+        run = {"date": datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+               "host": socket.gethostname(), "python": platform.python_version(),
+               "workers": workers, "blockSize": blockSize, "seed": seed}
+        for r in results:
+            key = [r["stage"], r["species"], r["height"], r["width"]]
+            earlier = [e["seconds"] for old in runs
+                       if [old["host"], old["workers"], old["blockSize"], 
+                           old["seed"]] == [run["host"], workers, blockSize, seed]
+                       for e in old["results"]
+                       if [e["stage"], e["species"], e["height"], e["width"]] == key]
+            r["baseline"] = min(earlier) if earlier else None
+            r["regression"] = bool(earlier) and \
+                              r["seconds"] > min(earlier)*(1 + tolerance)
+        run["results"] = results
+        runs.append(run)
+        with open(history, "w") as f:
+            json.dump(runs, f, indent=1, sort_keys=True)
+    return results
+
+
+def _TimeStage(conn, stage, settings):
+    '''
+    Runs one step of BenchmarkPipelines and sends its time in seconds, the peak
+        resident memory (MB) of this process and its children, less this process's
+        memory when it started, and the number of table rows summarized (RATStats
+        only, otherwise None) through conn, or the exception it raised.
+    '''
+    import os, sys, time
+    from gapanalysis import data, richness, habitat, misc
+    try:
+        import resource
+    except ImportError:
+        resource = None
+    try:
+        if resource is not None:
+            # A forked process's peak starts at the parent's resident memory
+            startRSS = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        d, spp = settings["data"], settings["species"]
+        outDir, workers = settings["outDir"], settings["workers"]
+        blockSize = settings["blockSize"]
+        seasonDir = os.path.join(outDir, "seasonal") + "/"
+        if not os.path.exists(outDir):
+            os.makedirs(outDir)
+        rows = None
+        if stage == "RATStats":
+            ranges = [d["rangeDir"] + sp + ".tif" for sp in spp]
+            rows = sum([len(misc.ReadRAT(r)["VALUE"]) for r in ranges])
+        start = time.time()
+        if stage == "Make01Seasonal":
+            data.Make01Seasonal([sp + ".tif" for sp in spp], ["Summer", "Winter", "Any"],
+                                d["rangeDir"], seasonDir, d["CONUSExtent"],
+                                log=os.path.join(outDir, "seasonal_log.txt"),
+                                engine="numpy", workers=workers, blockSize=blockSize)
+        elif stage == "MapRichness":
+            richness.MapRichness(spp, "richness", outDir, seasonDir, "Summer", 
+                                 len(spp), d["CONUSExtent"], engine="numpy",
+                                 blockSize=blockSize, workers=workers)
+        elif stage == "PercentOverlay":
+            habitat.PercentOverlay(d["zones"], "zones", "VALUE", 
+                                   [sp + ".tif" for sp in spp], d["rangeDir"],
+                                   os.path.join(outDir, "overlay"), 
+                                   os.path.join(outDir, "scratch"), d["CONUSExtent"],
+                                   engine="numpy", blockSize=blockSize)
+        elif stage == "RATStats":
+            misc.RATStats(ranges, [5, 50, 95])
+        seconds = time.time() - start
+        if resource is not None:
+            peak = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                       resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+            # Kilobytes, except on Mac OS where it's bytes
+            peak = max(peak - startRSS, 0)/1024.**(2 if sys.platform == "darwin" 
+                                                    else 1)
+        else:
+            peak = None
+        conn.send((seconds, peak, rows))
+    except Exception as e:
+        conn.send(e)
+    finally:
+        conn.close()
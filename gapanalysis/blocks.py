@@ -0,0 +1,645 @@
+# -*- coding: utf-8 -*-
+"""
+A module of functions for reading and writing GAP rasters in blocks (windows) with
+numpy and rasterio.  These are the building blocks of the "numpy" engines, which
+do not need arcpy or an ArcGIS license.
+
+Windows are tuples of (row offset, column offset, height, width) in cells of a
+reference grid, usually the CONUS extent raster.
+"""
+from collections import namedtuple
+
+Grid = namedtuple("Grid", ["x0", "y0", "cellSize", "height", "width", "crs",
+                           "counter"])
+
+# CONUS grids worked out by CONUSGrid, as path -> (stamp, grid, counter values)
+_CONUSGrids = {}
+
+
+def RasterGrid(raster):
+    '''
+    (string) -> Grid
+
+    Returns the grid definition of a raster: the coordinates of the top left corner,
+        cell size, number of rows and columns, spatial reference (as WKT), and the
+        window of the counter pixels in the top left corner (None if there are none).
+
+    Arguments:
+    raster -- Path to the raster that defines the grid, usually the CONUS extent
+        raster (conus_ext_cnt.tif).
+
+    Example:
+    >>> grid = RasterGrid("C:/data/conus_ext_cnt.tif")
+    >>> grid.cellSize
+    30.0
+    '''
+    import numpy as np, rasterio
+    from rasterio.windows import Window
+    with rasterio.open(raster) as src:
+        t = src.transform
+        # Counter pixels are in the top left corner, so only read a small window
+        h, w = min(64, src.height), min(64, src.width)
+        corner = src.read(1, window=Window(0, 0, w, h))
+        if src.nodata is not None:
+            corner[corner == src.nodata] = 0
+        rows, cols = np.nonzero(corner)
+        if len(rows) > 0:
+            counter = (int(rows.min()), int(cols.min()),
+                       int(rows.max() - rows.min() + 1),
+                       int(cols.max() - cols.min() + 1))
+        else:
+            counter = None
+        crs = src.crs.to_wkt() if src.crs else None
+        return Grid(t.c, t.f, t.a, src.height, src.width, crs, counter)
+
+
+def CONUSGrid(raster):
+    '''
+    (string) -> Grid, numpy array
+
+    Returns the grid definition of the CONUS extent raster (see RasterGrid) and the
+        values of its counter pixels, which is all that the numpy engines need from
+        it.  They're worked out once and saved in a JSON file next to the raster
+        (e.g., "conus_ext_cnt.tif.grid.json"), so later calls, in this process or 
+        others, don't open the raster unless it has changed.  Both are small enough 
+        to be passed to worker processes with their jobs; see CounterWindow.
+
+    Arguments:
+    raster -- Path to the CONUS extent raster (conus_ext_cnt.tif).
+
+    Example:
+    >>> grid, counterValues = CONUSGrid("C:/data/conus_ext_cnt.tif")
+    >>> grid.counter, counterValues.sum()
+    ((0, 0, 3, 3), 9)
+    '''
+    import os, json, numpy as np, rasterio
+    stat = os.stat(raster)
+    stamp = [os.path.abspath(raster), stat.st_mtime, stat.st_size]
+    if _CONUSGrids.get(stamp[0], (None,))[0] == stamp:
+        return _CONUSGrids[stamp[0]][1:]
+    sidecar = raster + ".grid.json"
+    saved = None
+    if os.path.exists(sidecar):
+        try:
+            with open(sidecar) as f:
+                saved = json.load(f)
+        except ValueError:
+            saved = None
+    if saved is not None and saved["stamp"] == json.loads(json.dumps(stamp)):
+        grid = saved["grid"]
+        grid["counter"] = tuple(grid["counter"]) if grid["counter"] else None
+        grid = Grid(**grid)
+        counterValues = np.array(saved["counterValues"], dtype=saved["dtype"])
+    else:
+        grid = RasterGrid(raster)
+        if grid.counter is not None:
+            with rasterio.open(raster) as src:
+                counterValues = ReadWindow(src, grid, grid.counter)
+        else:
+            counterValues = np.zeros((0, 0), dtype=np.uint8)
+        try:
+            with open(sidecar, "w") as f:
+                json.dump({"stamp": stamp, "grid": dict(grid._asdict()),
+                           "counterValues": counterValues.tolist(),
+                           "dtype": counterValues.dtype.name}, f, indent=1)
+        except (IOError, OSError):
+            # The grid can still be used if the directory is read only
+            pass
+    _CONUSGrids[stamp[0]] = (stamp, grid, counterValues)
+    return grid, counterValues
+
+
+def CounterWindow(grid, counterValues, window, dtype=None):
+    '''
+    (Grid, numpy array, tuple, [string]) -> numpy array
+
+    Returns a window of the CONUS extent raster without reading it: zeros, with the
+        counter pixels from CONUSGrid where the window overlaps them.
+
+    Arguments:
+    grid -- A Grid from CONUSGrid().
+    counterValues -- The counter pixel values from CONUSGrid().
+    window -- The window to return, in grid cells.
+    dtype -- Data type of the array; defaults to that of the counter pixels.
+    '''
+    import numpy as np
+    out = np.zeros((window[2], window[3]), dtype=dtype or counterValues.dtype)
+    if grid.counter is not None:
+        overlap = Intersect(window, grid.counter)
+        if overlap is not None:
+            r, c = overlap[0] - grid.counter[0], overlap[1] - grid.counter[1]
+            out[overlap[0] - window[0]:overlap[0] - window[0] + overlap[2],
+                overlap[1] - window[1]:overlap[1] - window[1] + overlap[3]] = \
+                counterValues[r:r + overlap[2], c:c + overlap[3]]
+    return out
+
+
+def BlockWindows(grid, blockSize):
+    '''
+    (Grid, integer) -> list
+
+    Returns a list of windows that tile the grid, in row major order.  Windows on
+        the right and bottom edges are clipped to the grid.
+
+    Arguments:
+    grid -- A Grid from RasterGrid().
+    blockSize -- Height and width of the windows in cells.
+
+    Example:
+    >>> BlockWindows(grid, 4096)[:2]
+    [(0, 0, 4096, 4096), (0, 4096, 4096, 4096)]
+    '''
+    windows = []
+    for row in range(0, grid.height, blockSize):
+        for col in range(0, grid.width, blockSize):
+            windows.append((row, col, min(blockSize, grid.height - row),
+                            min(blockSize, grid.width - col)))
+    return windows
+
+
+def SubGrid(grid, window):
+    '''
+    (Grid, tuple) -> Grid
+
+    Returns the grid definition of a window of a grid, for example to save one
+        row band of a larger raster in its own file.  Windows of the sub grid start
+        at (0, 0).
+
+    Arguments:
+    grid -- A Grid from RasterGrid().
+    window -- The window of the grid to return.
+    '''
+    counter = None
+    if grid.counter is not None:
+        overlap = Intersect(window, grid.counter)
+        if overlap is not None:
+            counter = (overlap[0] - window[0], overlap[1] - window[1], overlap[2],
+                       overlap[3])
+    return Grid(grid.x0 + window[1]*grid.cellSize, grid.y0 - window[0]*grid.cellSize,
+                grid.cellSize, window[2], window[3], grid.crs, counter)
+
+
+def SourceWindow(src, grid):
+    '''
+    (rasterio dataset, Grid) -> tuple
+
+    Returns the window that a raster covers in the reference grid.  Raises a
+        ValueError if the raster's cells are not the same size as, or not snapped to,
+        the grid's cells.
+
+    Arguments:
+    src -- An open rasterio dataset.
+    grid -- A Grid from RasterGrid().
+    '''
+    t = src.transform
+    if abs(t.a - grid.cellSize) > 1e-6 or abs(-t.e - grid.cellSize) > 1e-6:
+        raise ValueError("{0} does not have {1}m cells".format(src.name, grid.cellSize))
+    col = (t.c - grid.x0)/grid.cellSize
+    row = (grid.y0 - t.f)/grid.cellSize
+    if abs(col - round(col)) > 1e-3 or abs(row - round(row)) > 1e-3:
+        raise ValueError("{0} is not snapped to the grid".format(src.name))
+    return (int(round(row)), int(round(col)), src.height, src.width)
+
+
+def RasterWindow(raster, grid):
+    '''
+    (string, Grid) -> tuple
+
+    Returns the window that a raster covers in the reference grid.  See SourceWindow().
+
+    Arguments:
+    raster -- Path to a raster.
+    grid -- A Grid from RasterGrid().
+    '''
+    import rasterio
+    with rasterio.open(raster) as src:
+        return SourceWindow(src, grid)
+
+
+def Intersect(a, b):
+    '''
+    (tuple, tuple) -> tuple or None
+
+    Returns the window where two windows overlap, or None if they don't.
+
+    Example:
+    >>> Intersect((0, 0, 10, 10), (5, 5, 10, 10))
+    (5, 5, 5, 5)
+    '''
+    r0, c0 = max(a[0], b[0]), max(a[1], b[1])
+    r1, c1 = min(a[0] + a[2], b[0] + b[2]), min(a[1] + a[3], b[1] + b[3])
+    if r0 >= r1 or c0 >= c1:
+        return None
+    return (r0, c0, r1 - r0, c1 - c0)
+
+
+def Union(a, b):
+    '''
+    (tuple, tuple) -> tuple
+
+    Returns the smallest window that contains two windows.
+
+    Example:
+    >>> Union((0, 0, 10, 10), (5, 5, 10, 10))
+    (0, 0, 15, 15)
+    '''
+    r0, c0 = min(a[0], b[0]), min(a[1], b[1])
+    return (r0, c0, max(a[0] + a[2], b[0] + b[2]) - r0, 
+            max(a[1] + a[3], b[1] + b[3]) - c0)
+
+
+def ReadWindow(src, grid, window, fill=0, band=1):
+    '''
+    (rasterio dataset, Grid, tuple, [number], [integer]) -> numpy array
+
+    Reads a window of the reference grid from a raster.  Cells of the window that
+        are outside of the raster's extent, or that are nodata, are set to fill.  This
+        way range extent and CONUS extent habitat maps can be read the same way.  For
+        sparse habitat maps (see data.MakeSparse), the counter pixels implied by 
+        their "GAP_COUNTER" tag are set as Make01Seasonal sets them (1), or, for
+        "0123" maps, have the counter values in their "GAP_COUNTER_VALUES" tag added
+        as Make0123 does.
+
+    Arguments:
+    src -- An open rasterio dataset.
+    grid -- A Grid from RasterGrid().
+    window -- The window to read, in grid cells.
+    fill -- Value to use for nodata cells and cells outside of the raster.
+    band -- The band to read.
+    '''
+    import numpy as np
+    from rasterio.windows import Window
+    srcWindow = SourceWindow(src, grid)
+    out = np.empty((window[2], window[3]), dtype=src.dtypes[band - 1])
+    out.fill(fill)
+    overlap = Intersect(window, srcWindow)
+    if overlap is not None:
+        r0, c0, h, w = overlap
+        data = src.read(band, window=Window(c0 - srcWindow[1], r0 - srcWindow[0], w,
+                                            h))
+        nodata = src.nodatavals[band - 1]
+        if nodata is not None:
+            data[data == nodata] = fill
+        out[r0 - window[0]:r0 - window[0] + h, c0 - window[1]:c0 - window[1] + w] = data
+    if grid.counter is not None and ImpliedCounter(src) > 0:
+        overlap = Intersect(window, grid.counter)
+        if overlap is not None:
+            part = out[overlap[0] - window[0]:overlap[0] - window[0] + overlap[2],
+                       overlap[1] - window[1]:overlap[1] - window[1] + overlap[3]]
+            part[part == fill] = 0
+            values = _ImpliedCounterValues(src)
+            if values is None:
+                part[:] = 1
+            else:
+                r, c = overlap[0] - grid.counter[0], overlap[1] - grid.counter[1]
+                part += values[r:r + overlap[2], c:c + overlap[3]].astype(part.dtype)
+                # Make0123's 2 bit cells can't hold more than 3
+                np.minimum(part, 3, out=part)
+    return out
+
+
+def ImpliedCounter(src):
+    '''
+    (rasterio dataset) -> integer
+
+    Returns the number of counter pixels that a sparse habitat map (see
+        data.MakeSparse) implies but doesn't store, which is 0 for other rasters.
+    '''
+    return int(src.tags().get("GAP_COUNTER", 0))
+
+
+def _ImpliedCounterValues(src):
+    '''
+    Returns the counter values that a sparse "0123" habitat map implies, which
+        Make0123 adds to its counter pixels, or None for other rasters.
+    '''
+    import json, numpy as np
+    values = src.tags().get("GAP_COUNTER_VALUES")
+    if values is None:
+        return None
+    return np.array(json.loads(values))
+
+
+def NeedsWindow(window, srcWindow, grid):
+    '''
+    (tuple, tuple, Grid) -> boolean
+
+    Returns True if reading a window from a raster that covers srcWindow could return
+        anything but fill, allowing for counter pixels implied by sparse habitat maps.
+    '''
+    if Intersect(window, srcWindow) is not None:
+        return True
+    return grid.counter is not None and Intersect(window, grid.counter) is not None
+
+
+def PrefetchWindows(jobs, grid, fill=0, readers=2, maxBytes=256*1024**2,
+                    cellBytes=1):
+    '''
+    (list, Grid, [number], [integer], [integer], [integer]) -> generator
+
+    Reads windows of rasters with ReadWindow() on background threads, ahead of the
+        caller, and yields the arrays in the order of jobs.  While the caller works
+        on one window the next ones are being read and decompressed, which hides
+        most of the latency of network drives.  GDAL datasets can't be shared
+        between threads, so each thread opens its own; a thread keeps its dataset
+        open while consecutive jobs read the same raster.
+
+    Arguments:
+    jobs -- A list of (path, window) pairs to read.
+    grid -- A Grid from RasterGrid().
+    fill -- Value to use for nodata cells and cells outside of the raster.
+    readers -- Number of threads to read with.  Up to twice as many windows are read
+        ahead.  With 0, each window is read in the calling thread when it's needed.
+    maxBytes -- Memory budget for the windows read ahead but not yet yielded.  At
+        least one window is always read ahead.
+    cellBytes -- Bytes per cell, for the memory budget (1 for habitat maps).
+
+    Example:
+    >>> jobs = [(p, (0, 0, 4096, 4096)) for p in ["C:/Summer/bAMROx.tif",
+    ...                                           "C:/Summer/mSEWEx.tif"]]
+    >>> for habmap in PrefetchWindows(jobs, RasterGrid("C:/data/conus_ext_cnt.tif")):
+    ...     tally += habmap
+    '''
+    import threading, rasterio
+    from collections import deque
+    from multiprocessing.pool import ThreadPool
+    jobs = list(jobs)
+    if readers < 1:
+        for path, window in jobs:
+            with rasterio.open(path) as src:
+                yield ReadWindow(src, grid, window, fill)
+        return
+    local = threading.local()
+    opened = []
+    lock = threading.Lock()
+
+    def Read(job):
+        path, window = job
+        src = getattr(local, "src", None)
+        if src is None or src.name != path:
+            src = rasterio.open(path)
+            with lock:
+                opened.append(src)
+            if getattr(local, "src", None) is not None:
+                local.src.close()
+            local.src = src
+        return ReadWindow(src, grid, window, fill)
+
+    pool = ThreadPool(readers)
+    pending = deque()
+    ahead = 0
+    try:
+        i = 0
+        while i < len(jobs) or pending:
+            while i < len(jobs) and len(pending) < 2*readers:
+                nBytes = jobs[i][1][2]*jobs[i][1][3]*cellBytes
+                if pending and ahead + nBytes > maxBytes:
+                    break
+                pending.append((pool.apply_async(Read, (jobs[i],)), nBytes))
+                ahead += nBytes
+                i += 1
+            result, nBytes = pending.popleft()
+            ahead -= nBytes
+            yield result.get()
+    finally:
+        pool.terminate()
+        pool.join()
+        for src in opened:
+            src.close()
+
+
+def HabitatWindow(raster, grid, blockSize=4096, readers=2):
+    '''
+    (string, Grid, [integer], [integer]) -> tuple
+
+    Returns the window of the bounding box of a habitat map's cells > 0 in the grid,
+        leaving out counter pixels, or (0, 0, 0, 0) if there are none.  For CONUS
+        extent habitat maps it's usually much smaller than the raster's window (see
+        RasterWindow()).  Reads the whole map.
+
+    Arguments:
+    raster -- Path to a habitat map.
+    grid -- A Grid from RasterGrid().
+    blockSize -- Height and width, in cells, of the blocks read.
+    readers -- Number of threads that read blocks ahead (see PrefetchWindows()).
+
+    Example:
+    >>> HabitatWindow("C:/Summer/mSEWEx.tif", RasterGrid("C:/data/conus_ext_cnt.tif"))
+    (61390, 97455, 3210, 2867)
+    '''
+    import numpy as np
+    srcWindow = RasterWindow(raster, grid)
+    windows = [Intersect(w, srcWindow) for w in BlockWindows(grid, blockSize)]
+    windows = [w for w in windows if w is not None]
+    rows, cols = [], []
+    reads = PrefetchWindows([(raster, w) for w in windows], grid, readers=readers)
+    for window in windows:
+        data = next(reads)
+        if grid.counter is not None:
+            overlap = Intersect(window, grid.counter)
+            if overlap is not None:
+                data[overlap[0] - window[0]:overlap[0] - window[0] + overlap[2],
+                     overlap[1] - window[1]:overlap[1] - window[1] + overlap[3]] = 0
+        r = np.nonzero(data.any(axis=1))[0]
+        c = np.nonzero(data.any(axis=0))[0]
+        if len(r) > 0:
+            rows += [window[0] + r[0], window[0] + r[-1]]
+            cols += [window[1] + c[0], window[1] + c[-1]]
+    if not rows:
+        return (0, 0, 0, 0)
+    return (int(min(rows)), int(min(cols)), int(max(rows) - min(rows) + 1),
+            int(max(cols) - min(cols) + 1))
+
+
+def CreateRaster(raster, grid, dtype, nbits=None, nodata=None, sparseOK=False):
+    '''
+    (string, Grid, string, [integer], [number], [boolean]) -> rasterio dataset
+
+    Creates a tiled, compressed GeoTIFF with the extent of the grid and returns it
+        open for writing windows.  Close it when finished.
+
+    Arguments:
+    raster -- Path for the new GeoTIFF.
+    grid -- A Grid from RasterGrid().
+    dtype -- A numpy data type name such as "uint8" or "uint16".
+    nbits -- Number of bits per cell, for example 1 or 2 for habitat maps.
+    nodata -- Value to record as nodata, if any.
+    sparseOK -- True to leave tiles that are never written out of the file.  They
+        read as nodata, or as 0 if there is no nodata value.
+    '''
+    import rasterio
+    from affine import Affine
+    profile = {"driver": "GTiff", "height": grid.height, "width": grid.width,
+               "count": 1, "dtype": dtype, "crs": grid.crs, "nodata": nodata,
+               "transform": Affine(grid.cellSize, 0, grid.x0, 0, -grid.cellSize,
+                                   grid.y0),
+               "tiled": True, "blockxsize": 256, "blockysize": 256,
+               "compress": "lzw", "BIGTIFF": "IF_SAFER"}
+    if nbits is not None:
+        profile["nbits"] = nbits
+    if sparseOK:
+        profile["sparse_ok"] = True
+    return rasterio.open(raster, "w", **profile)
+
+
+def WriteWindow(dst, grid, window, array):
+    '''
+    (rasterio dataset, Grid, tuple, numpy array) -> None
+
+    Writes an array to a window of a raster created with CreateRaster().
+    '''
+    from rasterio.windows import Window
+    dst.write(array.astype(dst.dtypes[0]), 1,
+              window=Window(window[1], window[0], window[3], window[2]))
+
+
+def AddHistogram(hist, array):
+    '''
+    (numpy array or None, numpy array) -> numpy array
+
+    Adds the counts of each value in an array of non-negative integers to a histogram
+        indexed by value, growing the histogram as needed.
+    '''
+    import numpy as np
+    counts = np.bincount(array.ravel())
+    if hist is None:
+        return counts.astype(np.int64)
+    if len(counts) > len(hist):
+        counts[:len(hist)] += hist
+        return counts.astype(np.int64)
+    hist[:len(counts)] += counts
+    return hist
+
+
+def MergeHistograms(a, b):
+    '''
+    (numpy array or None, numpy array or None) -> numpy array or None
+
+    Returns the sum of two histograms from AddHistogram(), either of which may be None.
+    '''
+    if a is None or b is None:
+        return b if a is None else a
+    if len(b) > len(a):
+        a, b = b, a
+    a = a.copy()
+    a[:len(b)] += b
+    return a
+
+
+def WriteVAT(raster, values, counts):
+    '''
+    (string, list, list) -> string
+
+    Writes a raster attribute table as a dBASE sidecar (raster + ".vat.dbf") with
+        VALUE and COUNT fields, the way ArcGIS stores attribute tables for GeoTIFFs.
+        Returns the path to the table.
+
+    Arguments:
+    raster -- Path to the raster.
+    values -- Integer cell values.
+    counts -- Number of cells with each value.
+    '''
+    import struct, datetime
+    fields = [("VALUE", 10), ("COUNT", 19)]
+    today = datetime.date.today()
+    recordLength = 1 + sum([f[1] for f in fields])
+    vat = raster + ".vat.dbf"
+    with open(vat, "wb") as dbf:
+        dbf.write(struct.pack("<BBBBLHH20x", 3, today.year - 1900, today.month,
+                              today.day, len(values), 33 + 32*len(fields),
+                              recordLength))
+        for name, width in fields:
+            dbf.write(struct.pack("<11sc4xBB14x", name.encode("ascii"), b"N",
+                                  width, 0))
+        dbf.write(b"\r")
+        for v, c in zip(values, counts):
+            dbf.write(b" " + str(int(v)).rjust(fields[0][1]).encode("ascii") +
+                      str(int(c)).rjust(fields[1][1]).encode("ascii"))
+        dbf.write(b"\x1a")
+    with open(raster + ".vat.cpg", "w") as cpg:
+        cpg.write("UTF-8")
+    return vat
+
+
+def ReadVAT(raster):
+    '''
+    (string) -> dictionary
+
+    Reads a raster attribute table from its dBASE sidecar (raster + ".vat.dbf") and
+        returns a dictionary of numpy arrays keyed by field name.  Numeric fields are
+        converted to numbers.  Raises an IOError if the raster has no sidecar table.
+
+    Arguments:
+    raster -- Path to the raster.
+
+    Example:
+    >>> vat = ReadVAT("C:/data/conus_ext_cnt.tif")
+    >>> vat["VALUE"], vat["COUNT"]
+    (array([0, 1]), array([2092590393, 9]))
+    '''
+    import struct, numpy as np
+    with open(raster + ".vat.dbf", "rb") as dbf:
+        content = dbf.read()
+    nRecords, headerLength, recordLength = struct.unpack("<LHH", content[4:12])
+    fields = []
+    for start in range(32, headerLength - 1, 32):
+        name, kind, width, decimals = struct.unpack("<11sc4xBB14x",
+                                                    content[start:start + 32])
+        fields.append((name.split(b"\x00")[0].decode("ascii"), kind, width,
+                       decimals))
+    # Read all of the records at once as fixed width fields after the deletion flag
+    offsets = np.cumsum([1] + [f[2] for f in fields])[:-1]
+    layout = np.dtype({"names": [str(f[0]) for f in fields],
+                       "formats": ["S{0}".format(f[2]) for f in fields],
+                       "offsets": [int(o) for o in offsets],
+                       "itemsize": recordLength})
+    records = np.frombuffer(content, dtype=layout, count=nRecords, offset=headerLength)
+    table = {}
+    for name, kind, width, decimals in fields:
+        column = records[str(name)]
+        if kind == b"N" and decimals == 0:
+            column = column.astype(np.int64)
+        elif kind in (b"N", b"F"):
+            column = column.astype(float)
+        else:
+            column = np.char.strip(column.astype(str))
+        table[name] = column
+    return table
+
+
+def HabitatCount(raster, value=1):
+    '''
+    (string, [integer]) -> integer
+
+    Returns the number of cells with a value from a habitat map's .vat.dbf table,
+        including the counter pixels implied by sparse habitat maps when value is 1.
+
+    Arguments:
+    raster -- Path to a habitat map.
+    value -- The cell value to count.
+    '''
+    import rasterio
+    vat = ReadVAT(raster)
+    count = int(vat["COUNT"][vat["VALUE"] == value].sum())
+    if value == 1:
+        with rasterio.open(raster) as src:
+            count += ImpliedCounter(src)
+    return count
+
+
+def FindRaster(directory, name):
+    '''
+    (string, string) -> string
+
+    Returns the path to a raster in a directory, adding a ".tif" suffix if the
+        name doesn't include one.  Raises an IOError if the raster doesn't exist.
+
+    Arguments:
+    directory -- The directory holding the raster.  Should end with "/".
+    name -- The raster or species name (e.g., "mSEWEx" or "mSEWEx.tif").
+    '''
+    import os
+    for path in [directory + name, directory + name + ".tif"]:
+        if os.path.isfile(path):
+            return path
+    raise IOError("No raster named {0} in {1}".format(name, directory))
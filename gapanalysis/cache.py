@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+"""
+A module of functions for caching results that are derived from files, such as zone
+raster indexes, on disk.  Cache entries are directories keyed by the source file's
+path, modification time, and size, so they go stale when the file changes.  The
+cache has a disk budget; the least recently used entries are deleted to stay in it.
+"""
+
+
+def FileKey(path, *args):
+    '''
+    (string, ...) -> string
+
+    Returns a cache key for a file: a hash of its absolute path, modification time,
+        and size, and any other arguments that the cached result depends on.
+
+    Arguments:
+    path -- Path to the source file.
+    args -- Other values the cached result depends on, such as a block size.
+
+    Example:
+    >>> FileKey("C:/data/PADUS.tif", "VALUE", 4096)
+    '5f1d0c0a3e...'
+    '''
+    import os, hashlib
+    stat = os.stat(path)
+    parts = [os.path.abspath(path), repr(stat.st_mtime), str(stat.st_size)] + \
+            [repr(a) for a in args]
+    return hashlib.sha1("|".join(parts).encode("utf-8")).hexdigest()
+
+
+def Entry(cacheDir, key):
+    '''
+    (string, string) -> string or None
+
+    Returns the directory of a cache entry and marks it as used, or returns None if
+        there is no entry for the key.
+    '''
+    import os, time
+    entry = os.path.join(cacheDir, key)
+    if not os.path.isdir(entry):
+        return None
+    now = time.time()
+    os.utime(entry, (now, now))
+    return entry
+
+
+def NewEntry(cacheDir, key):
+    '''
+    (string, string) -> string
+
+    Returns a new, empty temporary directory to save an entry's files in.  Pass it
+        to Commit() when it's complete; until then other processes won't see it.
+        If the entry can't be completed, pass it to Discard().
+    '''
+    import os, tempfile
+    if not os.path.exists(cacheDir):
+        os.makedirs(cacheDir)
+    return tempfile.mkdtemp(prefix=key + ".tmp", dir=cacheDir)
+
+
+def Discard(tmpDir):
+    '''
+    (string) -> None
+
+    Deletes a temporary directory from NewEntry() that won't be committed.
+    '''
+    import shutil
+    shutil.rmtree(tmpDir, ignore_errors=True)
+
+
+def Commit(cacheDir, key, tmpDir, maxBytes=None):
+    '''
+    (string, string, string, [integer]) -> string
+
+    Makes a temporary directory from NewEntry() the entry for the key, then deletes
+        the least recently used entries if the cache is larger than maxBytes.
+        Returns the entry's directory.
+    '''
+    import os, shutil
+    entry = os.path.join(cacheDir, key)
+    if os.path.isdir(entry):
+        # Another process finished the same entry first
+        shutil.rmtree(tmpDir, ignore_errors=True)
+    else:
+        os.rename(tmpDir, entry)
+    if maxBytes is not None:
+        Evict(cacheDir, maxBytes, keep=key)
+    return entry
+
+
+def Evict(cacheDir, maxBytes, keep=None, staleAge=24*3600):
+    '''
+    (string, integer, [string], [number]) -> list
+
+    Deletes the least recently used entries until the cache takes no more than
+        maxBytes of disk.  The entry for keep is never deleted.  Temporary 
+        directories from NewEntry() that haven't been touched in staleAge seconds
+        were left by processes that died, and are deleted too.  Returns the keys of
+        the deleted entries.
+    '''
+    import os, shutil, time
+    entries = []
+    now = time.time()
+    for key in os.listdir(cacheDir):
+        entry = os.path.join(cacheDir, key)
+        if not os.path.isdir(entry):
+            continue
+        if ".tmp" in key:
+            try:
+                if now - os.path.getmtime(entry) > staleAge:
+                    shutil.rmtree(entry, ignore_errors=True)
+            except OSError:
+                # Committed or discarded by its process in the meantime
+                pass
+            continue
+        size = sum([os.path.getsize(os.path.join(entry, f))
+                    for f in os.listdir(entry)])
+        entries.append((os.path.getmtime(entry), key, size))
+    total = sum([e[2] for e in entries])
+    deleted = []
+    for used, key, size in sorted(entries):
+        if total <= maxBytes:
+            break
+        if key == keep:
+            continue
+        shutil.rmtree(os.path.join(cacheDir, key), ignore_errors=True)
+        total -= size
+        deleted.append(key)
+    return deleted
+
+
+def SaveArray(entry, name, array):
+    '''
+    (string, string, numpy array) -> None
+
+    Saves a zlib compressed array in a cache entry.
+    '''
+    import os, io, zlib, numpy as np
+    buf = io.BytesIO()
+    np.save(buf, array)
+    with open(os.path.join(entry, name + ".npy.z"), "wb") as f:
+        f.write(zlib.compress(buf.getvalue(), 1))
+
+
+def LoadArray(entry, name):
+    '''
+    (string, string) -> numpy array or None
+
+    Loads an array saved with SaveArray(), or returns None if there isn't one.
+    '''
+    import os, io, zlib, numpy as np
+    path = os.path.join(entry, name + ".npy.z")
+    if not os.path.exists(path):
+        return None
+    with open(path, "rb") as f:
+        return np.load(io.BytesIO(zlib.decompress(f.read())))
+
+
+def SaveJSON(entry, name, content):
+    '''
+    (string, string, object) -> None
+
+    Saves an object as JSON in a cache entry.
+    '''
+    import os, json
+    with open(os.path.join(entry, name + ".json"), "w") as f:
+        json.dump(content, f)
+
+
+def LoadJSON(entry, name):
+    '''
+    (string, string) -> object
+
+    Loads an object saved with SaveJSON().
+    '''
+    import os, json
+    with open(os.path.join(entry, name + ".json")) as f:
+        return json.load(f)
@@ -4,9 +4,11 @@ A module of functions related to managing the data needed for analyses.
 
 """
 def Make01Seasonal(rasters, seasons, from_dir, to_dir, CONUS_extent, 
-                   log="P:/Proj3/USGap/Vert/Model/Output/CONUS/log.txt"):
+                   log="P:/Proj3/USGap/Vert/Model/Output/CONUS/log.txt",
+                   engine="arcpy", workers=1, blockSize=4096, readers=2):
     '''
-    (list, list, string, string, raster) -> saved rasters
+    (list, list, string, string, raster, [string], [string], [int], [int], [int]) -> 
+        saved rasters
     
     Copies a GAP habitat map that is in the format of values 1-3 and nodata (no zeros) 
         and with an extent defined by the species range to a full CONUS extent version
@@ -24,6 +26,18 @@ def Make01Seasonal(rasters, seasons, from_dir, to_dir, CONUS_extent,
     CONUS_extent -- A full continental extent raster (30m, albers), composed entirely of
         zeros and counter pixels with value "1" in the top left corner if desired.  This
         layer is used for setting the extent, snapgrid, and adding the counter pixels.
+    engine -- "arcpy" (the default) runs separate arcpy map algebra for each season.
+        "numpy" reads each block of the habitat map once with rasterio, derives all of 
+        the seasons from it, and writes the seasonal rasters (with .vat.dbf tables) 
+        together.  Blocks outside of the range are not written; they read as zeros.
+        Doesn't need arcpy.
+    workers -- Number of habitat maps the numpy engine processes at once, each in
+        its own process.  On Windows, call Make01Seasonal from under 
+        "if __name__ == '__main__':" when using more than 1 worker.
+    blockSize -- Height and width, in cells, of the blocks read by the numpy engine.
+    readers -- Number of threads each numpy engine process reads the next blocks of
+        a habitat map with while it writes the current one (see 
+        blocks.PrefetchWindows).  0 reads and writes strictly one after the other.
     
     Examples:
     >>> gapanalysis.data.MakeSeasonalBinary(rasters=arcpy.ListRasters(),
@@ -36,17 +50,22 @@ def Make01Seasonal(rasters, seasons, from_dir, to_dir, CONUS_extent,
     '''
     ################################################### import packages, set environments
     #####################################################################################
-    import arcpy, os, datetime
-    arcpy.ResetEnvironments()
-    arcpy.CheckOutExtension("Spatial")
-    arcpy.env.overwriteOutput=True
-    arcpy.env.snapRaster = CONUS_extent
-    arcpy.env.pyramid = 'PYRAMIDS'
-    arcpy.env.rasterStatistics = "STATISTICS"
-    arcpy.env.cellSize = 30
-    arcpy.env.scratchworkspace = to_dir
-    arcpy.env.extent = CONUS_extent
-    arcpy.env.workspace = to_dir
+    import os, datetime
+    from gapanalysis import runlog
+    if engine == "arcpy":
+        import arcpy
+        arcpy.ResetEnvironments()
+        arcpy.CheckOutExtension("Spatial")
+        arcpy.env.overwriteOutput=True
+        arcpy.env.snapRaster = CONUS_extent
+        arcpy.env.pyramid = 'PYRAMIDS'
+        arcpy.env.rasterStatistics = "STATISTICS"
+        arcpy.env.cellSize = 30
+        arcpy.env.scratchworkspace = to_dir
+        arcpy.env.extent = CONUS_extent
+        arcpy.env.workspace = to_dir
+    elif engine != "numpy":
+        raise ValueError('engine must be "arcpy" or "numpy"')
     
     ################################################### create directories for the output
     #####################################################################################
@@ -59,12 +78,44 @@ def Make01Seasonal(rasters, seasons, from_dir, to_dir, CONUS_extent,
     logg = open(log, "a")
     logg.close()
     
-    ############################################## Function to write data to the log file
+    #################################################### Log file and metrics for the run
     #####################################################################################
-    def __Log(content):
-        print content
-        with open(log, 'a') as logDoc:
-            logDoc.write(content + '\n')
+    __Log = runlog.RunLog(log, "Make01Seasonal")
+            
+    ################################################## Or process with the numpy engine
+    #####################################################################################
+    if engine == "numpy":
+        import multiprocessing
+        from gapanalysis import blocks
+        grid = blocks.CONUSGrid(CONUS_extent)[0]
+        jobs = [(raster, _SeasonNames(seasons), from_dir, to_dir, grid, blockSize, None,
+                 readers) for raster in rasters]
+        if workers > 1:
+            pool = multiprocessing.Pool(workers)
+            results = pool.imap(_Expand, jobs)
+        else:
+            pool = None
+            results = (_Expand(job) for job in jobs)
+        try:
+            for i, (raster, outcomes, runtime, metrics) in enumerate(results):
+                __Log.Merge(metrics)
+                date = datetime.datetime.now().strftime('%Y,%m,%d')
+                print(raster)
+                print(str(i + 1) + " of " + str(len(rasters)))
+                for season, error in outcomes:
+                    line = raster[:6] + "," + from_dir + raster + "," + \
+                           os.path.join(to_dir, season) + "/" + raster + "," + date
+                    if error is not None:
+                        print(error)
+                        line += ",FAILED"
+                    __Log(line)
+                print("\tTotal runtime: " + str(runtime))
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+            __Log.Close(engine=engine, rasters=len(rasters))
+        return
             
     ############################################################################  Process
     #####################################################################################
@@ -87,13 +138,15 @@ def Make01Seasonal(rasters, seasons, from_dir, to_dir, CONUS_extent,
                 print("\tAdding count pixels")            
                 summer_cnt = summer_0 + CONUS_extent
                 print("\tSaving")            
-                arcpy.management.CopyRaster(in_raster=summer_cnt, 
-                                            out_rasterdataset=to_dir + "Summer/" + raster, 
-                                            pixel_type="1_BIT", 
-                                            nodata_value="")
+                with __Log.Stage("write"):
+                    arcpy.management.CopyRaster(in_raster=summer_cnt, 
+                                                out_rasterdataset=to_dir + "Summer/" + raster, 
+                                                pixel_type="1_BIT", 
+                                                nodata_value="")
                 print("\tBuilding table")
-                arcpy.management.BuildRasterAttributeTable(to_dir + "Summer/" + raster,
-                                                           overwrite=True)
+                with __Log.Stage("RAT build"):
+                    arcpy.management.BuildRasterAttributeTable(to_dir + "Summer/" + raster,
+                                                               overwrite=True)
                 __Log(raster[:6] + "," + from_dir + raster + "," + summerDir + "/" + raster + "," + date)
             except Exception as e:
                 print(e)
@@ -111,13 +164,15 @@ def Make01Seasonal(rasters, seasons, from_dir, to_dir, CONUS_extent,
                 print("\tAdding count pixels")                     
                 winter_cnt = winter_0 + CONUS_extent
                 print("\tSaving")            
-                arcpy.management.CopyRaster(in_raster=winter_cnt, 
-                                            out_rasterdataset=to_dir + "Winter/" + raster, 
-                                            pixel_type="1_BIT", 
-                                            nodata_value="")
+                with __Log.Stage("write"):
+                    arcpy.management.CopyRaster(in_raster=winter_cnt, 
+                                                out_rasterdataset=to_dir + "Winter/" + raster, 
+                                                pixel_type="1_BIT", 
+                                                nodata_value="")
                 print("\tBuilding table")
-                arcpy.management.BuildRasterAttributeTable(to_dir + "Winter/" + raster,
-                                                           overwrite=True)
+                with __Log.Stage("RAT build"):
+                    arcpy.management.BuildRasterAttributeTable(to_dir + "Winter/" + raster,
+                                                               overwrite=True)
                 __Log(raster[:6] + "," + from_dir + raster + "," + winterDir + "/" + raster + "," + date)
             except Exception as e:
                 print(e)
@@ -134,13 +189,15 @@ def Make01Seasonal(rasters, seasons, from_dir, to_dir, CONUS_extent,
                 print("\tAdding count pixels")                     
                 any_cnt = any_0 + CONUS_extent
                 print("\tSaving")            
-                arcpy.management.CopyRaster(in_raster=any_cnt, 
-                                            out_rasterdataset=to_dir + "Any/" + raster, 
-                                            pixel_type="1_BIT", 
-                                            nodata_value="")
+                with __Log.Stage("write"):
+                    arcpy.management.CopyRaster(in_raster=any_cnt, 
+                                                out_rasterdataset=to_dir + "Any/" + raster, 
+                                                pixel_type="1_BIT", 
+                                                nodata_value="")
                 print("\tBuilding table")
-                arcpy.management.BuildRasterAttributeTable(to_dir + "Any/" + raster,
-                                                           overwrite=True)
+                with __Log.Stage("RAT build"):
+                    arcpy.management.BuildRasterAttributeTable(to_dir + "Any/" + raster,
+                                                               overwrite=True)
                 __Log(raster[:6] + "," + from_dir + raster + "," + anyDir + "/" + raster + "," + date)
             except Exception as e:
                 print(e)
@@ -149,12 +206,15 @@ def Make01Seasonal(rasters, seasons, from_dir, to_dir, CONUS_extent,
         end = datetime.datetime.now()
         runtime = end - start1
         print("\tTotal runtime: " + str(runtime))
+    __Log.Close(engine=engine, rasters=len(rasters))
 
 
 def CheckHabMaps(rasters, nodata=0, Format="TIFF", pixel_type="U2", maximum=3,
-                 minimum=3, zero=False):
+                 minimum=3, zero=False, engine="arcpy", workers=8, cache=None,
+                 report=None, deep=False, blockSize=4096, readers=2):
     '''
-    (list) -> dictionary
+    (list, [number], [string], [string], [number], [number], [boolean], [string], 
+        [integer], [string], [string], [boolean], [integer], [integer]) -> dictionary
     
     Returns a dictionary of lists, one for each error that the function tests for.
         It looks for tables with a count of values less than zero, raster values
@@ -167,6 +227,8 @@ def CheckHabMaps(rasters, nodata=0, Format="TIFF", pixel_type="U2", maximum=3,
         Keys:
         "WrongProjection" -- Raster has projection other than Albers.
         "WrongNoDataValue" -- Raster has nodata value other than nodata.
+        "NoNoDataValue" -- Raster has no nodata value at all (numpy engine only; 
+            the arcpy engine lists these under "WrongNoDataValue").
         "WrongPixelType" -- The pixel type isn't correct.
         "WrongFormat" -- Raster isn't the desired type.
         "WrongMinimum" -- Minimum from cell statistics is > allowable minimum.
@@ -177,6 +239,9 @@ def CheckHabMaps(rasters, nodata=0, Format="TIFF", pixel_type="U2", maximum=3,
         "overMax" -- The table has a value > allowable maximum in it.
         "NoRows" -- A table exists, but doesn't have any rows.
         "Zeros" -- The value "0" exists in the table.
+        "BadPixels" -- Cells have values < 0 or > maximum (deep checks only).
+        "RATMismatch" -- The table's values and counts don't match the cells, or 
+            there is no table (deep checks only).  The table is rebuilt.
     
     Argument:
     rasters -- A list of rasters to check.
@@ -185,6 +250,26 @@ def CheckHabMaps(rasters, nodata=0, Format="TIFF", pixel_type="U2", maximum=3,
     maximum -- Allowable max value for the raster.
     minimum -- Allowable min value for the raster.
     zero -- True or False on whether to check for the existence of 0 values in the table.
+    engine -- "arcpy" (the default) checks one raster at a time with arcpy.  "numpy" 
+        reads only the rasters' headers, statistics, and attribute table sidecars with
+        rasterio, in a pool of threads.  Pixels are only read if a raster has no 
+        statistics for its minimum and maximum.
+    workers -- Number of rasters the numpy engine checks at once.
+    cache -- Path to a JSON file of the numpy engine's results.  Rasters whose files 
+        (and sidecars) haven't changed since they were checked with the same 
+        settings aren't checked again.
+    report -- Path to save a JSON report of the numpy engine's results for each 
+        raster: the errors found, the minimum and maximum, and whether the result 
+        came from the cache.
+    deep -- True to have the numpy engine also read every cell of each raster, one
+        block at a time, instead of trusting the statistics and attribute table.  The
+        cells' values are checked against 0 to maximum, their counts are compared to
+        the table, and mismatched or missing tables are rebuilt (as .vat.dbf) from 
+        the counts.  Rasters are checked in separate processes; on Windows, call 
+        CheckHabMaps from under "if __name__ == '__main__':".
+    blockSize -- Height and width, in cells, of the blocks read by deep checks.
+    readers -- Number of threads each deep check reads the next blocks with while it
+        counts the current one (see blocks.PrefetchWindows).
     
 
     Examples:
@@ -192,7 +277,16 @@ def CheckHabMaps(rasters, nodata=0, Format="TIFF", pixel_type="U2", maximum=3,
     >>> a = BadProperties["WrongNoDataValue"]
     >>> a
     ['amwlfx.tif', 'andsax.tif']
+    >>> BadProperties = CheckHabMaps(glob.glob("C:/models/*.tif"), engine="numpy",
+                                     cache="C:/models/check_cache.json",
+                                     report="C:/models/check_report.json")
     '''
+    if engine == "numpy":
+        return _CheckHabMapsNumpy(rasters, [nodata, Format, pixel_type, maximum, 
+                                            minimum, zero, deep], 
+                                  workers, cache, report, blockSize, readers)
+    elif engine != "arcpy":
+        raise ValueError('engine must be "arcpy" or "numpy"')
     import arcpy, time
     
     #######################################  Initialize dictionaries for collection
@@ -274,9 +368,11 @@ def CheckHabMaps(rasters, nodata=0, Format="TIFF", pixel_type="U2", maximum=3,
 
 
 def Make0123(rasters, CONUS_extent, from_dir, to_dir, 
-             log="P:/Proj3/USGap/Vert/Model/Output/CONUS/log.txt"):
+             log="P:/Proj3/USGap/Vert/Model/Output/CONUS/log.txt",
+             engine="arcpy", workers=1, blockSize=4096, readers=2):
     '''
-    (list, string, string, string, string, string) -> saved raster
+    (list, string, string, string, string, string, [string], [int], [int], [int]) -> 
+        saved raster
     
     Copies a GAP habitat map that is in the format of values 1-3 and nodata (no zeros) 
         and with an extent defined by the species range to a full CONUS extent version
@@ -292,6 +388,19 @@ def Make0123(rasters, CONUS_extent, from_dir, to_dir,
     to_dir -- Directory to work in and save output.  It should have a subdirectory named
         "0123".
     log -- Path to the log file used to keep track of habmap movement and creation.
+    engine -- "arcpy" (the default) uses arcpy map algebra and then builds 
+        statistics and a RAT.  "numpy" creates the CONUS extent 2 bit raster as a
+        compressed, tiled GeoTIFF and writes only the blocks that overlap the range
+        or the counter pixels, in one read of the map.  The RAT (.vat.dbf) comes from
+        the counts of the written blocks plus the zeros of the rest.  Doesn't need 
+        arcpy.
+    workers -- Number of habitat maps the numpy engine processes at once, each in
+        its own process.  On Windows, call Make0123 from under 
+        "if __name__ == '__main__':" when using more than 1 worker.
+    blockSize -- Height and width, in cells, of the blocks read by the numpy engine.
+    readers -- Number of threads each numpy engine process reads the next blocks of
+        a habitat map with while it writes the current one (see 
+        blocks.PrefetchWindows).  0 reads and writes strictly one after the other.
 
     Examples:
     >>> gapanalysis.data.Expand_0s(rasters=arcpy.ListRasters(), 
@@ -301,21 +410,60 @@ def Make0123(rasters, CONUS_extent, from_dir, to_dir,
                                    log = "P:/Proj3/USGap/Vert/Model/Output/CONUS/log.txt")
     >>>
     '''
-    import arcpy, datetime
-    arcpy.CheckOutExtension("Spatial")
-    arcpy.overwriteOutput=True
-    arcpy.env.snapRaster = CONUS_extent
-    arcpy.env.extent = CONUS_extent
-    arcpy.env.workspace = to_dir
-    
+    import datetime
+    from gapanalysis import runlog
+    if engine == "arcpy":
+        import arcpy
+        arcpy.CheckOutExtension("Spatial")
+        arcpy.overwriteOutput=True
+        arcpy.env.snapRaster = CONUS_extent
+        arcpy.env.extent = CONUS_extent
+        arcpy.env.workspace = to_dir
+    elif engine != "numpy":
+        raise ValueError('engine must be "arcpy" or "numpy"')
     
-    ######################################### Function to write data to the log file
+    ############################################### Log file and metrics for the run
     ################################################################################
-    log = log
-    def __Log(content):
-        print content
-        with open(log, 'a') as logDoc:
-            logDoc.write(content + '\n')
+    __Log = runlog.RunLog(log, "Make0123")
+            
+    ############################################### Or expand with the numpy engine
+    ################################################################################
+    if engine == "numpy":
+        import os, multiprocessing
+        from gapanalysis import blocks
+        if not os.path.exists(to_dir + "0123/"):
+            os.makedirs(to_dir + "0123/")
+        grid, counter = blocks.CONUSGrid(CONUS_extent)
+        if grid.counter is None:
+            counter = None
+        jobs = [(sp, ["0123"], from_dir, to_dir, grid, blockSize, counter, readers)
+                for sp in rasters]
+        if workers > 1:
+            pool = multiprocessing.Pool(workers)
+            results = pool.imap(_Expand, jobs)
+        else:
+            pool = None
+            results = (_Expand(job) for job in jobs)
+        try:
+            for sp, outcomes, runtime, metrics in results:
+                __Log.Merge(metrics)
+                date = datetime.datetime.now().strftime('%Y,%m,%d')
+                print(sp)
+                newTiff = to_dir + "0123/" + sp
+                error = outcomes[0][1]
+                if error is None:
+                    print("\tTotal runtime: " + str(runtime))
+                    __Log(sp[:6] + "," + from_dir + sp + "," + newTiff + "," + date)
+                else:
+                    print('ERROR expanding raster - {0}'.format(error))
+                    __Log(sp[:6] + "," + from_dir + sp + "," + newTiff + "," + date + 
+                          ",Failed")
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+            __Log.Close(engine=engine, rasters=len(rasters))
+        return
             
     ######################################### Expand each raster to Conus and add 0s
     ################################################################################
@@ -331,16 +479,503 @@ def Make0123(rasters, CONUS_extent, from_dir, to_dir,
             print("\tSumming")
             newRast = ConNull + CONUS_extent
             print("\tSaving")
-            arcpy.management.CopyRaster(newRast, newTiff, pixel_type="2_BIT", 
-                                        nodata_value="")
+            with __Log.Stage("write"):
+                arcpy.management.CopyRaster(newRast, newTiff, pixel_type="2_BIT", 
+                                            nodata_value="")
             print("\tCalculating statistics")
-            arcpy.management.CalculateStatistics(newTiff)
-            print("\tBuilding RAT")
-            arcpy.management.BuildRasterAttributeTable(newTiff, overwrite=True)
+            with __Log.Stage("RAT build"):
+                arcpy.management.CalculateStatistics(newTiff)
+                print("\tBuilding RAT")
+                arcpy.management.BuildRasterAttributeTable(newTiff, overwrite=True)
             end = datetime.datetime.now()
             runtime = end - start1
             print("\tTotal runtime: " + str(runtime))
             __Log(sp[:6] + "," + from_dir + sp + "," + newTiff + "," + date)
         except Exception as e:
             print('ERROR expanding raster - {0}'.format(e))
-            __Log(sp[:6] + "," + from_dir + sp + "," + newTiff + "," + date + ",Failed")
\ No newline at end of file
+            __Log(sp[:6] + "," + from_dir + sp + "," + newTiff + "," + date + ",Failed")
+    __Log.Close(engine=engine, rasters=len(rasters))
+
+def MakeSparse(rasters, seasons, from_dir, to_dir, CONUS_extent, blockSize=4096,
+               log="P:/Proj3/USGap/Vert/Model/Output/CONUS/log.txt", readers=2):
+    '''
+    (list, list, string, string, string, [integer], [string], [integer]) -> 
+        saved rasters
+    
+    An alternative to Make01Seasonal and Make0123 that doesn't expand habitat maps to
+        the CONUS extent.  Copies a GAP habitat map that is in the format of values 1-3
+        and nodata (no zeros) and with an extent defined by the species range to a 
+        "sparse" version with the same (range) extent, zeros instead of nodata, and
+        1 bit (seasons) or 2 bit ("0123") cells.  A raster is saved for each season in
+        a "Summer", "Winter", "Any", or "0123" directory, with a .vat.dbf table.
+        Sparse maps record their offsets in the CONUS grid in "GAP_ROW_OFFSET" and 
+        "GAP_COL_OFFSET" tags.  Instead of storing counter pixels, a "GAP_COUNTER" tag
+        records how many the map implies (seasonal maps store 0 in any counter 
+        pixels that are in the range, so the table doesn't count them twice), and 
+        for "0123" maps a "GAP_COUNTER_VALUES" tag records the CONUS extent's counter
+        values that Make0123 adds.  The numpy engines (e.g., 
+        richness.MapRichness(engine="numpy")) read sparse maps directly, treat cells 
+        outside of the range extent as zeros, and add the implied counter pixels, so 
+        the results are the same as with CONUS extent maps.  Requires rasterio, but
+        not arcpy.  Each map is read once for all seasons.
+    
+    Arguments:
+    rasters -- A list of rasters to copy.
+    seasons -- A list of seasons create rasters for ("Summer", "Winter", "Any", 
+        "0123", or abbreviations as for Make01Seasonal).
+    from_dir -- Directory to copy rasters from.
+    to_dir -- Directory to create seasonal subdirectories in and save to.
+    CONUS_extent -- The CONUS extent raster, which defines the grid the habitat maps
+        must be snapped to and the counter pixels.
+    blockSize -- Height and width, in cells, of the blocks read at a time.
+    log -- The log file to record progress to.
+    readers -- Number of threads that read the next blocks of a habitat map while the
+        current one is written (see blocks.PrefetchWindows).
+    
+    Examples:
+    >>> gapanalysis.data.MakeSparse(rasters=["bAMROx.tif"], seasons=["Summer", "0123"],
+                                    from_dir="C:/data/maps/", 
+                                    to_dir="C:/data/Sparse/",
+                                    CONUS_extent="C:/data/conus_ext_cnt.tif",
+                                    log="C:/data/Sparse/log.txt")
+    >>>
+    '''
+    import os, json, datetime, numpy as np, rasterio
+    from gapanalysis import blocks, runlog
+    
+    #################################################### Log file and metrics for the run
+    #####################################################################################
+    __Log = runlog.RunLog(log, "MakeSparse")
+    
+    ################################################### create directories for the output
+    #####################################################################################
+    outSeasons = _SeasonNames(seasons)
+    for x in outSeasons:
+        if not os.path.exists(os.path.join(to_dir, x)):
+            os.makedirs(os.path.join(to_dir, x))
+            
+    ############################################################################  Process
+    #####################################################################################
+    grid, counterValues = blocks.CONUSGrid(CONUS_extent)
+    nCounter = grid.counter[2]*grid.counter[3] if grid.counter else 0
+    try:
+        for raster in rasters:
+            start1 = datetime.datetime.now()
+            date = start1.strftime('%Y,%m,%d')
+            print(raster)
+            print(str(rasters.index(raster) + 1) + " of " + str(len(rasters)))
+            outs, done = {}, []
+            try:
+                with rasterio.open(from_dir + raster) as src:
+                    rangeWindow = blocks.SourceWindow(src, grid)
+                    rangeGrid = blocks.SubGrid(grid, rangeWindow)
+                    for x in outSeasons:
+                        outs[x] = blocks.CreateRaster(to_dir + x + "/" + raster, 
+                                                      rangeGrid, "uint8", 
+                                                      nbits=2 if x == "0123" else 1)
+                        outs[x].update_tags(GAP_ROW_OFFSET=rangeWindow[0], 
+                                            GAP_COL_OFFSET=rangeWindow[1],
+                                            GAP_COUNTER=nCounter)
+                        if x == "0123" and nCounter:
+                            outs[x].update_tags(GAP_COUNTER_VALUES=json.dumps(
+                                                counterValues.tolist()))
+                    hists = dict([(x, None) for x in outSeasons])
+                    windows = [blocks.Intersect(w, rangeWindow) 
+                               for w in blocks.BlockWindows(grid, blockSize)]
+                    windows = [w for w in windows if w is not None]
+                    reads = blocks.PrefetchWindows([(from_dir + raster, w) 
+                                                    for w in windows],
+                                                   grid, readers=readers)
+                    for window in windows:
+                        with __Log.Stage("read"):
+                            data = next(reads)
+                        __Log.Count("bytes read", data.nbytes)
+                        __Log.Count("cells", data.size)
+                        local = (window[0] - rangeWindow[0], window[1] - rangeWindow[1],
+                                 window[2], window[3])
+                        counter = blocks.Intersect(window, grid.counter) \
+                                  if grid.counter is not None else None
+                        for x in outSeasons:
+                            with __Log.Stage("compute"):
+                                out = _SeasonValues(data, x)
+                                if counter is not None and x != "0123":
+                                    # The implied counter pixels replace these cells, so
+                                    # they aren't counted twice in the table
+                                    out[counter[0] - window[0]:
+                                        counter[0] - window[0] + counter[2],
+                                        counter[1] - window[1]:
+                                        counter[1] - window[1] + counter[3]] = 0
+                                hists[x] = blocks.AddHistogram(hists[x], out)
+                            with __Log.Stage("write"):
+                                blocks.WriteWindow(outs[x], rangeGrid, local, out)
+                            __Log.Count("bytes written", out.nbytes)
+                for x in outSeasons:
+                    outs.pop(x).close()
+                    values = np.nonzero(hists[x])[0]
+                    with __Log.Stage("RAT build"):
+                        blocks.WriteVAT(to_dir + x + "/" + raster, values, 
+                                        hists[x][values])
+                    __Log(raster[:6] + "," + from_dir + raster + "," + to_dir + x + 
+                          "/" + raster + "," + date)
+                    done.append(x)
+            except Exception as e:
+                print(e)
+                # Seasons that were saved before the failure stay logged as saved
+                for x in outSeasons:
+                    if x in outs:
+                        outs[x].close()
+                    if x not in done:
+                        __Log(raster[:6] + "," + from_dir + raster + "," + to_dir + x + 
+                              "/" + raster + "," + date + ",FAILED")
+        
+            end = datetime.datetime.now()
+            runtime = end - start1
+            print("\tTotal runtime: " + str(runtime))
+    finally:
+        __Log.Close(rasters=len(rasters))
+
+
+def _CheckHabMapsNumpy(rasters, settings, workers, cache, report, blockSize, 
+                       readers=2):
+    '''
+    The numpy engine of CheckHabMaps.  Checks rasters in a thread pool, or gets their
+        results from the cache, then collects the errors into CheckHabMaps' 
+        dictionary.
+    '''
+    import os, json, datetime, multiprocessing
+    from multiprocessing.pool import ThreadPool
+    deep = settings[6]
+    cached = {}
+    if cache is not None and os.path.exists(cache):
+        with open(cache) as f:
+            cached = json.load(f)
+    results = {}
+    jobs = []
+    for r in rasters:
+        old = cached.get(os.path.abspath(r))
+        if old is not None and old["settings"] == settings and \
+           old["stamp"] == _FileStamp(r):
+            results[r] = dict(old, cached=True)
+        else:
+            jobs.append(r)
+    if workers > 1 and len(jobs) > 1:
+        # Decoding pixels needs processes, reading headers only needs threads
+        pool = multiprocessing.Pool(workers) if deep else ThreadPool(workers)
+    else:
+        pool = None
+    try:
+        if pool is not None:
+            checked = pool.imap(_CheckHabMap, [(r, settings, blockSize, readers) 
+                                               for r in jobs])
+        else:
+            checked = (_CheckHabMap((r, settings, blockSize, readers)) for r in jobs)
+        # Take each result as it's checked, rather than zip them all at the end
+        for i, result in enumerate(checked):
+            r = jobs[i]
+            results[r] = dict(result, cached=False)
+            cached[os.path.abspath(r)] = result
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+        # Keep the rasters checked so far, even if one of the checks failed
+        if cache is not None:
+            with open(cache, "w") as f:
+                json.dump(cached, f, indent=1, sort_keys=True)
+    
+    # Collect the errors as the arcpy engine does
+    errors = dict([(key, []) for key in ("WrongProjection", "WrongNoDataValue", 
+                                         "NoNoDataValue", "WrongPixelType", "WrongFormat", 
+                                         "WrongMinimum", "WrongMaximum", "BadCount",
+                                         "CursorProblem", "overMax", "NoRows", 
+                                         "Zeros")])
+    if deep:
+        errors["BadPixels"] = []
+        errors["RATMismatch"] = []
+    for r in rasters:
+        print(r)
+        for message in results[r]["messages"]:
+            print(message)
+        for key in results[r]["errors"]:
+            # Attribute table problems are listed by raster name
+            if key in ("BadCount", "CursorProblem", "overMax", "NoRows", "Zeros",
+                       "RATMismatch"):
+                errors[key].append(os.path.basename(r))
+            else:
+                errors[key].append(r)
+    if report is not None:
+        with open(report, "w") as f:
+            json.dump({"checked": datetime.datetime.now().strftime("%Y-%m-%d %H:%M"),
+                       "settings": dict(zip(["nodata", "Format", "pixel_type", 
+                                             "maximum", "minimum", "zero", "deep"],
+                                            settings)),
+                       "rasters": dict([(r, results[r]) for r in rasters]),
+                       "errors": errors}, f, indent=1, sort_keys=True)
+    return errors
+
+
+def _FileStamp(raster):
+    '''
+    Returns the modification times and sizes of a raster and its sidecar files, with
+        None for sidecars that don't exist.
+    '''
+    import os
+    stamp = []
+    for path in (raster, raster + ".vat.dbf", raster + ".aux.xml"):
+        if os.path.exists(path):
+            stat = os.stat(path)
+            stamp.append([stat.st_mtime, stat.st_size])
+        else:
+            stamp.append(None)
+    return stamp
+
+
+def _PixelType(src):
+    '''
+    Returns the ArcGIS pixel type (such as "U2" or "S16") of a rasterio dataset.
+    '''
+    import numpy as np
+    dtype = np.dtype(src.dtypes[0])
+    nbits = src.tags(1, ns="IMAGE_STRUCTURE").get("NBITS")
+    if nbits is not None and int(nbits) < 8:
+        return "U" + str(nbits)
+    if dtype.kind == "f":
+        return "F" + str(8*dtype.itemsize)
+    return dtype.kind.upper().replace("I", "S") + str(8*dtype.itemsize)
+
+
+def _CheckHabMap(args):
+    '''
+    Checks one raster for CheckHabMaps' numpy engine.  Returns a dictionary of the
+        names of the errors found, messages to print, the raster's minimum and 
+        maximum, and the stamp of the files and the settings that were checked.
+    '''
+    import rasterio
+    from gapanalysis import misc
+    r, settings, blockSize, readers = args
+    nodata, Format, pixel_type, maximum, minimum, zero, deep = settings
+    errors, messages = [], []
+    result = {}
+    if deep:
+        result = _CheckHabMapCells(r, maximum, blockSize, readers)
+        if result["badPixels"]:
+            messages.append(r + " - has {0} cells < 0 or > {1}".format(
+                            result["badPixels"], maximum))
+            errors.append("BadPixels")
+        if result["rebuiltRAT"]:
+            messages.append(r + " - table didn't match the cells and was rebuilt")
+            errors.append("RATMismatch")
+    stamp = _FileStamp(r)
+    formats = {"GTiff": "TIFF", "AIG": "GRID", "HFA": "IMAGINE Image"}
+    with rasterio.open(r) as src:
+        ##################################### Examine the header like a describe object
+        ###############################################################################
+        if src.crs is None or "Albers" not in src.crs.to_wkt():
+            errors.append("WrongProjection")
+        if formats.get(src.driver, src.driver) != Format:
+            errors.append("WrongFormat")
+        if _PixelType(src) != pixel_type:
+            errors.append("WrongPixelType")
+        if src.nodata is None and nodata is not None:
+            errors.append("NoNoDataValue")
+        elif src.nodata != nodata:
+            errors.append("WrongNoDataValue")
+        tags = src.tags(1)
+    ############################### Use saved statistics, or calculate them if missing
+    ###################################################################################
+    if deep:
+        low, high = result.pop("minimum"), result.pop("maximum")
+    elif "STATISTICS_MINIMUM" in tags and "STATISTICS_MAXIMUM" in tags:
+        low, high = float(tags["STATISTICS_MINIMUM"]), float(tags["STATISTICS_MAXIMUM"])
+    else:
+        low, high = misc.RasterStats(r, engine="numpy")["range"]
+    if high > maximum:
+        errors.append("WrongMaximum")
+    if low > minimum:
+        errors.append("WrongMinimum")
+    ############################################## Check the raster attribute table
+    ###############################################################################
+    try:
+        RAT = misc.ReadRAT(r)
+    except Exception:
+        messages.append("No Cursor")
+        errors.append("CursorProblem")
+    else:
+        for value, countt in zip(RAT["VALUE"], RAT["COUNT"]):
+            if countt <= 0:
+                messages.append(r + "  - has bad counts")
+                errors.append("BadCount")
+            if value > maximum:
+                messages.append(r + " - has a value greater than {0}".format(maximum))
+                errors.append("overMax")
+            if zero == True and value == 0:
+                messages.append(r + " - has a value equal to 0")
+                errors.append("Zeros")
+        if len(RAT["VALUE"]) == 0:
+            errors.append("NoRows")
+    result.update({"errors": errors, "messages": messages, "minimum": low, 
+                   "maximum": high, "stamp": stamp, "settings": settings})
+    return result
+
+
+def _CheckHabMapCells(raster, maximum, blockSize, readers=2):
+    '''
+    Reads every cell of a raster, one block at a time, for a deep check.  Counts the
+        cells of each value (other than nodata) and the cells < 0 or > maximum, and
+        rebuilds the attribute table if it doesn't match the counts.  Blocks are
+        read ahead by readers threads.  Returns a dictionary of the minimum and 
+        maximum, the number of bad and nodata cells, the counts of each value, and
+        whether the table was rebuilt.
+    '''
+    import numpy as np, rasterio
+    from gapanalysis import blocks, misc
+    hist, uniques = None, []
+    nodataCells = 0
+    with rasterio.open(raster) as src:
+        unsigned = np.dtype(src.dtypes[0]).kind == "u"
+        nodata = src.nodata
+        cellBytes = np.dtype(src.dtypes[0]).itemsize
+        t = src.transform
+        # The raster's own grid, so that windows are read as they are stored
+        grid = blocks.Grid(t.c, t.f, t.a, src.height, src.width, None, None)
+    # Filling nodata with nodata leaves it as it is, to be counted
+    windows = blocks.BlockWindows(grid, blockSize)
+    for data in blocks.PrefetchWindows([(raster, w) for w in windows], grid,
+                                       fill=0 if nodata is None else nodata,
+                                       readers=readers, cellBytes=cellBytes):
+        if nodata is not None:
+            valid = data != nodata
+            nodataCells += int(data.size - valid.sum())
+            data = data[valid]
+        if unsigned:
+            hist = blocks.AddHistogram(hist, data)
+        else:
+            uniques.append(np.unique(data, return_counts=True))
+    if unsigned:
+        values = np.nonzero(hist)[0] if hist is not None else np.array([], dtype=int)
+        counts = hist[values] if hist is not None else np.array([], dtype=np.int64)
+    elif uniques:
+        values, counts = misc._MergeUniques(uniques)
+    else:
+        values, counts = np.array([], dtype=int), np.array([], dtype=np.int64)
+    # Compare the attribute table to the cells' counts
+    try:
+        RAT = misc.ReadRAT(raster)
+        matches = len(RAT["VALUE"]) == len(values) and \
+                  (RAT["VALUE"] == values).all() and (RAT["COUNT"] == counts).all()
+    except Exception:
+        matches = False
+    if not matches:
+        blocks.WriteVAT(raster, values, counts)
+    bad = counts[(values < 0) | (values > maximum)].sum()
+    return {"minimum": values.min().item() if len(values) else None,
+            "maximum": values.max().item() if len(values) else None,
+            "badPixels": int(bad), "nodataCells": nodataCells,
+            "cellCounts": dict([(str(v), int(c)) for v, c in zip(values, counts)]),
+            "rebuiltRAT": not matches}
+
+
+def _SeasonNames(seasons):
+    '''
+    Returns the output directory names ("Summer", "Winter", "Any", "0123") for a list
+        of seasons that may include abbreviations, as accepted by Make01Seasonal.
+    '''
+    aliases = {"Summer": ["Summer", "summer", "S", "s"],
+               "Winter": ["Winter", "winter", "W", "w"],
+               "Any": ["Any", "any", "A", "a"],
+               "0123": ["0123"]}
+    return [x for x in ["Summer", "Winter", "Any", "0123"] 
+            if set(aliases[x]) & set(seasons)]
+
+
+def _SeasonValues(data, season):
+    '''
+    Returns a block of a 0-3 habitat map reclassed to 0/1 (uint8) for a season, or
+        unchanged for "0123".
+    '''
+    import numpy as np
+    habitat = {"Summer": (1, 3), "Winter": (2, 3), "Any": (1, 2, 3)}
+    if season == "0123":
+        return data
+    return np.in1d(data, habitat[season]).reshape(data.shape).astype(np.uint8)
+
+
+def _Expand(args):
+    '''
+    Expands one habitat map to CONUS extent 0/1 rasters for several seasons, or to a
+        0-3 raster for "0123", in one read of the map, for the numpy engines of 
+        Make01Seasonal and Make0123.  Counter pixels are 1 in seasonal rasters; the
+        CONUS extent's counter values (counter) are added to "0123" rasters.  Returns 
+        the raster, a list of (season, error or None), the runtime, and Metrics.
+    '''
+    import datetime, numpy as np, rasterio
+    from gapanalysis import blocks, runlog
+    (raster, outSeasons, from_dir, to_dir, grid, blockSize, counterValues, 
+     readers) = args
+    metrics = runlog.Metrics()
+    if counterValues is None and grid.counter is not None:
+        counterValues = np.ones(grid.counter[2:], dtype=np.uint8)
+    start1 = datetime.datetime.now()
+    outs, outcomes = {}, []
+    try:
+        with rasterio.open(from_dir + raster) as src:
+            rangeWindow = blocks.SourceWindow(src, grid)
+            for x in outSeasons:
+                outs[x] = blocks.CreateRaster(to_dir + x + "/" + raster, grid, "uint8",
+                                              nbits=2 if x == "0123" else 1, 
+                                              sparseOK=True)
+            hists = dict([(x, None) for x in outSeasons])
+            written = 0
+            windows = [w for w in blocks.BlockWindows(grid, blockSize)
+                       if blocks.NeedsWindow(w, rangeWindow, grid)]
+            reads = blocks.PrefetchWindows([(from_dir + raster, w) for w in windows],
+                                           grid, readers=readers)
+            for window in windows:
+                with metrics.Stage("read"):
+                    data = next(reads)
+                metrics.Count("bytes read", data.nbytes)
+                counter = blocks.Intersect(window, grid.counter) \
+                          if grid.counter is not None else None
+                for x in outSeasons:
+                    with metrics.Stage("compute"):
+                        out = _SeasonValues(data, x)
+                        if counter is not None:
+                            if x == "0123":
+                                # Don't add the counter to the block the seasons use
+                                out = out.copy()
+                            part = out[counter[0] - window[0]:
+                                       counter[0] - window[0] + counter[2],
+                                       counter[1] - window[1]:
+                                       counter[1] - window[1] + counter[3]]
+                            if x == "0123":
+                                r, c = (counter[0] - grid.counter[0], 
+                                        counter[1] - grid.counter[1])
+                                part += counterValues[r:r + counter[2], 
+                                                      c:c + counter[3]]
+                                # 2 bit cells can't hold more than 3, as 
+                                # blocks.ReadWindow clips sparse maps
+                                np.minimum(part, 3, out=part)
+                            else:
+                                part[:] = 1
+                        hists[x] = blocks.AddHistogram(hists[x], out)
+                    with metrics.Stage("write"):
+                        blocks.WriteWindow(outs[x], grid, window, out)
+                    metrics.Count("bytes written", out.nbytes)
+                written += data.size
+            metrics.Count("cells", written)
+        for x in outSeasons:
+            outs.pop(x).close()
+            # Blocks that weren't written are zeros
+            hist = blocks.MergeHistograms(hists[x], 
+                                          np.array([grid.height*grid.width - written]))
+            values = np.nonzero(hist)[0]
+            with metrics.Stage("RAT build"):
+                blocks.WriteVAT(to_dir + x + "/" + raster, values, hist[values])
+            outcomes.append((x, None))
+    except Exception as e:
+        for x in outs:
+            outs[x].close()
+        # Seasons saved before the failure succeeded
+        done = [x for x, error in outcomes]
+        outcomes += [(x, e) for x in outSeasons if x not in done]
+    return raster, outcomes, datetime.datetime.now() - start1, metrics
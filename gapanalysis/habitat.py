@@ -3,10 +3,15 @@ Created Oct 31, 2016 by N. Tarr
 Functions related to calculating the amount of species' habitat that falls within zones
 of interest.
 """
+# Increase when PercentOverlay's results change, so incremental runs redo every species
+_OverlayVersion = 1
+
 def PercentOverlay(zoneFile, zoneName, zoneField, habmapList, habDir, workDir, scratchDir,
-                   snap, extent="habMap"):
+                   snap, extent="habMap", engine="arcpy", blockSize=4096, zoneCache=None,
+                   zoneCacheSize=20, incremental=False, store="csv", readers=2):
     '''
-    (string, string, string, list, string, string, string, string) -> pandas dataframe
+    (string, string, string, list, string, string, string, string, [string], [string],
+     [int], [string], [number], [boolean], [string], [int]) -> pandas dataframe
     
     This function calculates the number of habitat pixels and proportion of each species'
         summer, winter, and year-round habitat that occurs in each "zone" of a raster. 
@@ -51,6 +56,39 @@ def PercentOverlay(zoneFile, zoneName, zoneField, habmapList, habDir, workDir, s
         with an extent matching that species' habitat's extent.  zoneFile will do analyses
         at the extent of the zoneFile, which is usually CONUS and therefore takes much 
         longer.
+    engine -- "arcpy" (the default) sums each habitat map with the zone raster using
+        arcpy and reads the counts from the sum's attribute table.  "numpy" reads each
+        block of the zone raster once and counts the (zone, season code) pairs of 
+        every habitat map in it with numpy.bincount, without temporary rasters or 
+        arcpy.  The zone raster must be snapped to the habitat maps, and zone values 
+        are read from its .vat.dbf table.  Sparse habitat maps (data.MakeSparse) can 
+        be used, with the counter pixels they imply at snap's counter pixels; with 
+        extent="habMap" their extent is the range extent rather than the CONUS 
+        extent.  RunTime is the time spent on each species' blocks.
+    blockSize -- Height and width, in cells, of the blocks read by the numpy engine.
+    zoneCache -- Optional directory for caching what is learned about zone rasters.
+        Entries are keyed by the zone raster's path, modification time, and size, and
+        zoneField, so when the same, unchanged zone raster is used again its check 
+        (RasterReport) and list of zone values are skipped.  The numpy engine also 
+        caches the zone of every cell, block by block (compressed), and reuses it 
+        instead of reading the zone raster, so its entries are keyed by blockSize 
+        too.
+    zoneCacheSize -- Disk budget for zoneCache, in GB.  The least recently used 
+        entries are deleted when the cache is larger.
+    incremental -- True to skip species that are already in the master table and 
+        whose inputs haven't changed since they were run.  Inputs are recorded in 
+        "Percent_in_<zoneName>_Manifest.json" as checksums of the habitat map and
+        zone raster, the zone field, extent, and a version of this code.  Checksums 
+        are only recalculated for files whose modification time or size changed.
+    store -- How to save the master table.  "csv" (the default) archives a copy of 
+        "Percent_in_<zoneName>_Master.csv", updates it, and rewrites it, unless no 
+        cell counts changed.  "parts" appends a csv file of just the new rows to the
+        "Percent_in_<zoneName>_Master" directory; the master table is the parts read
+        in order, with later rows replacing earlier ones.  Nothing is rewritten or 
+        copied.
+    readers -- Number of threads the numpy engine reads the next habitat maps' 
+        blocks with while it counts the current one (see blocks.PrefetchWindows).
+        0 reads and counts strictly one after the other.
     
     Example:
     >>>ProportionPineDF = ga.representation.Calculate(zoneFile = "C:/data/Pine.tif",
@@ -64,14 +102,19 @@ def PercentOverlay(zoneFile, zoneName, zoneField, habmapList, habDir, workDir, s
     '''
     ############################################################## Imports and settings
     ###################################################################################
-    import arcpy, pandas as pd, os
+    import pandas as pd, numpy as np, os, json
     from datetime import datetime
-    arcpy.CheckOutExtension("Spatial")
-    arcpy.env.extent = arcpy.Raster(zoneFile).extent
-    arcpy.env.snapRaster = snap
-    arcpy.env.cellSize = 30
-    arcpy.env.overwriteOutput = True
-    arcpy.env.rasterStatistics = "STATISTICS"
+    from gapanalysis import runlog
+    if engine == "arcpy":
+        import arcpy
+        arcpy.CheckOutExtension("Spatial")
+        arcpy.env.extent = arcpy.Raster(zoneFile).extent
+        arcpy.env.snapRaster = snap
+        arcpy.env.cellSize = 30
+        arcpy.env.overwriteOutput = True
+        arcpy.env.rasterStatistics = "STATISTICS"
+    elif engine != "numpy":
+        raise ValueError('engine must be "arcpy" or "numpy"')
     pd.set_option('display.width', 1000)
         
     ################################ Create the working directories if they don't exist
@@ -87,21 +130,51 @@ def PercentOverlay(zoneFile, zoneName, zoneField, habmapList, habDir, workDir, s
     if not os.path.exists(archive):
         os.makedirs(archive)
         
-    ############################################ Function to write data to the log file
+    ################################################## Log file and metrics for the run
     ###################################################################################
     starttime0 = datetime.now()
     timestamp = starttime0.strftime('%Y-%m-%d')
     
     log = workDir + "/log{0}.txt".format(timestamp)
-    def __Log(content):
-        print content
-        with open(log, 'a') as logDoc:
-            logDoc.write(content + '\n')
+    __Log = runlog.RunLog(log, "PercentOverlay")
     
     __Log("\n\n\n****************  " + timestamp + "  **************************\n")
     __Log("\nRasters that will be processed: " + str(habmapList) + "\n")
     __Log("Checked for and built required directories, lists, & dataframes")
     
+    ###################################### Skip species whose inputs haven't changed
+    ###################################################################################
+    masterFileName = workDir + "/Percent_in_" + zoneName + "_Master.csv"
+    if store == "parts":
+        masterFileName = workDir + "/Percent_in_" + zoneName + "_Master"
+    elif store != "csv":
+        raise ValueError('store must be "csv" or "parts"')
+    manifestFile = workDir + "/Percent_in_" + zoneName + "_Manifest.json"
+    if incremental:
+        manifest = {"files": {}, "species": {}}
+        if os.path.exists(manifestFile):
+            with open(manifestFile) as f:
+                manifest = json.load(f)
+        with __Log.Stage("checksums"):
+            zoneSum = _Checksum(zoneFile, manifest["files"])
+            inputs = {}
+            for sp in habmapList:
+                inputs[sp] = {"habmap": _Checksum(habDir + sp, manifest["files"]),
+                              "zone": zoneSum, "zoneField": zoneField, 
+                              "extent": extent, "version": _OverlayVersion}
+        done = set()
+        if os.path.exists(masterFileName):
+            with __Log.Stage("table update"):
+                done = set(_LoadMaster(masterFileName).index.get_level_values(0))
+        unchanged = [sp for sp in habmapList 
+                     if sp in done and manifest["species"].get(sp) == inputs[sp]]
+        __Log("Skipping species with unchanged inputs: " + str(unchanged))
+        habmapList = [sp for sp in habmapList if sp not in unchanged]
+        if len(habmapList) == 0:
+            __Log("Nothing to update")
+            __Log.Close(engine=engine, species=0)
+            return _LoadMaster(masterFileName)
+    
     ############################################### Function to check raster properties
     ###################################################################################
     def RasterReport(raster):
@@ -145,190 +218,480 @@ def PercentOverlay(zoneFile, zoneName, zoneField, habmapList, habDir, workDir, s
     
     ###################################### Inspect the zone raster to make sure it's OK
     ###################################################################################
-    __Log("Checking zone raster properties")
-    zoneFile = arcpy.Raster(zoneFile)
-    RasterReport(zoneFile)
+    zoneKey = None
+    if zoneCache is not None:
+        from gapanalysis import cache
+        if engine == "numpy":
+            # Entries hold the zone index of each block, too
+            zoneKey = cache.FileKey(zoneFile, zoneField, engine, blockSize)
+        else:
+            zoneKey = cache.FileKey(zoneFile, zoneField)
+        zoneEntry = cache.Entry(zoneCache, zoneKey)
+    if zoneKey is not None and zoneEntry is not None:
+        __Log("Zone raster unchanged since it was checked on {0}, using cached "
+              "zone values".format(cache.LoadJSON(zoneEntry, "zone")["checked"]))
+        if engine == "arcpy":
+            zoneFile = arcpy.Raster(zoneFile)
+    elif engine == "numpy":
+        __Log("Checking zone raster properties")
+        import rasterio
+        with rasterio.open(zoneFile) as src:
+            __Log("----" + str(zoneFile))
+            __Log("\tNoDataValue: " + str(src.nodata))
+            __Log("\t" + str(src.crs))
+            __Log("\t" + str(src.driver))
+            __Log("\t" + str(src.dtypes[0]))
+            __Log("\tHas RAT = " + str(os.path.exists(zoneFile + ".vat.dbf")))
+    else:
+        __Log("Checking zone raster properties")
+        zoneFile = arcpy.Raster(zoneFile)
+        RasterReport(zoneFile)
     
     ######################################## Get list of unique values from zone raster
     ###################################################################################
-    zoneCursor = arcpy.SearchCursor(zoneFile)
-    zoneValues = []
-    for z in zoneCursor:
-        zoneValues.append(z.getValue(zoneField))
-    
-    ################################################################# Some housekeeping
-    ###################################################################################
-    ### Build empty dataframe with hierarchical indexing
-    colList = ValueMap.values() + ["Date", "RunTime"]
-    indexSpecies = habmapList * len(zoneValues)
-    indexSpecies.sort()
-    indexList = [indexSpecies, zoneValues * len(habmapList)]
-    df1 = pd.DataFrame(index=indexList, columns=colList).fillna(value=0)
-    df1.index.names = ["GeoTiff", "Zone"]
-        
-    ################################ Loop through rasters, sum species and zone rasters
-    ###################################################################################
-    arcpy.env.scratchworkspace = scratchDir
-    arcpy.env.workspace = scratchDir
-    for sp in habmapList:
-        __Log("\n-------" + sp + "-------")
+    if engine == "numpy":
+        # Count every species' (zone, season) cells in one pass over the zone raster
         starttime = datetime.now()
         timestamp = starttime.strftime('%Y-%m-%d-%M')
-        __Log("Copying habitat map to temp version")
-        try:
-            __Log("Building raster object")
-            spMap = arcpy.Raster(habDir + sp)
-            # Set processing extent to habitat map to be faster than using zonefile extent
-            if extent == "habMap":
-                arcpy.env.extent = spMap.extent
-            RasterReport(spMap)
-        except Exception as e:
-            __Log("ERROR -- {0}".format(e))
-        try:    
-            __Log("Summing zone and species map")
-            Sum = arcpy.sa.CellStatistics([spMap, zoneFile * 10], "SUM", "DATA")
-        except Exception as e:
-            __Log("ERROR -- {0}".format(e))
+        __Log("Cross tabulating zones and habitat maps, block by block")
         try:
-            __Log("Stats, RAT, and checking summed raster")
-            Sum.save(scratchDir + "tmpSum.tif")            ################################  Can this be ommitted?  It likely slows things down. Can the object have a valid RAT or does it have to be save first?
-            arcpy.management.CalculateStatistics(scratchDir + "tmpSum.tif")
-            arcpy.management.BuildRasterAttributeTable(scratchDir + "tmpSum.tif", 
-                                                        overwrite=True)
-            RasterReport(arcpy.Raster(scratchDir + "tmpSum.tif"))
+            zoneValues, counts, runtimes = _CrossTab(zoneFile, zoneField, habmapList, 
+                                                     habDir, extent, blockSize, 
+                                                     zoneCache, zoneKey, zoneCacheSize,
+                                                     __Log, readers, snap)
         except Exception as e:
-            __Log("ERROR -- {0}".format(e))
-        
-        ############################################## Fill out dataframes with results
-        ###############################################################################
-        # Make empty dataframe for species results, first build a list of index values    
-        df2indexList = []
-        for i in zoneValues:
-            df2indexList = df2indexList + [i*10 + k for k in ValueMap.keys()]
-        df2 = pd.DataFrame(index=df2indexList, columns=["COUNT"]).fillna(value=0)
-        try:
-            __Log("Reading summed raster's table, writing in a dataframe") 
-            __Log("\tValue:Count")
-            rows = arcpy.SearchCursor(Sum)
-            for r in rows:
-                # Make sure no unexpected values showed up
-                if r.getValue("VALUE") not in df2.index:
-                    __Log("ERROR!!!")
-                __Log("\t{0}:{1}".format(r.getValue("VALUE"), 
-                      int(r.getValue("COUNT"))))
-                df2.loc[r.getValue("VALUE"), "COUNT"] = r.getValue("COUNT")
-            del rows
-            del r
-        except Exception as e:
-            __Log("!!!!!!ERROR!!!!!!!!! -- {0}".format(e))
-            # Not doing anything will leave values set to zero in df2
+            # The run stops here, so close the log with what it did
+            __Log("ERROR in numpy overlay -- {0}".format(e))
+            __Log.Close(engine=engine, species=len(habmapList))
+            raise
+    elif zoneKey is not None and zoneEntry is not None:
+        zoneValues = cache.LoadJSON(zoneEntry, "zone")["zoneValues"]
+    else:
+        zoneCursor = arcpy.SearchCursor(zoneFile)
+        zoneValues = []
+        for z in zoneCursor:
+            zoneValues.append(z.getValue(zoneField))
+        if zoneKey is not None:
+            newEntry = cache.NewEntry(zoneCache, zoneKey)
+            cache.SaveJSON(newEntry, "zone", {"zoneValues": zoneValues, 
+                                              "checked": timestamp})
+            cache.Commit(zoneCache, zoneKey, newEntry, int(zoneCacheSize*1024**3))
     
-        # Do some table manipulation to prep for the next step
-        try:
-            # if else statement below should account for zones with zeros.
-            df2["Season"] = [ValueMap[int(str(x)[-1:])] 
-                            if len(str(x))>1 
-                            else ValueMap[int(str(x))] 
-                            for x in df2.index]
-            df2["Zone"] = [int(str(l)[:-1]) 
-                            if len(str(l))>1 
-                            else 0 
-                            for l in df2.index]
-            df2.set_index(["Zone", "Season"], drop=True, inplace=True)
-            # Fill out the species' entries in main DataFrame using the one just created
-            # First you need a list of index values to loop on, since Dataframe is multiindexed
-            df2Index = []
-            for a in list(df2.index.levels[0]):
-                for b in list(df2.index.levels[1]):
-                    df2Index.append((a,b))
-            # Fill out df1 with values from df2
-            for x in df2Index:
-                df1.loc[(sp, x[0]), x[1]] = int(df2.loc[(x[0], x[1])])
+    ################################################################# Some housekeeping
+    ###################################################################################
+    ### Collect the counts in an array indexed by [species, zone, value]
+    if engine == "numpy":
+        dates = [str(timestamp)]*len(habmapList)
+        runtimes = [str(r) for r in runtimes]
+        succeeded = set(habmapList)
+        for sp, runtime in zip(habmapList, runtimes):
+            __Log("{0} processing time: {1}".format(sp, runtime))
+    else:
+        counts = np.zeros((len(habmapList), len(zoneValues), len(ValueMap)), 
+                          dtype=np.int64)
+        zonePos = dict([(z, j) for j, z in enumerate(zoneValues)])
+        dates = [0]*len(habmapList)
+        runtimes = [0]*len(habmapList)
+        succeeded = set()
         
-            # Get end time and time it took to run the species
-            endtime = datetime.now()
-            delta = endtime - starttime
-            __Log("Processing time: " + str(delta))
+    ################################ Loop through rasters, sum species and zone rasters
+    ###################################################################################
+    if engine == "arcpy":
+        arcpy.env.scratchworkspace = scratchDir
+        arcpy.env.workspace = scratchDir
+        for spIdx, sp in enumerate(habmapList):
+            __Log("\n-------" + sp + "-------")
+            starttime = datetime.now()
+            timestamp = starttime.strftime('%Y-%m-%d-%M')
+            __Log("Copying habitat map to temp version")
+            try:
+                __Log("Building raster object")
+                spMap = arcpy.Raster(habDir + sp)
+                # Set processing extent to habitat map to be faster than using zonefile extent
+                if extent == "habMap":
+                    arcpy.env.extent = spMap.extent
+                RasterReport(spMap)
+            except Exception as e:
+                __Log("ERROR -- {0}".format(e))
+            try:    
+                __Log("Summing zone and species map")
+                with __Log.Stage("compute"):
+                    Sum = arcpy.sa.CellStatistics([spMap, zoneFile * 10], "SUM", "DATA")
+            except Exception as e:
+                __Log("ERROR -- {0}".format(e))
+            try:
+                __Log("Stats, RAT, and checking summed raster")
+                with __Log.Stage("write"):
+                    Sum.save(scratchDir + "tmpSum.tif")            ################################  Can this be ommitted?  It likely slows things down. Can the object have a valid RAT or does it have to be save first?
+                with __Log.Stage("RAT build"):
+                    arcpy.management.CalculateStatistics(scratchDir + "tmpSum.tif")
+                    arcpy.management.BuildRasterAttributeTable(scratchDir + "tmpSum.tif", 
+                                                                overwrite=True)
+                RasterReport(arcpy.Raster(scratchDir + "tmpSum.tif"))
+            except Exception as e:
+                __Log("ERROR -- {0}".format(e))
         
-            # Fillout runtime and date fields in the main DataFrame
-            df1.loc[sp, "RunTime"] = str(delta)
-            df1.loc[sp, "Date"] = str(timestamp)
-        except Exception as e:
-            __Log("ERROR -- {0}".format(e))
+            ############################################ Fill out the counts with results
+            ###########################################################################
+            try:
+                __Log("Reading summed raster's table") 
+                __Log("\tValue:Count")
+                rows = arcpy.SearchCursor(Sum)
+                for r in rows:
+                    value, count = int(r.getValue("VALUE")), int(r.getValue("COUNT"))
+                    __Log("\t{0}:{1}".format(value, count))
+                    # Values are zone*10 + season code, or just the code outside zones
+                    zone, code = divmod(value, 10)
+                    # Make sure no unexpected values showed up
+                    if zone not in zonePos or code not in ValueMap:
+                        __Log("ERROR!!!")
+                        if code not in ValueMap:
+                            continue
+                        zonePos[zone] = len(zoneValues)
+                        zoneValues.append(zone)
+                        counts = np.concatenate([counts, np.zeros((len(habmapList), 1, 
+                                                 len(ValueMap)), dtype=np.int64)], axis=1)
+                    counts[spIdx, zonePos[zone], code] = count
+                del rows
+                del r
             
-        # Delete intermediate files
-        try:
-            arcpy.management.Delete(scratchDir + sp)
-            arcpy.management.Delete(scratchDir + "tmpSum.tif")
-        except Exception as e:
-            __Log("ERROR -- {0}".format(e))
+                # Get end time and time it took to run the species
+                endtime = datetime.now()
+                delta = endtime - starttime
+                __Log("Processing time: " + str(delta))
+                __Log.Count("species")
+            
+                # Fillout runtime and date fields
+                runtimes[spIdx] = str(delta)
+                dates[spIdx] = str(timestamp)
+                succeeded.add(sp)
+            except Exception as e:
+                __Log("!!!!!!ERROR!!!!!!!!! -- {0}".format(e))
+                # Not doing anything will leave values set to zero in counts
+                
+            # Delete intermediate files
+            try:
+                arcpy.management.Delete(scratchDir + sp)
+                arcpy.management.Delete(scratchDir + "tmpSum.tif")
+            except Exception as e:
+                __Log("ERROR -- {0}".format(e))
         
     ######################################## Data munging of the multispecies dataframe
     ###################################################################################
     __Log("\nCalculating some fields in multispecies dataframe")
-    df3 = df1.reset_index(level=1)
-    df3["strUC"] = [i[0] + i[1:5].upper() + i[5] for i in df3.index]
-    df3["ZoneTotal"] = df3["NonHabitatPixels"] + df3["SummerPixels"] + df3["WinterPixels"] + df3["AllYearPixels"]
-    df3["SummerPixels"] = df3.SummerPixels + df3.AllYearPixels
-    df3["WinterPixels"] = df3.WinterPixels + df3.AllYearPixels
-    df3["SummerPixelTotal"] = [sum(df3.loc[i]["SummerPixels"]) for i in df3.index]
-    df3["WinterPixelTotal"] = [sum(df3.loc[i]["WinterPixels"]) for i in df3.index]
-    df3["AllYearPixelTotal"] = [sum(df3.loc[i]["AllYearPixels"]) for i in df3.index]
-    df3["PercSummer"] = 100*(df3["SummerPixels"]/df3["SummerPixelTotal"])
-    df3["PercWinter"] = 100*(df3["WinterPixels"]/df3["WinterPixelTotal"])
-    df3["PercYearRound"] = 100*(df3["AllYearPixels"]/df3["AllYearPixelTotal"])
-    df3.fillna(0, inplace=True)
-    
-    # Specify the order of columns for convenience
-    df3 = df3[[u'strUC', u'Zone', u'PercSummer', u'PercWinter', u'PercYearRound', 
-               u'NonHabitatPixels', u'SummerPixels', u'WinterPixels', u'AllYearPixels', 
-               u'ZoneTotal', u'SummerPixelTotal', u'WinterPixelTotal', u'AllYearPixelTotal', 
-               u'Date', u'RunTime']]
-                
-    ############################################ Print the results in the shell and log
-    ###################################################################################
-    df3.set_index([df3.index, "Zone"], inplace=True)
+    with __Log.Stage("compute"):
+        df3 = _OverlayResults(habmapList, zoneValues, counts, dates, runtimes)
     
     ######################################################### Update and save csv files
     ###################################################################################
-    df3FileName = workDir + "/archive/" + zoneName + "_" + \
-                    starttime.strftime('%Y-%m-%d-%H-%M') + ".csv"
-    __Log("Saving new species table to " + df3FileName)
-    print(df3)
-    df3.to_csv(df3FileName)#, index_col=["GeoTiff", "Zone"])
-    
-    # Load the master result table
-    masterFileName = workDir + "/Percent_in_" + zoneName + "_Master.csv"
-    if os.path.exists(masterFileName):
-        dfMas = pd.read_csv(masterFileName, index_col=["GeoTiff", "Zone"])
-        __Log("Loaded " + masterFileName)
+    updateStart = datetime.now()
+    if store == "parts":
+        # Append only the new rows; the parts are the master table and its history
+        print(df3)
+        if not os.path.exists(masterFileName):
+            os.makedirs(masterFileName)
+        partFileName = masterFileName + "/part_" + \
+                       datetime.now().strftime('%Y-%m-%d-%H-%M-%S-%f') + ".csv"
+        __Log("Saving new species table to " + partFileName)
+        df3.to_csv(partFileName)
+        dfMas = _LoadMaster(masterFileName)
     else:
-        dfMas = df3
-    
-    # Save an archive copy of master table/dataframe
-    dfMas.to_csv(workDir + "/archive/" + zoneName + "_Master_" + \
-                starttime.strftime('%Y-%m-%d-%H-%M') + ".csv", )
-    __Log("Creating " + workDir + "/archive/" + zoneName + "_Master_" + \
-            starttime.strftime('%Y-%m-%d-%H-%M') + ".csv")
-    
-    __Log("Updating master table with new calculations")
-    dfMas.update(df3)
+        df3FileName = archive + "/" + zoneName + "_" + \
+                        starttime.strftime('%Y-%m-%d-%H-%M') + ".csv"
+        __Log("Saving new species table to " + df3FileName)
+        print(df3)
+        df3.to_csv(df3FileName)#, index_col=["GeoTiff", "Zone"])
+        
+        # Load the master result table
+        if os.path.exists(masterFileName):
+            dfMas = pd.read_csv(masterFileName, index_col=["GeoTiff", "Zone"])
+            __Log("Loaded " + masterFileName)
+            changed = len(_ChangedRows(dfMas, df3))
+        else:
+            dfMas = df3
+            changed = len(df3)
+        
+        if changed == 0:
+            # Nothing to archive or rewrite
+            __Log("No rows changed, master table left as it was")
+        else:
+            # Save an archive copy of master table/dataframe
+            dfMas.to_csv(archive + "/" + zoneName + "_Master_" + \
+                        starttime.strftime('%Y-%m-%d-%H-%M') + ".csv", )
+            __Log("Creating " + archive + "/" + zoneName + "_Master_" + \
+                    starttime.strftime('%Y-%m-%d-%H-%M') + ".csv")
+            
+            __Log("Updating master table with new calculations")
+            dfMas.update(df3)
+            
+            __Log("Concating species that haven't been run before, saving")
+            newMod = [x for x in df3.index if x not in dfMas.index]
+            dfNewMod = df3.reindex(newMod)
+            dfNewMas = pd.concat([dfMas, dfNewMod])
+            dfNewMas.to_csv(masterFileName)#, index_col=["GeoTiff", "Zone"])
     
-    __Log("Concating species that haven't been run before, saving")
-    newMod = [x for x in df3.index if x not in dfMas.index]
-    dfNewMod = df3.reindex(newMod)
-    dfNewMas = pd.concat([dfMas, dfNewMod])
-    dfNewMas.to_csv(masterFileName)#, index_col=["GeoTiff", "Zone"])
+    # Record the inputs of the species that were run; species that failed are
+    # left out so the next incremental run tries them again
+    if incremental:
+        for sp in habmapList:
+            if sp in succeeded:
+                manifest["species"][sp] = inputs[sp]
+            else:
+                manifest["species"].pop(sp, None)
+        with open(manifestFile, "w") as f:
+            json.dump(manifest, f, indent=1, sort_keys=True)
+    __Log.AddTime("table update", (datetime.now() - updateStart).total_seconds())
     
     ########################################################################## Clean up
     ###################################################################################   
-    df1 = None
-    df2 = None
+    counts = None
     df3 = None
     
     # Get end time and time it took to run all species
     endtime2 = datetime.now()
     delta2 = endtime2 - starttime0
     __Log("Total processing time: " + str(delta2))
+    __Log.Close(engine=engine, species=len(habmapList))
     
-    return dfMas
\ No newline at end of file
+    return dfMas
+
+
+def _CrossTab(zoneFile, zoneField, habmapList, habDir, extent, blockSize, 
+              zoneCache=None, zoneKey=None, zoneCacheSize=20, metrics=None,
+              readers=2, snap=None):
+    '''
+    Counts the cells of each (zone, habitat map value) pair for every habitat map,
+        reading each block of the zone raster once.  Returns the zone values, an 
+        array of counts indexed by [species, zone, value], and a list of the time 
+        spent on each species.  Cells that are habitat but not in a zone are counted
+        in zone 0, which is added to the zone values if there are any, as 
+        CellStatistics does for the arcpy engine.  With a zoneCache, the zone index
+        of each block is read from, or saved to, the cache entry for zoneKey.  The
+        habitat maps' blocks are read ahead by readers threads.  Habitat map 
+        values other than 0-3 are not counted, and are reported in metrics' log if
+        it's a RunLog.  Stage times and counts are added to metrics, if given.  
+        Sparse habitat maps are counted with the counter pixels they imply, at the
+        snap (CONUS extent) raster's counter pixels, so that they give the same 
+        counts as the expanded maps.
+    '''
+    import datetime, numpy as np, rasterio
+    from gapanalysis import blocks, cache, runlog
+    metrics = metrics or runlog.Metrics()
+    entry, newEntry = None, None
+    if zoneCache is not None:
+        entry = cache.Entry(zoneCache, zoneKey)
+        if entry is None:
+            newEntry = cache.NewEntry(zoneCache, zoneKey)
+    try:
+        if entry is not None:
+            zoneValues = cache.LoadJSON(entry, "zone")["zoneValues"]
+        else:
+            vat = blocks.ReadVAT(zoneFile)
+            # Map raster values to the zone values of zoneField
+            rasterValues = np.asarray(vat["VALUE"])
+            zoneOfValue = np.asarray(vat[zoneField])
+            zoneValues = sorted(set(zoneOfValue.tolist()))
+            order = np.argsort(rasterValues)
+            rasterValues = rasterValues[order]
+            valueIndex = np.searchsorted(zoneValues, zoneOfValue[order])
+        nZones = len(zoneValues)
+        indexType = np.uint16 if nZones < 65535 else np.uint32
+        counts = np.zeros((len(habmapList), nZones + 1, 4), dtype=np.int64)
+        runtimes = [datetime.timedelta(0)]*len(habmapList)
+        dropped = np.zeros((len(habmapList), nZones + 1), dtype=np.int64)
+        with rasterio.open(zoneFile) as zsrc:
+            grid = blocks.RasterGrid(zoneFile)._replace(counter=None)
+            if snap is not None:
+                conus = blocks.CONUSGrid(snap)[0]
+                if conus.counter is not None:
+                    origin = blocks.RasterWindow(snap, grid)
+                    grid = grid._replace(counter=(origin[0] + conus.counter[0],
+                                                  origin[1] + conus.counter[1]) + 
+                                                 tuple(conus.counter[2:]))
+            zoneTotals = np.zeros(nZones + 1, dtype=np.int64)
+            paths = [habDir + sp for sp in habmapList]
+            extents, implied = [], []
+            for p in paths:
+                with rasterio.open(p) as src:
+                    extents.append(blocks.SourceWindow(src, grid))
+                    implied.append(grid.counter is not None and 
+                                   blocks.ImpliedCounter(src) > 0)
+            for window in blocks.BlockWindows(grid, blockSize):
+                name = "{0}_{1}".format(window[0], window[1])
+                if entry is not None:
+                    with metrics.Stage("zone cache"):
+                        zoneIdx = cache.LoadArray(entry, name)
+                    if zoneIdx is None:
+                        zoneIdx = np.zeros(window[2:], dtype=indexType)
+                else:
+                    with metrics.Stage("read"):
+                        zone = blocks.ReadWindow(zsrc, grid, window, fill=0)
+                    metrics.Count("bytes read", zone.nbytes)
+                    with metrics.Stage("compute"):
+                        # Zone index + 1 for each cell; 0 is outside of the zones
+                        pos = np.searchsorted(rasterValues, zone)
+                        pos[pos == len(rasterValues)] = 0
+                        zoneIdx = np.where(rasterValues[pos] == zone, 
+                                           valueIndex[pos] + 1, 0)
+                        zoneIdx = zoneIdx.astype(indexType)
+                    if newEntry is not None and zoneIdx.any():
+                        with metrics.Stage("zone cache"):
+                            cache.SaveArray(newEntry, name, zoneIdx)
+                zoneTotals += np.bincount(zoneIdx.ravel(), minlength=nZones + 1)
+                metrics.Count("cells", zoneIdx.size)
+                # The implied counter pixels of sparse maps are read as a part of 
+                # their own, and left out of the range's part
+                counter = blocks.Intersect(window, grid.counter) \
+                          if grid.counter is not None else None
+                parts = []
+                for i in range(len(paths)):
+                    part = blocks.Intersect(window, extents[i])
+                    if part is not None:
+                        parts.append((i, part, implied[i] and counter is not None))
+                    if implied[i] and counter is not None:
+                        parts.append((i, counter, False))
+                # Nodata is read as 255 so it can be told apart from 0
+                habs = blocks.PrefetchWindows([(paths[i], part) 
+                                               for i, part, skip in parts], 
+                                              grid, fill=255, readers=readers)
+                for i, part, skipCounter in parts:
+                    start = datetime.datetime.now()
+                    with metrics.Stage("read"):
+                        hab = next(habs)
+                    metrics.Count("bytes read", hab.nbytes)
+                    metrics.Count("habitat cells", hab.size)
+                    with metrics.Stage("compute"):
+                        hab = hab.astype(np.int64)
+                        z = zoneIdx[part[0] - window[0]:part[0] - window[0] + part[2],
+                                    part[1] - window[1]:part[1] - window[1] + part[3]]
+                        z = z.astype(np.int64)
+                        # Cells that are nodata in both rasters are nodata in the sum,
+                        # and values other than 0-3 are dropped, as the arcpy engine
+                        # drops unexpected values from the summed raster's table
+                        nodata = hab == 255
+                        bad = (hab > 3) & ~nodata
+                        keep = ~((nodata & (z == 0)) | bad)
+                        overlap = blocks.Intersect(part, counter) if skipCounter \
+                                  else None
+                        if overlap is not None:
+                            keep[overlap[0] - part[0]:overlap[0] - part[0] + overlap[2],
+                                 overlap[1] - part[1]:overlap[1] - part[1] + overlap[3]
+                                 ] = False
+                        hab[nodata | bad] = 0
+                        nBad = np.count_nonzero(bad)
+                        if nBad:
+                            dropped[i] += np.bincount(z[bad], minlength=nZones + 1)
+                            metrics.Count("unexpected cells", nBad)
+                        counts[i] += np.bincount((z*4 + hab)[keep], 
+                                                 minlength=(nZones + 1)*4
+                                                 ).reshape(-1, 4)
+                    runtimes[i] += datetime.datetime.now() - start
+        if isinstance(metrics, runlog.RunLog):
+            for sp, n in zip(habmapList, dropped.sum(axis=1)):
+                if n:
+                    metrics("ERROR!!! {0} has {1} cells with values other than 0-3, "
+                            "which were not counted".format(sp, n))
+        if newEntry is not None:
+            checked = datetime.datetime.now().strftime('%Y-%m-%d')
+            cache.SaveJSON(newEntry, "zone", {"zoneValues": zoneValues, 
+                                              "checked": checked})
+            cache.Commit(zoneCache, zoneKey, newEntry, int(zoneCacheSize*1024**3))
+    except:
+        # Don't leave the unfinished entry behind
+        if newEntry is not None:
+            cache.Discard(newEntry)
+        raise
+    if extent != "habMap":
+        # Zone cells outside of a map's extent are non-habitat
+        counts[:, 1:, 0] = zoneTotals[1:] - counts[:, 1:, 1:].sum(axis=2) - \
+                           dropped[:, 1:]
+    # Move zone 0 to the end, and drop it if it's empty
+    counts = np.concatenate([counts[:, 1:], counts[:, :1]], axis=1)
+    if counts[:, -1].any():
+        zoneValues.append(0)
+    else:
+        counts = counts[:, :-1]
+    return zoneValues, counts, runtimes
+
+
+
+def _Checksum(path, known):
+    '''
+    Returns the SHA-1 checksum of a file's contents.  known is a dictionary of
+        previous checksums keyed by path, with the file's modification time and size;
+        the checksum is only recalculated if those have changed, and known is updated.
+    '''
+    import os, hashlib
+    stat = os.stat(path)
+    old = known.get(path)
+    if old is not None and old["mtime"] == stat.st_mtime and old["size"] == stat.st_size:
+        return old["sha1"]
+    sha1 = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024*1024), b""):
+            sha1.update(chunk)
+    known[path] = {"mtime": stat.st_mtime, "size": stat.st_size, 
+                   "sha1": sha1.hexdigest()}
+    return known[path]["sha1"]
+
+
+def _ChangedRows(master, new):
+    '''
+    Returns the rows of a table of new results that aren't in the master table, or
+        whose cell counts differ from the master table's.
+    '''
+    columns = ["NonHabitatPixels", "SummerPixels", "WinterPixels", "AllYearPixels"]
+    same = (master.reindex(new.index)[columns] == new[columns]).all(axis=1)
+    return new[~same.values]
+
+
+def _LoadMaster(masterFileName):
+    '''
+    Loads a PercentOverlay master table, either a csv file or a directory of parts 
+        (store="parts") that are read in order, with later rows replacing earlier ones.
+    '''
+    import os, pandas as pd
+    if not os.path.isdir(masterFileName):
+        return pd.read_csv(masterFileName, index_col=["GeoTiff", "Zone"])
+    parts = sorted([f for f in os.listdir(masterFileName) if f.startswith("part_")])
+    dfMas = pd.concat([pd.read_csv(os.path.join(masterFileName, f), 
+                                   index_col=["GeoTiff", "Zone"]) for f in parts])
+    return dfMas[~dfMas.index.duplicated(keep="last")]
+
+
+
+def _OverlayResults(habmapList, zoneValues, counts, dates, runtimes):
+    '''
+    Builds PercentOverlay's table of results, indexed by GeoTiff and Zone, from an
+        array of counts indexed by [species, zone, value] and lists of each species'
+        date and runtime.  Species are sorted.  Summer and winter pixels include
+        year-round pixels, and percents are of each species' total.
+    '''
+    import numpy as np, pandas as pd
+    order = sorted(range(len(habmapList)), key=lambda i: habmapList[i])
+    flat = counts[order].reshape(-1, 4)
+    index = pd.MultiIndex.from_product([[habmapList[i] for i in order], zoneValues],
+                                       names=["GeoTiff", "Zone"])
+    species = index.get_level_values(0)
+    df3 = pd.DataFrame({"NonHabitatPixels": flat[:, 0],
+                        "SummerPixels": flat[:, 1] + flat[:, 3],
+                        "WinterPixels": flat[:, 2] + flat[:, 3],
+                        "AllYearPixels": flat[:, 3],
+                        "ZoneTotal": flat.sum(axis=1)}, index=index)
+    df3["strUC"] = [i[0] + i[1:5].upper() + i[5] for i in species]
+    totals = df3[["SummerPixels", "WinterPixels", "AllYearPixels"]].groupby(
+                level=0).transform("sum")
+    df3["SummerPixelTotal"] = totals["SummerPixels"]
+    df3["WinterPixelTotal"] = totals["WinterPixels"]
+    df3["AllYearPixelTotal"] = totals["AllYearPixels"]
+    with np.errstate(invalid="ignore", divide="ignore"):
+        df3["PercSummer"] = 100*(df3["SummerPixels"]/df3["SummerPixelTotal"])
+        df3["PercWinter"] = 100*(df3["WinterPixels"]/df3["WinterPixelTotal"])
+        df3["PercYearRound"] = 100*(df3["AllYearPixels"]/df3["AllYearPixelTotal"])
+    df3.fillna(0, inplace=True)
+    df3["Date"] = np.repeat([dates[i] for i in order], len(zoneValues))
+    df3["RunTime"] = np.repeat([runtimes[i] for i in order], len(zoneValues))
+    return df3[[u'strUC', u'PercSummer', u'PercWinter', u'PercYearRound', 
+                u'NonHabitatPixels', u'SummerPixels', u'WinterPixels', u'AllYearPixels', 
+                u'ZoneTotal', u'SummerPixelTotal', u'WinterPixelTotal', 
+                u'AllYearPixelTotal', u'Date', u'RunTime']]
@@ -2,13 +2,23 @@
 A collecton of funcions for common tasks related to land cover data.
 '''
           
-def ReclassLandCover(MUlist, reclassTo, keyword, workDir, lcPath, lcVersion):
+def ReclassLandCover(MUlist, reclassTo, keyword, workDir, lcPath, lcVersion,
+                     engine="arcpy", jobs=None, blockSize=4096):
     '''
-    (list, string, string, string, string, string, string) -> raster object, saved map.
+    (list, string, string, string, string, string, string, [string], [list], 
+        [integer]) -> string, saved map.
     
     Builds a national map of select systems from the GAP Landcover used in species
         modeling. Takes several minutes to run.
         
+    The numpy engine reclassifies the land cover block by block with a lookup table 
+        of map unit codes and writes the result once, with its RAT (.vat.dbf) and 
+        statistics (.aux.xml) from the same pass.  It can make several reclass maps
+        from one read of the land cover (see jobs).
+        
+    Returns the path to the saved map (workDir + keyword + ".tif") with either 
+        engine; wrap it in arcpy.Raster() for a raster object.
+        
     Arguments:
     MUlist -- A list of land cover map unit codes that you want to reclass.
     reclassTo -- Value to reclass the MUs in MUlist to.
@@ -17,36 +27,51 @@ def ReclassLandCover(MUlist, reclassTo, keyword, workDir, lcPath, lcVersion):
     lcPath -- Path to the national extent land cover mosaic suitable for overlay analyses
         with the models.
     lcVersion -- The version of GAP Land Cover to be reclassified.
+    engine -- "arcpy" (the default) reclassifies with arcpy.sa.Reclassify.  "numpy"
+        uses a lookup table with rasterio and doesn't need arcpy.  The land cover must
+        be an 8 or 16 bit integer raster.
+    jobs -- A list of more (MUlist, reclassTo, keyword) tuples to make from the same
+        read of the land cover with the numpy engine.  Each is saved as workDir + 
+        keyword + ".tif".
+    blockSize -- Height and width, in cells, of the blocks read by the numpy engine.
+    
+    Example:
+    >>> ReclassLandCover([4101, 4102], 1, "Forest", "C:/temp/lc/", 
+                         "C:/data/gaplc.tif", "1.0", engine="numpy",
+                         jobs=[([7101, 7102], 1, "Grass")])
+    'C:/temp/lc/Forest.tif'
     '''
     #################################################### Things to import and check out
     ###################################################################################    
-    import arcpy, datetime, os
-    arcpy.CheckOutExtension("Spatial")
-    arcpy.env.overwriteOutput=True
+    import datetime, os
+    from gapanalysis import runlog
+    if engine == "arcpy":
+        import arcpy
+        arcpy.CheckOutExtension("Spatial")
+        arcpy.env.overwriteOutput=True
     
-    ########################################################## Some environment settings
-    ####################################################################################  
-    arcpy.env.pyramid = "PYRAMIDS" 
-    arcpy.env.rasterStatistics = "STATISTICS"
-    arcpy.env.overwriteOutput = True
+        ###################################################### Some environment settings
+        ################################################################################  
+        arcpy.env.pyramid = "PYRAMIDS" 
+        arcpy.env.rasterStatistics = "STATISTICS"
+        arcpy.env.overwriteOutput = True
+        arcpy.env.workspace = workDir
+    elif engine != "numpy":
+        raise ValueError('engine must be "arcpy" or "numpy"')
     starttime = datetime.datetime.now()
-    arcpy.env.workspace = workDir
     
     ################################################# Create directories for the output
     ###################################################################################
     if not os.path.exists(workDir):
         os.makedirs(workDir)
             
-    ############################################# Function to write data to the log file
+    ################################################### Log file and metrics for the run
     ####################################################################################
     log = workDir + "/{0}_log.txt".format(keyword)
     if not os.path.exists(log):
         logObj = open(log, "wb")
         logObj.close()
-    def __Log(content):
-        print content
-        with open(log, 'a') as logDoc:
-            logDoc.write(content + '\n')    
+    __Log = runlog.RunLog(log, "ReclassLandCover")
     
     ########################################################### Write header to log file
     ####################################################################################
@@ -58,6 +83,28 @@ def ReclassLandCover(MUlist, reclassTo, keyword, workDir, lcPath, lcVersion):
     __Log('\nProcessing {0} systems as "{1}".\n'.format(len(MUlist), keyword).upper())
     __Log('The ecological systems used for this reclassification were:')
     __Log(str(MUlist) + '\n')
+    
+    ######################################## Or reclass the lc map with the numpy engine
+    ####################################################################################
+    if engine == "numpy":
+        outputs = []
+        for MUs, value, name in [(MUlist, reclassTo, keyword)] + list(jobs or []):
+            if name != keyword:
+                __Log('Also processing {0} systems as "{1}":'.format(len(MUs), 
+                                                                     name).upper())
+                __Log(str(MUs) + '\n')
+            dtype, nodata = _ReclassType([value])
+            outputs.append((workDir + name + ".tif", 
+                            dict([(int(mu), int(value)) for mu in MUs]), nodata, 
+                            dtype, nodata, {}))
+        __Log("\tReclassifying {0}".format(lcPath))
+        try:
+            _ReclassPass(lcPath, outputs, blockSize, metrics=__Log)
+        finally:
+            endtime = datetime.datetime.now()
+            __Log('\nProcessing time was {0}'.format(endtime - starttime))
+            __Log.Close(engine=engine, outputs=len(outputs))
+        return outputs[0][0]
         
     ################################################################ Make a remap object
     ####################################################################################
@@ -79,7 +126,8 @@ def ReclassLandCover(MUlist, reclassTo, keyword, workDir, lcPath, lcVersion):
     __Log("\tReclassifying {0}".format(lcPath))
     lcObj = arcpy.sa.Raster(lcPath)
     try:
-        lcReclassObj = arcpy.sa.Reclassify(lcObj, "VALUE", remap, "NODATA")
+        with __Log.Stage("compute"):
+            lcReclassObj = arcpy.sa.Reclassify(lcObj, "VALUE", remap, "NODATA")
     except Exception as e:
         __Log("ERROR reclassifying land cover")
     
@@ -87,9 +135,10 @@ def ReclassLandCover(MUlist, reclassTo, keyword, workDir, lcPath, lcVersion):
     ####################################################################################                                   
     try:
         __Log("Attempting to calculate statistics")
-        arcpy.management.CalculateStatistics(lcReclassObj, skip_existing=False)
-        __Log("Building a new RAT")
-        arcpy.management.BuildRasterAttributeTable(lcReclassObj, overwrite=True)
+        with __Log.Stage("RAT build"):
+            arcpy.management.CalculateStatistics(lcReclassObj, skip_existing=False)
+            __Log("Building a new RAT")
+            arcpy.management.BuildRasterAttributeTable(lcReclassObj, overwrite=True)
     except Exception as e:
         __Log("ERROR building RAT, pyramids, or statistics - {0}".format(e))
     
@@ -98,7 +147,8 @@ def ReclassLandCover(MUlist, reclassTo, keyword, workDir, lcPath, lcVersion):
     resultTiff = workDir + keyword + ".tif"
     try:
         print("\tSaving")
-        arcpy.management.CopyRaster(lcReclassObj, resultTiff)
+        with __Log.Stage("write"):
+            arcpy.management.CopyRaster(lcReclassObj, resultTiff)
     except Exception as e:
         __Log("ERROR saving reclassed land cover")
         
@@ -107,9 +157,218 @@ def ReclassLandCover(MUlist, reclassTo, keyword, workDir, lcPath, lcVersion):
     endtime = datetime.datetime.now()
     runtime = endtime - starttime
     __Log('\nProcessing time was {0}'.format(runtime))
+    __Log.Close(engine=engine, outputs=1)
         
-    ##################################### Return raster object of reclassed national map
+    ############################################## Return path of reclassed national map
     ####################################################################################  
-    reclassed = arcpy.Raster(workDir + keyword + ".tif")
-    return reclassed
-                                
\ No newline at end of file
+    return resultTiff
+                                
+
+
+def BatchReclass(groups, workDir, lcPath, lcVersion, packed=None, workers=1,
+                 blockSize=4096):
+    '''
+    (dictionary, string, string, string, [string], [integer], [integer]) -> 
+        dictionary or string
+    
+    Makes a binary map (1 for the map units of a grouping, 0 for other land cover, 
+        and nodata where the land cover is nodata) of each of many groupings of map 
+        units from a single read of the national land cover mosaic, without arcpy.
+        I/O grows with the size of the land cover, not the number of groupings.  
+        Each map gets a RAT (.vat.dbf) and statistics (.aux.xml).
+        
+    The maps can be saved as separate GeoTIFFs named for their keywords, or packed 
+        into the bits of one GeoTIFF: bit k (value 2**k) is set in cells of the kth 
+        keyword in sorted order.  The packed GeoTIFF's "GAP_LAYERS" tag lists the 
+        keywords in bit order and "GAP_LAYER_COUNTS" their numbers of cells, and its 
+        RAT counts the cells of each combination of groupings.
+        
+    Arguments:
+    groups -- A dictionary of keyword -> list of land cover map unit codes.
+    workDir -- Where to save output and log files.
+    lcPath -- Path to the national extent land cover mosaic suitable for overlay 
+        analyses with the models.  It must be an 8 or 16 bit integer raster.
+    lcVersion -- The version of GAP Land Cover to be reclassified.
+    packed -- Name for a single bit-packed GeoTIFF of up to 31 groupings, or None (the
+        default) to save each grouping separately.
+    workers -- Number of threads that reclassify and write the maps' blocks.
+    blockSize -- Height and width, in cells, of the blocks read at a time.
+    
+    Example:
+    >>> BatchReclass({"Forest": [4101, 4102], "Grass": [7101, 7102]}, "C:/temp/lc/",
+                     "C:/data/gaplc.tif", "1.0", workers=4)
+    {'Forest': 'C:/temp/lc/Forest.tif', 'Grass': 'C:/temp/lc/Grass.tif'}
+    '''
+    import datetime, os
+    from gapanalysis import runlog
+    starttime = datetime.datetime.now()
+    if not os.path.exists(workDir):
+        os.makedirs(workDir)
+    keywords = sorted(groups)
+    if packed is not None and len(keywords) > 31:
+        raise ValueError("Only 31 groupings can be packed into one GeoTIFF")
+        
+    ################################################### Log file and metrics for the run
+    ####################################################################################
+    log = workDir + "/{0}_log.txt".format(packed or "batch")
+    __Log = runlog.RunLog(log, "BatchReclass")
+    
+    ########################################################### Write header to log file
+    ####################################################################################
+    __Log("#"*67)
+    __Log("The statements from processing")
+    __Log("#"*67)    
+    __Log(starttime.strftime("%c"))
+    __Log('\nThis reclassification is based on GAP Land Cover version {0}.\n'.format(lcVersion))
+    for keyword in keywords:
+        __Log('Processing {0} systems as "{1}":'.format(len(groups[keyword]), 
+                                                        keyword).upper())
+        __Log(str(groups[keyword]) + '\n')
+    
+    ################################################################ Reclass the lc map
+    ####################################################################################
+    outputs = []
+    if packed is None:
+        for keyword in keywords:
+            outputs.append((workDir + keyword + ".tif", 
+                            dict([(int(mu), 1) for mu in groups[keyword]]), 0, 
+                            "uint8", 255, {}))
+    else:
+        bits = {}
+        for k, keyword in enumerate(keywords):
+            for mu in groups[keyword]:
+                bits[int(mu)] = bits.get(int(mu), 0) | 2**k
+        # All bits set is never a combination of groupings, so it can be nodata
+        dtype = [t for t, n in (("uint8", 7), ("uint16", 15), ("uint32", 31)) 
+                 if len(keywords) <= n][0]
+        nodata = 2**int(dtype[4:]) - 1
+        outputs.append((workDir + packed + ".tif", bits, 0, dtype, nodata,
+                        {"GAP_LAYERS": ",".join(keywords)}))
+    __Log("\tReclassifying {0}".format(lcPath))
+    try:
+        results = _ReclassPass(lcPath, outputs, blockSize, workers, __Log)
+    
+        ####################################################### Write closer to log file
+        ################################################################################
+        if packed is None:
+            paths = dict(zip(keywords, [o[0] for o in outputs]))
+        else:
+            import rasterio
+            values, counts = results[0]
+            layerCounts = [int(counts[(values & 2**k) > 0].sum()) 
+                           for k in range(len(keywords))]
+            with rasterio.open(outputs[0][0], "r+") as dst:
+                dst.update_tags(GAP_LAYER_COUNTS=",".join([str(c) 
+                                                           for c in layerCounts]))
+            # Keep the statistics newer than the raster so they're still used
+            if os.path.exists(outputs[0][0] + ".aux.xml"):
+                os.utime(outputs[0][0] + ".aux.xml", None)
+            for keyword, count in zip(keywords, layerCounts):
+                __Log("\t{0}: {1} cells".format(keyword, count))
+            paths = outputs[0][0]
+    finally:
+        endtime = datetime.datetime.now()
+        __Log('\nProcessing time was {0}'.format(endtime - starttime))
+        __Log.Close(outputs=len(keywords))
+    return paths
+
+
+def _ReclassType(values):
+    '''
+    Returns the smallest unsigned (or 32 bit) integer type for reclass values and a
+        nodata value that doesn't conflict with them.
+    '''
+    values = [int(v) for v in values]
+    for dtype, nodata in (("uint8", 255), ("uint16", 65535)):
+        if min(values) >= 0 and max(values) < nodata:
+            return dtype, nodata
+    return "int32", -2147483648
+
+
+def _ReclassPass(lcPath, outputs, blockSize, workers=1, metrics=None):
+    '''
+    Reads the land cover once, in blocks, and writes any number of reclassified 
+        rasters, each with a RAT and statistics from the same pass.  Each output is a
+        tuple of (raster path, dictionary of map unit code -> value, value for other
+        codes, numpy data type, nodata value, dictionary of GeoTIFF tags).  Land 
+        cover nodata cells are nodata in every output.  With more than 1 worker, the
+        outputs' blocks are reclassified and written in that many threads.  Returns a
+        list of (values, counts) histograms of the outputs.  Stage times and counts
+        are added to metrics, if given.
+    '''
+    import numpy as np, rasterio
+    from multiprocessing.pool import ThreadPool
+    from gapanalysis import blocks, misc, runlog
+    metrics = metrics or runlog.Metrics()
+    grid = blocks.RasterGrid(lcPath)._replace(counter=None)
+    with rasterio.open(lcPath) as src:
+        kind = np.dtype(src.dtypes[0])
+        if kind.kind not in "iu" or kind.itemsize > 2:
+            raise ValueError("{0} is not an 8 or 16 bit integer raster".format(lcPath))
+        # Lookup tables indexed by land cover value - offset
+        offset = int(np.iinfo(kind).min)
+        size = 2**(8*kind.itemsize)
+        luts = []
+        for raster, mapping, default, dtype, nodata, tags in outputs:
+            lut = np.empty(size, dtype=dtype)
+            lut.fill(default)
+            codes = np.array(sorted(mapping), dtype=np.int64)
+            if len(codes):
+                lut[codes - offset] = [mapping[c] for c in codes]
+            if src.nodata is not None:
+                lut[int(src.nodata) - offset] = nodata
+            luts.append(lut)
+        dsts = []
+        pool = ThreadPool(workers) if workers > 1 else None
+        hist = np.zeros(size, dtype=np.int64)
+        try:
+            for raster, mapping, default, dtype, nodata, tags in outputs:
+                dsts.append(blocks.CreateRaster(raster, grid, dtype, nodata=nodata))
+                if tags:
+                    dsts[-1].update_tags(**tags)
+            for window in blocks.BlockWindows(grid, blockSize):
+                with metrics.Stage("read"):
+                    data = blocks.ReadWindow(src, grid, window, fill=src.nodata or 0)
+                metrics.Count("bytes read", data.nbytes)
+                metrics.Count("cells", data.size)
+                with metrics.Stage("compute"):
+                    index = data.astype(np.int64) - offset if offset else data
+                    hist += np.bincount(index.ravel(), minlength=size)
+                def __Write(k):
+                    out = luts[k][index]
+                    blocks.WriteWindow(dsts[k], grid, window, out)
+                    return out.nbytes
+                # Reclassifying is timed with writing, since they're done together
+                with metrics.Stage("write"):
+                    if pool is None:
+                        written = [__Write(k) for k in range(len(dsts))]
+                    else:
+                        written = pool.map(__Write, range(len(dsts)))
+                metrics.Count("bytes written", sum(written))
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+            for dst in dsts:
+                dst.close()
+    # The outputs' histograms follow from the land cover's
+    results = []
+    used = np.nonzero(hist)[0]
+    for (raster, mapping, default, dtype, nodata, tags), lut in zip(outputs, luts):
+        mapped = lut[used].astype(np.int64)
+        keep = mapped != nodata
+        values, inverse = np.unique(mapped[keep], return_inverse=True)
+        counts = np.bincount(inverse, weights=hist[used][keep], 
+                             minlength=len(values)).astype(np.int64)
+        with metrics.Stage("RAT build"):
+            blocks.WriteVAT(raster, values, counts)
+            if counts.sum() > 0:
+                mean = (values*counts.astype(float)).sum()/counts.sum()
+                std = np.sqrt((counts*np.square(values - mean)).sum()/counts.sum())
+                misc._WriteAuxStats(raster + ".aux.xml", 
+                                    {"count": int(counts.sum()), "mean": float(mean),
+                                     "standard_deviation": float(std), 
+                                     "range": (int(values[0]), int(values[-1])),
+                                     "integer": True, "histogram": (values, counts)})
+        results.append((values, counts))
+    return results
@@ -1,3 +1,111 @@
+# Tables read by ReadRAT, as raster -> (source, stamp, table, last use)
+_RATCache = {}
+_RATCacheSize = 32
+
+
+def ReadRAT(raster):
+    '''
+    (string) -> dictionary
+    
+    Returns a raster's attribute table (RAT) as a dictionary of numpy arrays keyed by
+        upper case field name, sorted by "VALUE".  The table is read in bulk from the 
+        raster's dBASE sidecar (raster + ".vat.dbf") or the RAT in GDAL's sidecar 
+        (raster + ".aux.xml"), and with arcpy only if there is neither, such as for 
+        rasters in a geodatabase.  The most recently read tables are kept in memory
+        until the file they came from is modified, so the arrays are read only.
+        
+    Arguments:
+    raster -- path to a raster with a valid attribute table.
+    
+    Example:
+    >>> RAT = ReadRAT("C:/Data/conus_ext_cnt.tif")
+    >>> RAT["VALUE"], RAT["COUNT"]
+    (array([0, 1]), array([2092590393, 9]))
+    '''
+    import os
+    for source in (raster + ".vat.dbf", raster + ".aux.xml", None):
+        if source is None or os.path.exists(source):
+            break
+    if source is not None:
+        stat = os.stat(source)
+        stamp = (stat.st_mtime, stat.st_size)
+    else:
+        stamp = None
+    import time
+    hit = _RATCache.get(raster)
+    if hit is not None and hit[:2] == (source, stamp):
+        _RATCache[raster] = hit[:3] + (time.time(),)
+        return dict(hit[2])
+    if source is None:
+        table = _ArcpyRAT(raster)
+    elif source.endswith(".dbf"):
+        from gapanalysis import blocks
+        table = blocks.ReadVAT(raster)
+    else:
+        table = _AuxRAT(source)
+    if table is None:
+        table = _ArcpyRAT(raster)
+        stamp = None
+    table = dict([(str(name).upper(), column) for name, column in table.items()])
+    order = table["VALUE"].argsort(kind="mergesort")
+    for name in table:
+        table[name] = table[name][order]
+        table[name].flags.writeable = False
+    if stamp is not None:
+        _RATCache[raster] = (source, stamp, table, time.time())
+        # Forget the least recently used tables.  Dictionary operations are atomic, 
+        # so threads can share the cache.
+        for old in sorted(_RATCache.items(), key=lambda i: i[1][3])[:-_RATCacheSize]:
+            _RATCache.pop(old[0], None)
+    return dict(table)
+
+
+def _AuxRAT(auxFile):
+    '''
+    Reads the first band's RAT from a GDAL .aux.xml file, or returns None if there 
+        isn't one.  GDAL's value and pixel count fields are named "VALUE" and 
+        "COUNT", like ArcGIS's, whatever they're called in the file.
+    '''
+    import numpy as np
+    import xml.etree.ElementTree as ET
+    RAT = ET.parse(auxFile).getroot().find("PAMRasterBand/GDALRasterAttributeTable")
+    if RAT is None:
+        return None
+    names, types = [], []
+    for field in RAT.findall("FieldDefn"):
+        name, usage = field.findtext("Name"), field.findtext("Usage")
+        # Usage 5 is the value of a class (min = max), 1 is the pixel count
+        if usage == "5":
+            name = "VALUE"
+        elif usage == "1":
+            name = "COUNT"
+        names.append(name.upper())
+        types.append(field.findtext("Type"))
+    if "VALUE" not in names or "COUNT" not in names:
+        return None
+    cells = [f.text or "" for f in RAT.iter("F")]
+    cells = np.array(cells, dtype=object).reshape(-1, len(names))
+    table = {}
+    for j, (name, kind) in enumerate(zip(names, types)):
+        if kind == "0":
+            table[name] = cells[:, j].astype(np.int64)
+        elif kind == "1":
+            table[name] = cells[:, j].astype(float)
+        else:
+            table[name] = cells[:, j].astype(str)
+    return table
+
+
+def _ArcpyRAT(raster):
+    '''
+    Reads a raster's VALUE and COUNT fields with a single arcpy cursor.
+    '''
+    import arcpy, numpy as np
+    rows = [row for row in arcpy.da.SearchCursor(raster, ["VALUE", "COUNT"])]
+    return {"VALUE": np.array([r[0] for r in rows]), 
+            "COUNT": np.array([r[1] for r in rows], dtype=np.int64)}
+
+
 
 def RATtoDataFrame(raster):
     '''
@@ -12,15 +120,10 @@ def RATtoDataFrame(raster):
     Example:
     >>>RATDataFrame = RATtoDataFrame("C:/Data/araster.tif")
     '''
-    import arcpy, pandas as pd
-    raster = arcpy.Raster(raster)
-    RAT = pd.DataFrame()
-    rows = arcpy.SearchCursor(raster)
-    for row in rows:
-        value = row.getValue("VALUE")
-        countt= row.getValue("COUNT")
-        RAT.loc[value, "cell_count"] = countt
-    RAT.index.name = "value"
+    import pandas as pd
+    table = ReadRAT(raster)
+    RAT = pd.DataFrame({"cell_count": table["COUNT"].astype(float)},
+                       index=pd.Index(table["VALUE"], name="value"))
     return RAT
 
 def MakeRemapList(mapUnitCodes, reclassValue):
@@ -73,18 +176,12 @@ def PlotRAT(raster, OgiveName, DistributionName, OgiveTitle="", DistributionTitl
                 DistributionName="T:/temp/RATdist.png", dropMax=True, dropZero=True,
                 OgiveTitle="All Species", DistributionTitle="All Species",)
     '''
-    import arcpy, pandas as pd
-    
-    # Create empty dataframe
-    DF0 = pd.DataFrame(index=[], columns=[])
-    DF0.index.name = "value"
+    import pandas as pd
     
-    # Use search cursor to copy RAT to dataframe
-    rows = arcpy.SearchCursor(raster)
-    for row in rows:
-        frequency = row.getValue("COUNT")
-        value = row.getValue("VALUE")
-        DF0.loc[value, "freq"] = frequency
+    # Copy RAT to dataframe
+    table = ReadRAT(raster)
+    DF0 = pd.DataFrame({"freq": table["COUNT"].astype(float)},
+                       index=pd.Index(table["VALUE"], name="value"))
         
     # Drop max value
     if dropMax == True:
@@ -111,20 +208,95 @@ def PlotRAT(raster, OgiveName, DistributionName, OgiveTitle="", DistributionTitl
     fig2.savefig(DistributionName)
 
 
-def RasterStats(raster):
+def RasterStats(raster, engine="arcpy", percentile_list=[], saveStats=False,
+                blockSize=4096, workers=1):
     '''
-    (string) -> dictionary
+    (string or list, [string], [list], [boolean], [integer], [integer]) -> dictionary
+        or list of dictionaries
     
     Creates a dictionary of measures of central tendency for a raster's values.
         Includes mean, range (as a tuple), standard deviation, and coefficient
-        of variation.  Handles integer or floating point rasters.
+        of variation.  Handles integer or floating point rasters.  
+        
+    The numpy engine reads the raster once, block by block, and also returns the 
+        number of cells with data ("count"), the histogram of an integer raster 
+        ("histogram", as a tuple of arrays of values and counts), and exact 
+        percentiles of an integer raster, like RATStats.  The standard deviation is 
+        that of the population, like ArcGIS's.  Statistics saved to the raster's 
+        .aux.xml by an earlier run are reused if the raster hasn't changed since.
     
     Argument:
-    raster -- A path to a raster to summarize.
+    raster -- A path to a raster to summarize, or a list of paths.  A list of 
+        dictionaries is returned for a list.
+    engine -- "arcpy" to use the statistics from GetRasterProperties, or "numpy" to
+        calculate them with rasterio.
+    percentile_list -- A python list of percentiles to include in the dictionary with 
+        the numpy engine.  They're None for floating point rasters.
+    saveStats -- True or False to save the numpy engine's statistics and histogram in
+        the raster's .aux.xml, where ArcGIS and GDAL will find them too.
+    blockSize -- Height and width, in cells, of the blocks read by the numpy engine.
+    workers -- Number of rasters the numpy engine summarizes at once, each in its own
+        process.  On Windows, call RasterStats from under 
+        "if __name__ == '__main__':" when using more than 1 worker.
         
     Example:
     >>> aDict = RasterStats(raster="T:/temp/a_richness_map.tif")
+    >>> dicts = RasterStats(["T:/temp/a.tif", "T:/temp/b.tif"], engine="numpy",
+                            percentile_list=[25, 50, 75], saveStats=True, workers=2)
     '''
+    if engine not in ("arcpy", "numpy"):
+        raise ValueError('engine must be "arcpy" or "numpy"')
+    if type(raster) in (list, tuple):
+        jobs = [(r, engine, percentile_list, saveStats, blockSize) for r in raster]
+        if engine == "numpy" and workers > 1:
+            import multiprocessing
+            pool = multiprocessing.Pool(workers)
+            try:
+                return pool.map(_RasterStats, jobs)
+            finally:
+                pool.close()
+                pool.join()
+        return [_RasterStats(job) for job in jobs]
+    return _RasterStats((raster, engine, percentile_list, saveStats, blockSize))
+
+
+def _RasterStats(args):
+    '''
+    Summarizes one raster for RasterStats.
+    '''
+    raster, engine, percentile_list, saveStats, blockSize = args
+    if engine == "numpy":
+        import os
+        stats = None
+        auxFile = raster + ".aux.xml"
+        if os.path.exists(auxFile) and \
+           os.path.getmtime(auxFile) >= os.path.getmtime(raster):
+            stats = _ReadAuxStats(auxFile)
+            if stats is not None and stats["integer"] and \
+               stats["histogram"] is None and percentile_list:
+                # The histogram was too wide to save
+                stats = None
+        if stats is None:
+            stats = _StreamStats(raster, blockSize)
+            if saveStats:
+                _WriteAuxStats(auxFile, stats)
+        resultsDict = {"mean": stats["mean"], 
+                       "standard_deviation": stats["standard_deviation"],
+                       "range": stats["range"], "count": stats["count"],
+                       "histogram": stats["histogram"]}
+        if stats["mean"] != 0:
+            resultsDict["coefficient_of_variation"] = 100*(stats["standard_deviation"]/
+                                                           stats["mean"])
+        else:
+            resultsDict["coefficient_of_variation"] = float("nan")
+        if stats["histogram"] is not None:
+            values, counts = stats["histogram"]
+            resultsDict.update(_HistogramPercentiles(values, counts, percentile_list))
+        else:
+            for percentile in percentile_list:
+                resultsDict[str(percentile) + "th"] = None
+        return resultsDict
+    
     import arcpy
     # Create dictionary for results
     resultsDict = {}
@@ -146,70 +318,290 @@ def RasterStats(raster):
     return resultsDict
 
 
-def RATStats(raster, percentile_list, dropMax=False, dropZero=False):
+def _StreamStats(raster, blockSize):
     '''
-    (string, list, [boolean], [boolean]) -> dictionary
+    Calculates the count, mean, population standard deviation, range, and, for an 
+        integer raster, the histogram of a raster's data cells in one pass.  The 
+        blocks' means and sums of squared deviations are combined with Chan's 
+        parallel form of Welford's algorithm, so large rasters don't lose precision.
+    '''
+    import numpy as np, rasterio
+    from rasterio.windows import Window
+    n, mean, M2 = 0, 0.0, 0.0
+    low, high = None, None
+    hist, offset = None, 0
+    uniques = []
+    with rasterio.open(raster) as src:
+        integer = np.dtype(src.dtypes[0]).kind in "iu"
+        small = integer and np.dtype(src.dtypes[0]).itemsize <= 2
+        if small:
+            offset = int(np.iinfo(np.dtype(src.dtypes[0])).min)
+        for row in range(0, src.height, blockSize):
+            for col in range(0, src.width, blockSize):
+                window = Window(col, row, min(blockSize, src.width - col),
+                                min(blockSize, src.height - row))
+                data = src.read(1, window=window, masked=True).compressed()
+                if data.size == 0:
+                    continue
+                if np.dtype(src.dtypes[0]).kind == "f":
+                    data = data[np.isfinite(data)]
+                    if data.size == 0:
+                        continue
+                nB = data.size
+                meanB = data.mean(dtype=np.float64)
+                M2B = float(np.square(data.astype(np.float64) - meanB).sum())
+                delta = meanB - mean
+                total = n + nB
+                mean += delta*nB/total
+                M2 += M2B + delta**2*n*nB/float(total)
+                n = total
+                low = data.min() if low is None else min(low, data.min())
+                high = data.max() if high is None else max(high, data.max())
+                if small:
+                    hist = _AddCounts(hist, np.bincount(data.astype(np.int64) - offset))
+                elif integer:
+                    uniques.append(np.unique(data, return_counts=True))
+                    if len(uniques) > 64:
+                        uniques = [_MergeUniques(uniques)]
+    if n == 0:
+        return {"count": 0, "mean": float("nan"), "standard_deviation": float("nan"),
+                "range": (float("nan"), float("nan")), "integer": False,
+                "histogram": None}
+    if small:
+        values = np.nonzero(hist)[0]
+        histogram = (values + offset, hist[values])
+    elif integer:
+        histogram = _MergeUniques(uniques)
+    else:
+        histogram = None
+    if integer:
+        _range = int(low), int(high)
+    else:
+        _range = float(low), float(high)
+    return {"count": int(n), "mean": float(mean), 
+            "standard_deviation": float(np.sqrt(M2/n)), "range": _range,
+            "integer": integer, "histogram": histogram}
+
+
+def _AddCounts(hist, counts):
+    '''
+    Adds bincount counts to a histogram, growing it as needed.
+    '''
+    import numpy as np
+    if hist is None:
+        return counts.astype(np.int64)
+    if len(counts) > len(hist):
+        hist, counts = counts.astype(np.int64), hist
+    hist[:len(counts)] += counts
+    return hist
+
+
+def _MergeUniques(uniques):
+    '''
+    Merges a list of (values, counts) tuples into one, sorted by value.
+    '''
+    import numpy as np
+    values = np.concatenate([u[0] for u in uniques])
+    counts = np.concatenate([u[1] for u in uniques]).astype(np.int64)
+    merged, inverse = np.unique(values, return_inverse=True)
+    return merged, np.bincount(inverse, weights=counts).astype(np.int64)
+
+
+def _ReadAuxStats(auxFile):
+    '''
+    Returns the statistics saved in a .aux.xml by _WriteAuxStats, or None if the 
+        file doesn't have them.
+    '''
+    import numpy as np
+    import xml.etree.ElementTree as ET
+    band = ET.parse(auxFile).getroot().find("PAMRasterBand")
+    if band is None:
+        return None
+    mdi = dict([(m.get("key"), m.text) for m in band.findall("Metadata/MDI")])
+    if "STATISTICS_GAP_COUNT" not in mdi:
+        return None
+    stats = {"count": int(mdi["STATISTICS_GAP_COUNT"]), 
+             "mean": float(mdi["STATISTICS_MEAN"]),
+             "standard_deviation": float(mdi["STATISTICS_STDDEV"]),
+             "integer": mdi.get("STATISTICS_GAP_INTEGER") == "1",
+             "histogram": None}
+    if stats["integer"]:
+        stats["range"] = (int(float(mdi["STATISTICS_MINIMUM"])), 
+                          int(float(mdi["STATISTICS_MAXIMUM"])))
+        for item in band.findall("Histograms/HistItem"):
+            if item.findtext("Approximate") == "0" and \
+               float(item.findtext("HistMin")) == stats["range"][0] - 0.5 and \
+               float(item.findtext("HistMax")) == stats["range"][1] + 0.5:
+                counts = np.array(item.findtext("HistCounts").split("|"), 
+                                  dtype=np.int64)
+                values = np.nonzero(counts)[0]
+                stats["histogram"] = (values + stats["range"][0], counts[values])
+    else:
+        stats["range"] = (float(mdi["STATISTICS_MINIMUM"]), 
+                          float(mdi["STATISTICS_MAXIMUM"]))
+    return stats
+
+
+def _WriteAuxStats(auxFile, stats):
+    '''
+    Saves statistics from _StreamStats in the first band of a .aux.xml, keeping the 
+        rest of the file.  Integer histograms with fewer than 2**20 buckets are saved
+        as exact histograms, like those of GDAL and ArcGIS.
+    '''
+    import os, numpy as np
+    import xml.etree.ElementTree as ET
+    if os.path.exists(auxFile):
+        tree = ET.parse(auxFile)
+    else:
+        tree = ET.ElementTree(ET.Element("PAMDataset"))
+    root = tree.getroot()
+    band = root.find("PAMRasterBand")
+    if band is None:
+        band = ET.SubElement(root, "PAMRasterBand", band="1")
+    metadata = band.find("Metadata")
+    if metadata is None:
+        metadata = ET.SubElement(band, "Metadata")
+    integer = stats["integer"]
+    values = {"STATISTICS_MINIMUM": repr(stats["range"][0]),
+              "STATISTICS_MAXIMUM": repr(stats["range"][1]),
+              "STATISTICS_MEAN": repr(stats["mean"]),
+              "STATISTICS_STDDEV": repr(stats["standard_deviation"]),
+              "STATISTICS_GAP_COUNT": str(stats["count"]),
+              "STATISTICS_GAP_INTEGER": "1" if integer else "0"}
+    for mdi in metadata.findall("MDI"):
+        if mdi.get("key") in values:
+            metadata.remove(mdi)
+    for key in sorted(values):
+        ET.SubElement(metadata, "MDI", key=key).text = values[key]
+    if integer and stats["count"] and stats["range"][1] - stats["range"][0] < 2**20:
+        histograms = band.find("Histograms")
+        if histograms is None:
+            histograms = ET.SubElement(band, "Histograms")
+        for item in histograms.findall("HistItem"):
+            histograms.remove(item)
+        low, high = stats["range"]
+        counts = np.zeros(high - low + 1, dtype=np.int64)
+        counts[stats["histogram"][0] - low] = stats["histogram"][1]
+        item = ET.SubElement(histograms, "HistItem")
+        for tag, text in (("HistMin", repr(low - 0.5)), ("HistMax", repr(high + 0.5)),
+                          ("BucketCount", str(len(counts))), 
+                          ("IncludeOutOfRange", "0"), ("Approximate", "0"),
+                          ("HistCounts", "|".join([str(c) for c in counts]))):
+            ET.SubElement(item, tag).text = text
+    tree.write(auxFile)
+
+
+def _HistogramPercentiles(values, counts, percentile_list, 
+                          interpolation="inverted_cdf"):
+    '''
+    Returns a dictionary of percentile values ("25th", etc.) from a histogram sorted
+        by value, as if the values were repeated by their counts.  "inverted_cdf" 
+        gives the lowest value whose cumulative count reaches the percentile of the
+        total count, like RATStats always has.  The other interpolations are those
+        of numpy.percentile.
+    '''
+    import numpy as np
+    percentiles = np.asarray(percentile_list, dtype=float)
+    if len(percentiles) == 0:
+        return {}
+    cumFreq = np.cumsum(counts)
+    last = len(values) - 1
+    if interpolation == "inverted_cdf":
+        position = np.searchsorted(cumFreq, cumFreq[-1]*(percentiles/100.))
+        found = values[np.minimum(position, last)]
+    else:
+        # Positions in the sorted cells, and the values of the cells at them
+        h = (cumFreq[-1] - 1)*(percentiles/100.)
+        lower = values[np.minimum(np.searchsorted(cumFreq, np.floor(h), 
+                                                  side="right"), last)]
+        higher = values[np.minimum(np.searchsorted(cumFreq, np.ceil(h), 
+                                                   side="right"), last)]
+        if interpolation == "lower":
+            found = lower
+        elif interpolation == "higher":
+            found = higher
+        elif interpolation == "nearest":
+            found = values[np.minimum(np.searchsorted(cumFreq, np.around(h),
+                                                      side="right"), last)]
+        elif interpolation == "midpoint":
+            found = (lower + higher)/2.
+        elif interpolation == "linear":
+            found = lower + (h - np.floor(h))*(higher - lower)
+        else:
+            raise ValueError('interpolation must be "inverted_cdf", "linear", ' + 
+                             '"lower", "higher", "midpoint", or "nearest"')
+    return dict([(str(p) + "th", v) for p, v in zip(percentile_list, found)])
+
+
+def RATStats(raster, percentile_list, dropMax=False, dropZero=False, 
+             interpolation="inverted_cdf"):
+    '''
+    (string or list, list, [boolean], [boolean], [string]) -> dictionary or list of
+        dictionaries
     
     Creates a dictionary of measures of variability for a Raster Attribute Table (RAT).
-        Includes mean, range (as a tuple), and percentile values from the list passed.
+        Includes mean, standard deviation, range (as a tuple), and percentile values
+        from the list passed.  Everything is calculated from the RAT's values and 
+        counts, after dropping the rows asked for, so the raster isn't read.  The
+        standard deviation is that of the population, like ArcGIS's.
     
-    Note: Uses pd.Series.searchsorted for getting percentile values.  This is a complicated
-        process that should match quantile interpolation methods during comparisons 
-        with values from other tables.  It seems to behave like "interpolation="higher"" 
-        in pd.quantile().
+    Note: By default, a percentile is the lowest value whose cumulative count reaches
+        that percent of the total count (the "inverted_cdf" method of 
+        numpy.percentile).  Pass another interpolation to match quantile 
+        interpolation methods during comparisons with values from other tables.
     
     Argument:
-    raster -- A path to a raster with an attribute table (RAT) to summarize.
+    raster -- A path to a raster with an attribute table (RAT) to summarize, or a list 
+        of paths.  A list of dictionaries is returned for a list.
     percentile_list -- A python list of percentiles to calculate and include in the 
-        dictionary that is returned.
+        dictionary that is returned.  With a list of rasters, this can also be a list
+        of lists, one for each raster.
     dropMax -- True or False to drop the highest value from the table.  This is useful
         when using richness rasters that included "counter pixels" in the NW corner.
     dropZero -- True or False, will the row for zero values from the table before 
         plotting.  
+    interpolation -- "inverted_cdf", or "linear", "lower", "higher", "midpoint", or 
+        "nearest" as in numpy.percentile.
     
     Example:
     >>> aDict = RATStats(raster="T:/temp/a_richness_map.tif", 
                        percentile_list=[25, 50, 75],
                        dropMax=True, 
                        dropZero=True)
+    >>> dicts = RATStats(["T:/temp/birds.tif", "T:/temp/mammals.tif"], 
+                         [[10, 90], [25, 50, 75]], interpolation="linear")
     '''
-    import arcpy, pandas as pd
-    # Create empty dataframe
-    DF0 = pd.DataFrame(index=[], columns=[])
+    import numpy as np
+    if type(raster) in (list, tuple):
+        if len(percentile_list) and type(percentile_list[0]) in (list, tuple):
+            lists = percentile_list
+        else:
+            lists = [percentile_list]*len(raster)
+        return [RATStats(r, l, dropMax, dropZero, interpolation) 
+                for r, l in zip(raster, lists)]
     # Create dictionary for results
     resultsDict = {}
-    # Use search cursor to copy RAT to dataframe
-    rows = arcpy.SearchCursor(raster)
-    for row in rows:
-        frequency = row.getValue("COUNT")
-        value = row.getValue("VALUE")
-        DF0.loc[value, "freq"] = frequency
+    # Get the histogram from the RAT
+    table = ReadRAT(raster)
+    values, counts = table["VALUE"], table["COUNT"]
     # Drop max and/or zero if specified
     if dropMax == True:
         # Drop highest value/counter
-        DF0 = DF0[:-1]
+        values, counts = values[:-1], counts[:-1]
     if dropZero == True:
-        DF0 = DF0[DF0.index > 0]
+        values, counts = values[values > 0], counts[values > 0]
     # Calculate mean value
-    DF0.index.name = "value"
-    DF0.reset_index(drop=False, inplace=True)
-    DF0["countXvalue"] = DF0.value * DF0.freq
-    mean = DF0.countXvalue.sum()/DF0.freq.sum()
+    total = float(counts.sum())
+    mean = (values*counts.astype(float)).sum()/total
     resultsDict["mean"] = mean
     # Calculate std
-    std = arcpy.GetRasterProperties_management(raster, "STD").getOutput(0)
+    std = np.sqrt((counts*np.square(values - mean)).sum()/total)
     resultsDict["standard_deviation"] = float(std)
     # Calculate the range
-    _min = DF0.value.min()
-    _max = DF0.value.max()
-    _range = _min, _max
+    _range = values.min(), values.max()
     resultsDict["range"] = _range
     # Find percentile values
-    DF0.drop("countXvalue", inplace=True, axis=1)
-    DF0["cumFreq"] = DF0.freq.cumsum()
-    for percentile in percentile_list:
-        percentile_freq = DF0.freq.sum()*(percentile/100.)
-        percentile_value = DF0.loc[DF0.cumFreq.searchsorted(percentile_freq)[0], "value"]
-        resultsDict[str(percentile) + "th"] = percentile_value
+    resultsDict.update(_HistogramPercentiles(values, counts, percentile_list, 
+                                             interpolation))
     # Return result 
-    return resultsDict
\ No newline at end of file
+    return resultsDict
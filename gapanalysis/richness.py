@@ -1,7 +1,15 @@
+# Fractional bits of the fixed point sums of weighted richness.  Enough that 2000
+# species with percentile weights (1/weight <= 20) can't overflow int64.
+_FixedBits = 44
+
+
 def MapRichness(spp, groupName, outLoc, modelDir, season, intervalSize, 
-                CONUSExtent, weight="None"):    
+                CONUSExtent, weight="None", engine="arcpy", blockSize=4096,
+                workers=1, resume=False, snapshotWindow=None, countTable=None,
+                habitatStack=None, readers=2):    
     '''
-    (list, str, str, str, str, int, str) -> str, str
+    (list, str, str, str, str, int, str, [str], [str], [int], [int], [bool], 
+        [tuple], [str], [HabitatStack], [int]) -> str, str
 
     Creates a species richness raster for the passed species. Also includes a
       table listing all the included species. Intermediate richness rasters are
@@ -30,12 +38,49 @@ def MapRichness(spp, groupName, outLoc, modelDir, season, intervalSize,
     CONUSExtent -- A raster with a national/CONUS extent, and all cells have value of 0 except 
         for a 3x3 cell square in the top left corner that has values of 1.  The spatial reference
         should be NAD_1983_Albers and cell size 30x30 m.  Also used as a snap raster.
+        The numpy engine only reads it once (see blocks.CONUSGrid).
     weight -- option to weight each species to allow less widespead species to 
         count more.  Options are "None", "percentile", and "area".  None
         is the default and will weight each species equally (1).  Percentile
         will weight with 1/proportion of species (from the list you provided, 
         which is important to note) with a pixel count below the species' 
         pixel count.  The area option will use 1/species pixel count.  
+    engine -- "arcpy" (the default) sums the rasters with arcpy map algebra.  "numpy"
+        reads the rasters in blocks with rasterio, sums each block with numpy, and
+        writes the richness raster once, without arcpy or an ArcGIS license.  The
+        numpy engine does not save CONUS extent intermediate rasters (see 
+        snapshotWindow), and it treats nodata cells as 0.  Instead it keeps a 
+        checkpoint of finished blocks in the "Richness_checkpoint" directory, 
+        which is deleted when the richness raster is complete (see resume).  Weighted 
+        values are summed as 64 bit fixed point integers, which are exact and don't
+        depend on the order of the species.  It can also read sparse habitat maps
+        from data.MakeSparse, which don't need to be expanded to the CONUS extent.
+    blockSize -- Height and width, in cells, of the blocks read by the numpy engine.
+    workers -- Number of processes the numpy engine uses.  With more than 1, the 
+        CONUS extent is split into row bands (one row of blocks each) that are summed 
+        in separate processes and then stitched into the richness raster.  The 
+        result is identical to that of one process.  On Windows, call MapRichness 
+        from under "if __name__ == '__main__':" when using more than 1 worker.
+    resume -- True to have the numpy engine pick up where an interrupted run with the
+        same species, weights, and block size left off, instead of starting over.  
+        Runs resume whole blocks: blocks in the checkpoint aren't summed again, and
+        the block that was being summed is summed from the start.  With more than 1
+        worker, only row bands with every block in the checkpoint are skipped.  If
+        any habitat map has changed since, the checkpoint is discarded and every
+        block is summed again.
+    snapshotWindow -- A window (row offset, column offset, height, width) of the CONUS
+        extent for the numpy engine to save intermediate rasters of, in place of the
+        arcpy engine's CONUS extent ones.  The running tally of the window is saved
+        every intervalSize species, as "Intermediate_N.tif" in the intermediates 
+        directory, for spot-checking.
+    countTable -- Path to a CSV of habitat counts to reuse for weighting, from this 
+        or other runs and groups (see HabitatCounts).  Counts of maps that changed
+        are read again, and new counts are added to the table.
+    habitatStack -- A stack.HabitatStack to take habitat counts for weighting from,
+        for species whose maps haven't changed since they were packed.
+    readers -- Number of threads that each numpy engine process reads the next 
+        species' blocks with while it sums the current one (see 
+        blocks.PrefetchWindows).  0 reads and sums strictly one after the other.
 
     Example:
     >>> MapRichness(['aagtox', 'bbaeax', 'mnarox'], 'MyRandomSpecies', 
@@ -45,16 +90,22 @@ def MapRichness(spp, groupName, outLoc, modelDir, season, intervalSize,
     C:\GIS_Data\Richness\MyRandomSpecies_04_Richness\MyRandomSpecies.tif, C:\GIS_Data\Richness\MyRandomSpecies.csv
     '''    
     
-    import os, datetime, arcpy, pandas as pd
-    from scipy import stats
-    arcpy.CheckOutExtension('SPATIAL')
-    arcpy.ResetEnvironments()
-    arcpy.env.overwriteOutput=True
-    arcpy.env.pyramid = 'NONE'
-    arcpy.env.snapRaster = CONUSExtent
-    arcpy.env.rasterStatistics = "STATISTICS"
-    arcpy.env.cellSize = "MINOF"
-    arcpy.env.extent = CONUSExtent
+    import os, datetime, pandas as pd
+    from gapanalysis import runlog
+    if engine == "arcpy":
+        import arcpy
+        arcpy.CheckOutExtension('SPATIAL')
+        arcpy.ResetEnvironments()
+        arcpy.env.overwriteOutput=True
+        arcpy.env.pyramid = 'NONE'
+        arcpy.env.snapRaster = CONUSExtent
+        arcpy.env.rasterStatistics = "STATISTICS"
+        arcpy.env.cellSize = "MINOF"
+        arcpy.env.extent = CONUSExtent
+    elif engine == "numpy":
+        from gapanalysis import blocks
+    else:
+        raise ValueError('engine must be "arcpy" or "numpy"')
     starttime = datetime.datetime.now()      
     
     # Maximum number of species to process at once
@@ -62,12 +113,14 @@ def MapRichness(spp, groupName, outLoc, modelDir, season, intervalSize,
     # Count the number of species in the species list
     sppLength = len(spp)
     # The seasonal input directory
+    baseDir = modelDir
     modelDir = modelDir + season + "/"
     
     ############################################# create directories for the output
     ###############################################################################
     outDir = os.path.join(outLoc, groupName)   
-    arcpy.env.workspace = outDir
+    if engine == "arcpy":
+        arcpy.env.workspace = outDir
     intDir = os.path.join(outDir, 'Richness_intermediates')
     for x in [intDir, outDir]:
         if not os.path.exists(x):
@@ -77,12 +130,9 @@ def MapRichness(spp, groupName, outLoc, modelDir, season, intervalSize,
         logObj = open(log, "wb")
         logObj.close()
     
-    ######################################## Function to write data to the log file
+    ############################################## Log file and metrics for the run
     ###############################################################################
-    def __Log(content):
-        print content
-        with open(log, 'a') as logDoc:
-            logDoc.write(content + '\n')
+    __Log = runlog.RunLog(log, "MapRichness")
     
     ################################################ Create a dataframe for weights
     ###############################################################################  
@@ -90,19 +140,11 @@ def MapRichness(spp, groupName, outLoc, modelDir, season, intervalSize,
     weightsDF = pd.DataFrame()
     if weight != "None":
         # Record habitat area per species in the table
-        for sp in spp:
-            habmap = arcpy.Raster(modelDir + sp)
-            rows = arcpy.SearchCursor(habmap)
-            for row in rows:
-                if row.getValue("VALUE") == 1:
-                    count = row.getValue("COUNT")
-            weightsDF.loc[sp, "cnt"] = count
-        if weight == "percentile":
-            weightsDF["weight"] = 100.*(stats.rankdata(weightsDF.cnt, method="average")/len(weightsDF.cnt))
-        if weight == "area":
-            weightsDF["weight"] = [(c-9)*1. for c in weightsDF.cnt]
-        weightsDF["weighted_value"] = 1./(weightsDF.weight)
-        weightsDF.to_csv(outTable)
+        with __Log.Stage("weights"):
+            weightsDF = _WeightTable(spp, baseDir, season, weight, engine, countTable,
+                                     habitatStack)
+        with __Log.Stage("table update"):
+            weightsDF.to_csv(outTable)
         
     if weight == "None":
         spTable = open(outTable, "a")
@@ -123,6 +165,53 @@ def MapRichness(spp, groupName, outLoc, modelDir, season, intervalSize,
     __Log('\nThe species that will be used for analysis:')
     __Log(str(spp) + '\n')
     
+    ################################ Or sum blocks of the rasters with the numpy engine
+    ###############################################################################
+    if engine == "numpy":
+        try:
+            richness_file_name = outDir + "/{0}_Richness.tif".format(groupName)
+            paths = [blocks.FindRaster(modelDir, sp) for sp in spp]
+            if weight == "None":
+                weights = None
+            else:
+                weights = [weightsDF.loc[sp, "weight"] for sp in spp]
+                unweighted = [sp for sp, w in zip(spp, weights) if w == 0]
+                if unweighted:
+                    __Log("Species with no habitat, which add nothing: " + 
+                          str(unweighted))
+            for i, sp in enumerate(spp):
+                __Log(sp)
+                if weights is None:
+                    __Log("\tvalue = " + str(1))
+                elif weights[i] == 0:
+                    __Log("\tvalue = 0 (no habitat)")
+                else:
+                    __Log("\tvalue = " + str(1/weights[i]))
+            if snapshotWindow is not None:
+                __Log("Saving intermediate rasters of window {0}".format(snapshotWindow))
+                with __Log.Stage("snapshots"):
+                    for snapshot in _Snapshots(paths, weights, CONUSExtent, 
+                                               snapshotWindow, intervalSize, intDir,
+                                               readers):
+                        __Log('\tSaved to {0}'.format(snapshot))
+            __Log("Summing blocks and saving richness raster to {0}".format(
+                  richness_file_name))
+            resumed = _SumRichness(paths, weights, CONUSExtent, richness_file_name, 
+                                   blockSize, workers, 
+                                   os.path.join(outDir, "Richness_checkpoint"), resume,
+                                   __Log, readers)
+            if resumed:
+                __Log('Resumed with {0} blocks from the checkpoint'.format(resumed))
+            __Log('Richness raster and RAT saved')
+        except Exception as e:
+            __Log('ERROR in numpy richness -- {0}'.format(e))
+            raise
+        finally:
+            runtime = datetime.datetime.now() - starttime
+            __Log("Total runtime was: " + str(runtime))
+            __Log.Close(engine=engine, species=sppLength)
+        return richness_file_name, outTable
+    
     #################################### Sum rasters, saving the tally periodically
     ###############################################################################    
     tally = arcpy.Raster(CONUSExtent)
@@ -139,22 +228,27 @@ def MapRichness(spp, groupName, outLoc, modelDir, season, intervalSize,
             # Determine the weight for the species and add accordingling
             if weight == "None":
                 __Log("\tvalue = " + str(1))
-                tally = tally + habmap
+                with __Log.Stage("compute"):
+                    tally = tally + habmap
             if weight != "None":
-                weight = weightsDF.loc[sp, "weight"]
+                spWeight = weightsDF.loc[sp, "weight"]
                 # These cases would produce float data type 
                 # so multiply by 1000 for integers
-                __Log("\tvalue = " + str((1/weight)))
-                tally = tally + (habmap/weight)
+                __Log("\tvalue = " + str((1/spWeight)))
+                with __Log.Stage("compute"):
+                    tally = tally + (habmap/spWeight)
+            __Log.Count("species")
             
             if counter - 1 in range(0, 2000, interval):
-                if weight == "None":
-                    tally.save(tally_file_name)
-                if weight != "None":
-                    intermediate = arcpy.sa.Int((tally*10000) + 0.5)
-                    intermediate.save(tally_file_name)
-                arcpy.management.BuildRasterAttributeTable(in_raster=tally_file_name,
-                                                           overwrite=False)
+                with __Log.Stage("write"):
+                    if weight == "None":
+                        tally.save(tally_file_name)
+                    if weight != "None":
+                        intermediate = arcpy.sa.Int((tally*10000) + 0.5)
+                        intermediate.save(tally_file_name)
+                with __Log.Stage("RAT build"):
+                    arcpy.management.BuildRasterAttributeTable(in_raster=tally_file_name,
+                                                               overwrite=False)
                 __Log('\tSaved to {0}'.format(tally_file_name))
                     
             """if  counter != tally.maximum:
@@ -168,19 +262,696 @@ def MapRichness(spp, groupName, outLoc, modelDir, season, intervalSize,
     try:
         richness_file_name = outDir + "/{0}_Richness.tif".format(groupName)
         __Log('Saving richness raster to {0}'.format(richness_file_name))
-        if weight != "None":
-            finalrichness = arcpy.sa.Int((tally*10000) + 0.5)
-            finalrichness.save(richness_file_name)
-        if weight == "None":
-            tally.save(richness_file_name)
+        with __Log.Stage("write"):
+            if weight != "None":
+                finalrichness = arcpy.sa.Int((tally*10000) + 0.5)
+                finalrichness.save(richness_file_name)
+            if weight == "None":
+                tally.save(richness_file_name)
         __Log('Richness raster saved')
         __Log('Building RAT')
-        arcpy.management.BuildRasterAttributeTable(in_raster=richness_file_name,
-                                                   overwrite=True)
+        with __Log.Stage("RAT build"):
+            arcpy.management.BuildRasterAttributeTable(in_raster=richness_file_name,
+                                                       overwrite=True)
     except Exception as e:
         __Log('ERROR in final richness save -- {0}'.format(e))
     
     runtime = datetime.datetime.now() - starttime
     __Log("Total runtime was: " + str(runtime))
+    __Log.Close(engine=engine, species=sppLength)
+
+    return tally, outTable
+
+
+def HabitatCounts(spp, modelDir, season, engine="numpy", countTable=None,
+                  habitatStack=None, workers=8):
+    '''
+    (list, str, str, [str], [str], [HabitatStack], [int]) -> pandas Series
+
+    Returns the number of habitat (value 1) cells, counter pixels included, in each
+      species' seasonal habitat map, which MapRichness weights species with.  Counts
+      are read from the maps' RATs in a pool of threads, unless they can be taken
+      from a count table or a habitat stack.  Counts are only taken from those if
+      the habitat map hasn't changed since they were made.
+
+    Arguments:
+    spp -- A list of GAP species codes.
+    modelDir -- The directory holding the "Summer", "Winter", and "Any" 
+        subdirectories of habitat maps, as for MapRichness.
+    season -- "Summer", "Winter", or "Any".
+    engine -- "numpy" reads counts from the maps' .vat.dbf tables, including counter
+        pixels implied by sparse habitat maps.  "arcpy" reads them with a cursor if 
+        a map doesn't have a .vat.dbf table.
+    countTable -- Path to a CSV of counts (species, season, source, mtime, size, 
+        cnt) to reuse.  It's created or updated with the counts that are read, so 
+        that one table can serve many runs and groups.
+    habitatStack -- A stack.HabitatStack with the species' seasonal maps.
+    workers -- Number of threads that read RATs.
+
+    Example:
+    >>> HabitatCounts(['bAMROx', 'mSEWEx'], 'C:/Data/Model/Output/', 'Summer',
+                      countTable='C:/Data/habitat_counts.csv')
+    bAMROx    2719481
+    mSEWEx      80312
+    dtype: int64
+    '''
+    import os, pandas as pd
+    from multiprocessing.pool import ThreadPool
+    from gapanalysis import blocks
+    seasonDir = modelDir + season + "/"
+    if engine == "numpy":
+        paths = [blocks.FindRaster(seasonDir, sp) for sp in spp]
+    else:
+        paths = [seasonDir + sp for sp in spp]
+    stats = [os.stat(p) for p in paths]
+    
+    # Counts that are still good
+    old = {}
+    if countTable is not None and os.path.exists(countTable):
+        table = pd.read_csv(countTable)
+        for row in table.itertuples(index=False):
+            old[(row.species, row.season)] = row
+    counts = {}
+    for sp, path, stat in zip(spp, paths, stats):
+        row = old.get((sp, season))
+        if row is not None and row.source == os.path.abspath(path) and \
+           row.size == stat.st_size and abs(row.mtime - stat.st_mtime) < 1e-3:
+            counts[sp] = int(row.cnt)
+            continue
+        if habitatStack is None:
+            continue
+        entry = habitatStack.entries.get(season, {}).get(sp)
+        if entry is not None and \
+           os.path.abspath(entry["source"]) == os.path.abspath(path) and \
+           entry["size"] == stat.st_size and entry["mtime"] == stat.st_mtime:
+            counts[sp] = entry["count"] + sum([v == 1 for row in entry["counter"]
+                                               for v in row])
+    
+    # Read the rest from the RATs
+    jobs = [(path, engine) for sp, path in zip(spp, paths) if sp not in counts]
+    if jobs:
+        pool = ThreadPool(max(1, min(workers, len(jobs))))
+        try:
+            read = pool.map(_HabitatCount, jobs)
+        finally:
+            pool.close()
+            pool.join()
+        for (path, engine), count in zip(jobs, read):
+            counts[spp[paths.index(path)]] = count
+    
+    if countTable is not None:
+        for sp, path, stat in zip(spp, paths, stats):
+            old[(sp, season)] = (sp, season, os.path.abspath(path), stat.st_mtime,
+                                 stat.st_size, counts[sp])
+        table = pd.DataFrame([tuple(old[k]) for k in sorted(old)],
+                             columns=["species", "season", "source", "mtime", "size",
+                                      "cnt"])
+        table.to_csv(countTable, index=False, float_format="%.6f")
+    return pd.Series([counts[sp] for sp in spp], index=spp, dtype="int64")
+
+
+def UpdateRichness(groupName, outLoc, modelDir, season, CONUSExtent, add=[], 
+                   remove=[], replace=[], weight="None", oldModelDir=None,
+                   blockSize=4096, countTable=None, habitatStack=None, readers=2):
+    '''
+    (str, str, str, str, str, [list], [list], [list], [str], [str], [int], [str], 
+        [HabitatStack], [int]) -> str, str
+
+    Updates a richness raster made by MapRichness, and its species table, when 
+      species are added to or removed from the group or their habitat maps are 
+      revised, without summing the whole group again.  Only the blocks that the 
+      changed species' habitat reaches (its bounding box in the CONUS grid, plus 
+      the counter pixels) are read and rewritten.  The bounding boxes are found by
+      reading the changed species' maps, unless they're in habitatStack.  For 
+      unweighted richness, the old maps are subtracted from those blocks and the 
+      new ones added.  Weighted richness is rounded, so its blocks are summed again
+      from every species' map, and species whose weights change are treated as 
+      replaced.  With percentile weights, 
+      adding or removing a species changes the weights of many others.  The result
+      is the same as that of MapRichness with the numpy engine for the new list of
+      species.  Requires rasterio, but not arcpy.
+
+    The new blocks are saved in the "Richness_update" directory before any are 
+      written, so the richness raster is left as it was if the update fails.  The
+      raster is updated in place; rewritten blocks can make it a little larger.
+
+    Returns the path to the richness raster and the path to the species table.
+
+    Arguments:
+    groupName -- The name of the group, as given to MapRichness.
+    outLoc -- The directory holding the group's directory, as given to MapRichness.
+    modelDir -- The directory holding the "Summer", "Winter", and "Any" 
+        subdirectories of the current habitat maps, as for MapRichness.
+    season -- The season of the richness raster: "Summer", "Winter", or "Any".
+    CONUSExtent -- The CONUS extent raster the richness raster was made with.
+    add -- A list of GAP species codes to add to the group.
+    remove -- A list of species to take out of the group.  Their maps are read 
+        from oldModelDir if they're there, otherwise from modelDir, and must be as 
+        they were when richness was mapped.
+    replace -- A list of species in the group whose habitat maps have been revised
+        since richness was mapped.
+    weight -- The weighting of the richness raster: "None", "percentile", or "area",
+        as given to MapRichness.  It must match the species table.
+    oldModelDir -- A directory with "Summer", "Winter", and "Any" subdirectories of
+        the habitat maps as they were when richness was mapped, for the replaced and
+        removed species.  If an old map can't be found, the blocks that it covered
+        are unknown, so every block is summed again.
+    blockSize -- Height and width, in cells, of the blocks read.
+    countTable -- Path to a CSV of habitat counts to reuse for weighting (see 
+        HabitatCounts).
+    habitatStack -- A stack.HabitatStack to take habitat counts for weighting and 
+        bounding boxes from, for species whose maps haven't changed since they were
+        packed.
+    readers -- Number of threads that read the next species' blocks while the 
+        current one is summed (see blocks.PrefetchWindows).
+
+    Example:
+    >>> UpdateRichness('MyRandomSpecies', 'C:/GIS_Data/Richness', 
+                       'C:/Data/Model/Output/', 'Summer', 'C:/data/conus_ext_cnt.tif',
+                       add=['bAMROx'], replace=['mnarox'], 
+                       oldModelDir='C:/Data/Model/Output_2018/')
+    C:/GIS_Data/Richness/MyRandomSpecies/MyRandomSpecies_Richness.tif, C:/GIS_Data/Richness/MyRandomSpecies/MyRandomSpecies.csv
+    '''
+    import os, shutil, datetime, numpy as np, rasterio
+    from gapanalysis import blocks, runlog
+    starttime = datetime.datetime.now()
+    outDir = os.path.join(outLoc, groupName)
+    richness_file_name = outDir + "/{0}_Richness.tif".format(groupName)
+    outTable = os.path.join(outDir, groupName + '.csv')
+    seasonDir = modelDir + season + "/"
+    add, remove, replace = list(add), list(remove), list(replace)
+    
+    ###################################### Check the changes against the species table
+    ###############################################################################
+    oldSpp, oldWeights = _ReadSpeciesTable(outTable)
+    if (weight == "None") != (oldWeights is None):
+        raise ValueError('weight "{0}" does not match {1}'.format(weight, outTable))
+    misplaced = [sp for sp in add if sp in oldSpp] + \
+                [sp for sp in remove + replace if sp not in oldSpp]
+    if misplaced:
+        raise ValueError("Species already in, or not in, {0}: {1}".format(groupName,
+                                                                          misplaced))
+    spp = [sp for sp in oldSpp if sp not in remove] + add
+    
+    ############################################## Log file and metrics for the run
+    ###############################################################################
+    __Log = runlog.RunLog(outDir + "/Log_{0}.txt".format(groupName), "UpdateRichness")
+    __Log("\n" + ("#"*67))
+    __Log("The results from updating richness")
+    __Log("#"*67)    
+    __Log(starttime.strftime("%c"))
+    __Log('\nUpdating "{0}" to {1} species.\n'.format(groupName, len(spp)).upper())
+    __Log('Season of this calculation: ' + season)
+    __Log('Weighting method: ' + weight)
+    __Log('Added: {0}'.format(add))
+    __Log('Removed: {0}'.format(remove))
+    __Log('Replaced: {0}'.format(replace))
+    
+    ############################################ Work out the weights that changed
+    ###############################################################################
+    weights, weightsDF, reweighted = None, None, []
+    changed = set(add + remove + replace)
+    if weight != "None":
+        with __Log.Stage("weights"):
+            weightsDF = _WeightTable(spp, modelDir, season, weight, "numpy", 
+                                     countTable, habitatStack)
+        weights = [weightsDF.loc[sp, "weight"] for sp in spp]
+        unweighted = [sp for sp, w in zip(spp, weights) if w == 0]
+        if unweighted:
+            __Log("Species with no habitat, which add nothing: " + str(unweighted))
+        # The table's weights may have lost some digits
+        reweighted = [sp for sp, w in zip(spp, weights) if sp not in changed and
+                      abs(oldWeights[sp] - w) > 1e-9*abs(w)]
+        __Log('Reweighted: {0}'.format(reweighted))
+    
+    ############################################# Find the blocks the changes reach
+    ###############################################################################
+    grid, counterValues = blocks.CONUSGrid(CONUSExtent)
+    paths = [blocks.FindRaster(seasonDir, sp) for sp in spp]
+    extents = [blocks.RasterWindow(p, grid) for p in paths]
+    oldDirs = [oldModelDir + season + "/"] if oldModelDir is not None else []
+    oldPaths = {}
+    for sp in remove + replace:
+        oldPaths[sp] = None
+        for directory in oldDirs + ([seasonDir] if sp in remove else []):
+            try:
+                oldPaths[sp] = blocks.FindRaster(directory, sp)
+                break
+            except IOError:
+                pass
+    missing = [sp for sp in oldPaths if oldPaths[sp] is None]
+    minus, plus = [], []
+    if missing:
+        __Log('No old habitat maps for {0}; summing every block'.format(missing))
+        windows = blocks.BlockWindows(grid, blockSize)
+    else:
+        with __Log.Stage("bounding boxes"):
+            args = (season, grid, blockSize, habitatStack, readers)
+            minus = [(oldPaths[sp], _HabitatBox(sp, oldPaths[sp], *args)) 
+                     for sp in remove + replace]
+            plus = [(paths[spp.index(sp)], _HabitatBox(sp, paths[spp.index(sp)], *args))
+                    for sp in add + replace]
+            reach = [box for path, box in minus + plus] + \
+                    [_HabitatBox(sp, paths[spp.index(sp)], *args) for sp in reweighted]
+        windows = [w for w in blocks.BlockWindows(grid, blockSize)
+                   if any([blocks.NeedsWindow(w, box, grid) for box in reach])]
+    delta = weights is None and not missing
+    __Log('{0} {1} of {2} blocks'.format("Updating" if delta else "Summing", 
+                                         len(windows),
+                                         len(blocks.BlockWindows(grid, blockSize))))
+    
+    ###################### Make the new blocks, then write them to the richness raster
+    ###############################################################################
+    updateDir = os.path.join(outDir, "Richness_update")
+    try:
+        _OpenCheckpoint(updateDir, {"spp": spp, "windows": windows}, False)
+        removedHist, addedHist = None, None
+        with rasterio.open(richness_file_name) as src:
+            for window in windows:
+                with __Log.Stage("read"):
+                    before = blocks.ReadWindow(src, grid, window)
+                if delta:
+                    tally = _UpdateBlock(grid, window, before, minus, plus, __Log,
+                                         readers)
+                else:
+                    tally = _RichnessBlock(grid, window, counterValues, paths, 
+                                           extents, weights, __Log, readers)
+                removedHist = blocks.AddHistogram(removedHist, before)
+                addedHist = blocks.AddHistogram(addedHist, tally)
+                with __Log.Stage("checkpoint"):
+                    _SaveTile(updateDir, window, tally)
+        with __Log.Stage("write"):
+            with rasterio.open(richness_file_name, "r+") as dst:
+                for window in windows:
+                    blocks.WriteWindow(dst, grid, window, _LoadTile(updateDir, window))
+        with __Log.Stage("RAT build"):
+            vat = blocks.ReadVAT(richness_file_name)
+            hist = np.zeros(vat["VALUE"].max() + 1, dtype=np.int64)
+            hist[vat["VALUE"]] = vat["COUNT"]
+            if removedHist is not None:
+                hist = blocks.MergeHistograms(hist, addedHist)
+                hist[:len(removedHist)] -= removedHist
+            values = np.nonzero(hist)[0]
+            blocks.WriteVAT(richness_file_name, values, hist[values])
+        with __Log.Stage("table update"):
+            if weightsDF is not None:
+                weightsDF.to_csv(outTable)
+            else:
+                with open(outTable, "w") as spTable:
+                    for sp in spp:
+                        spTable.write(str(sp) + ", {0}".format(str(1)) + ",\n")
+        __Log('Richness raster, RAT, and table updated')
+    except Exception as e:
+        __Log('ERROR in richness update -- {0}'.format(e))
+        raise
+    finally:
+        shutil.rmtree(updateDir, ignore_errors=True)
+        __Log("Total runtime was: " + str(datetime.datetime.now() - starttime))
+        __Log.Close(species=len(spp), blocks=len(windows))
+    return richness_file_name, outTable
+
+
+def _HabitatCount(args):
+    '''
+    Returns the number of habitat cells in a habitat map from its RAT.
+    '''
+    path, engine = args
+    if engine == "numpy":
+        from gapanalysis import blocks
+        return blocks.HabitatCount(path)
+    from gapanalysis import misc
+    rat = misc.ReadRAT(path)
+    return int(rat["COUNT"][rat["VALUE"] == 1].sum())
+
+
+def _HabitatBox(sp, path, season, grid, blockSize, habitatStack=None, readers=2):
+    '''
+    Returns the bounding box of a species' habitat in the grid (see 
+      blocks.HabitatWindow), from the habitat stack if the map hasn't changed since
+      it was packed.
+    '''
+    import os
+    from gapanalysis import blocks
+    if habitatStack is not None:
+        entry = habitatStack.entries.get(season, {}).get(sp)
+        stat = os.stat(path)
+        if entry is not None and \
+           os.path.abspath(entry["source"]) == os.path.abspath(path) and \
+           entry["size"] == stat.st_size and entry["mtime"] == stat.st_mtime:
+            return tuple(entry["window"])
+    return blocks.HabitatWindow(path, grid, blockSize, readers)
+
+
+def _WeightTable(spp, modelDir, season, weight, engine, countTable, habitatStack):
+    '''
+    Returns MapRichness' table of the species' habitat counts ("cnt"), weights for
+      "percentile" or "area" weighting, and weighted values (1/weight), indexed by 
+      species.
+    '''
+    import pandas as pd
+    from scipy import stats
+    counts = HabitatCounts(spp, modelDir, season, engine, countTable, habitatStack)
+    weightsDF = pd.DataFrame({"cnt": counts.astype(float)}, index=spp)
+    if weight == "percentile":
+        weightsDF["weight"] = 100.*(stats.rankdata(weightsDF.cnt, method="average")/len(weightsDF.cnt))
+    if weight == "area":
+        weightsDF["weight"] = weightsDF.cnt - 9.
+    weightsDF["weighted_value"] = 1./(weightsDF.weight)
+    return weightsDF
+
+
+def _ReadSpeciesTable(table):
+    '''
+    Reads the species table that MapRichness writes.  Returns the list of species
+      and, for weighted richness, a dictionary of their weights (None otherwise).
+    '''
+    import pandas as pd
+    with open(table) as f:
+        header = f.readline()
+    if "weight" in header:
+        weightsDF = pd.read_csv(table, index_col=0)
+        return list(weightsDF.index), dict(weightsDF["weight"])
+    spp = []
+    with open(table) as f:
+        for line in f:
+            # Species are appended to the table each run, so they can repeat
+            sp = line.split(",")[0].strip()
+            if sp and sp not in spp:
+                spp.append(sp)
+    return spp, None
 
-    return tally, outTable
\ No newline at end of file
+
+def _FixedWeights(weights):
+    '''
+    Returns 1/weight of each species as a 64 bit fixed point integer with 
+        _FixedBits fractional bits.  A weight of 0 is an area weight of a species 
+        with no habitat; it gets 0, so the species adds nothing, as its 0/0 cells 
+        are NoData that the arcpy engine's sum leaves out.
+    '''
+    import numpy as np
+    weights = np.asarray(weights, dtype=np.float64)
+    if not (weights >= 0).all():
+        raise ValueError("Species weights must be positive, got {0}".format(
+                         weights[~(weights >= 0)].tolist()))
+    fixed = np.zeros(len(weights), dtype=np.int64)
+    positive = weights > 0
+    fixed[positive] = np.round(float(2**_FixedBits)/weights[positive])
+    return fixed
+
+
+def _FixedRound(tally):
+    '''
+    Converts a fixed point tally to int32 richness, Int(tally*10000 + 0.5), without 
+        overflowing.
+    '''
+    import numpy as np
+    whole, part = np.divmod(tally, 2**_FixedBits)
+    return (whole*10000 + (part*10000 + 2**(_FixedBits - 1)) // 2**_FixedBits
+            ).astype(np.int32)
+
+
+def _RichnessBlock(grid, window, counterValues, paths, extents, weights, 
+                   metrics=None, readers=2):
+    '''
+    Returns the richness of one window: the CONUS extent (counter pixels) plus each
+        habitat map, or plus each habitat map divided by its weight, summed in fixed
+        point and converted to integers the way MapRichness does for weighted 
+        richness.  The habitat maps are read ahead by readers threads.  Read (time
+        spent waiting for a map) and compute times are added to metrics, if given.
+    '''
+    import numpy as np
+    from gapanalysis import blocks, runlog
+    metrics = metrics or runlog.Metrics()
+    base = blocks.CounterWindow(grid, counterValues, window)
+    if weights is None:
+        tally = base.astype(np.uint16)
+    else:
+        fixed = _FixedWeights(weights)
+        tally = base.astype(np.int64) << _FixedBits
+    needed = [i for i in range(len(paths))
+              if blocks.NeedsWindow(window, extents[i], grid)]
+    habmaps = blocks.PrefetchWindows([(paths[i], window) for i in needed], grid,
+                                     readers=readers)
+    for i in needed:
+        with metrics.Stage("read"):
+            habmap = next(habmaps)
+        metrics.Count("bytes read", habmap.nbytes)
+        with metrics.Stage("compute"):
+            if weights is None:
+                tally += habmap
+            else:
+                tally += habmap.astype(np.int64)*fixed[i]
+    if weights is not None:
+        with metrics.Stage("compute"):
+            tally = _FixedRound(tally)
+    metrics.Count("cells", tally.size)
+    return tally
+
+
+def _UpdateBlock(grid, window, before, minus, plus, metrics=None, readers=2):
+    '''
+    Returns a block of unweighted richness with the habitat maps in minus taken out 
+        and those in plus added.  minus and plus are lists of (path, window in the
+        grid) of the maps.  Raises a ValueError if a cell would be less than zero, 
+        as happens if the maps in minus aren't the ones the richness was summed 
+        from.  Read and compute times are added to metrics, if given.
+    '''
+    import numpy as np
+    from gapanalysis import blocks, runlog
+    metrics = metrics or runlog.Metrics()
+    tally = before.astype(np.int32)
+    for sign, maps in ((-1, minus), (1, plus)):
+        needed = [path for path, extent in maps 
+                  if blocks.NeedsWindow(window, extent, grid)]
+        habmaps = blocks.PrefetchWindows([(path, window) for path in needed], grid,
+                                         readers=readers)
+        for path in needed:
+            with metrics.Stage("read"):
+                habmap = next(habmaps)
+            metrics.Count("bytes read", habmap.nbytes)
+            with metrics.Stage("compute"):
+                if sign < 0:
+                    tally -= habmap
+                else:
+                    tally += habmap
+    if (tally < 0).any():
+        raise ValueError("The old habitat maps aren't in the richness of block " +
+                         str(window))
+    metrics.Count("cells", tally.size)
+    return tally.astype(np.uint16)
+
+
+def _RichnessBand(args):
+    '''
+    Sums the blocks of one row band and saves them to a temporary GeoTIFF.  Returns
+        the band's window, the path to the GeoTIFF, the band's histogram, and the
+        band's Metrics.
+    '''
+    from gapanalysis import blocks, runlog
+    (grid, band, blockSize, counterValues, paths, extents, weights, bandRaster,
+     readers) = args
+    metrics = runlog.Metrics()
+    bandGrid = blocks.SubGrid(grid, band)
+    hist = None
+    dst = blocks.CreateRaster(bandRaster, bandGrid, 
+                              "uint16" if weights is None else "int32")
+    try:
+        for window in blocks.BlockWindows(grid, blockSize):
+            if window[0] != band[0]:
+                continue
+            tally = _RichnessBlock(grid, window, counterValues, paths, extents, weights,
+                                   metrics, readers)
+            with metrics.Stage("write"):
+                blocks.WriteWindow(dst, bandGrid, (0, window[1], window[2], window[3]),
+                                   tally)
+            metrics.Count("bytes written", tally.nbytes)
+            hist = blocks.AddHistogram(hist, tally)
+    finally:
+        dst.close()
+    return band, bandRaster, hist, metrics
+
+
+def _SumRichness(paths, weights, CONUSExtent, outRaster, blockSize, workers=1,
+                 checkDir=None, resume=False, metrics=None, readers=2):
+    '''
+    Sums habitat maps block by block into outRaster and writes its RAT.  With more
+        than one worker, row bands are summed in a process pool and stitched.  Each
+        finished block is saved in checkDir, if given, so that a run can resume.  
+        Returns the number of blocks taken from the checkpoint.  Workers resume 
+        whole bands only.  Stage times and counts are added to metrics, if given;
+        the workers' times are added up, so they can be more than the run's.
+    '''
+    import os, shutil, tempfile, multiprocessing, numpy as np, rasterio
+    from gapanalysis import blocks, runlog
+    metrics = metrics or runlog.Metrics()
+    grid, counterValues = blocks.CONUSGrid(CONUSExtent)
+    extents = [blocks.RasterWindow(p, grid) for p in paths]
+    dtype = "uint16" if weights is None else "int32"
+    done = set()
+    if checkDir is not None:
+        signature = {"version": 1, "CONUSExtent": os.path.abspath(CONUSExtent),
+                     "paths": [os.path.abspath(p) for p in paths],
+                     "mtimes": [os.path.getmtime(p) for p in paths],
+                     "weights": weights, "blockSize": blockSize}
+        done = _OpenCheckpoint(checkDir, signature, resume)
+    hist = None
+    resumed = 0
+    dst = blocks.CreateRaster(outRaster, grid, dtype)
+    try:
+        if workers <= 1:
+            for window in blocks.BlockWindows(grid, blockSize):
+                if window[:2] in done:
+                    with metrics.Stage("checkpoint"):
+                        tally = _LoadTile(checkDir, window)
+                    resumed += 1
+                else:
+                    tally = _RichnessBlock(grid, window, counterValues, paths, 
+                                           extents, weights, metrics, readers)
+                    if checkDir is not None:
+                        with metrics.Stage("checkpoint"):
+                            _SaveTile(checkDir, window, tally)
+                with metrics.Stage("write"):
+                    blocks.WriteWindow(dst, grid, window, tally)
+                metrics.Count("bytes written", tally.nbytes)
+                hist = blocks.AddHistogram(hist, tally)
+        else:
+            bandDir = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(outRaster)))
+            bands = [(row, 0, min(blockSize, grid.height - row), grid.width)
+                     for row in range(0, grid.height, blockSize)]
+            windows = blocks.BlockWindows(grid, blockSize)
+            jobs = []
+            for band in bands:
+                bandWindows = [w for w in windows if w[0] == band[0]]
+                if all([w[:2] in done for w in bandWindows]):
+                    for window in bandWindows:
+                        with metrics.Stage("checkpoint"):
+                            tally = _LoadTile(checkDir, window)
+                        resumed += 1
+                        blocks.WriteWindow(dst, grid, window, tally)
+                        hist = blocks.AddHistogram(hist, tally)
+                else:
+                    jobs.append((grid, band, blockSize, counterValues, paths, extents,
+                                 weights, 
+                                 os.path.join(bandDir, "band_{0}.tif".format(band[0])),
+                                 readers))
+            pool = multiprocessing.Pool(workers)
+            try:
+                # Stitch each band into the output as soon as it's finished
+                for band, bandRaster, bandHist, bandMetrics in \
+                        pool.imap_unordered(_RichnessBand, jobs):
+                    metrics.Merge(bandMetrics)
+                    bandGrid = blocks.SubGrid(grid, band)
+                    with metrics.Stage("stitch"):
+                        with rasterio.open(bandRaster) as src:
+                            for window in blocks.BlockWindows(bandGrid, blockSize):
+                                tally = blocks.ReadWindow(src, bandGrid, window)
+                                window = (band[0] + window[0], window[1], window[2], 
+                                          window[3])
+                                blocks.WriteWindow(dst, grid, window, tally)
+                                if checkDir is not None:
+                                    _SaveTile(checkDir, window, tally)
+                    os.remove(bandRaster)
+                    hist = blocks.MergeHistograms(hist, bandHist)
+            finally:
+                pool.close()
+                pool.join()
+                shutil.rmtree(bandDir, ignore_errors=True)
+    finally:
+        dst.close()
+    with metrics.Stage("RAT build"):
+        values = np.nonzero(hist)[0]
+        blocks.WriteVAT(outRaster, values, hist[values])
+    if checkDir is not None:
+        shutil.rmtree(checkDir, ignore_errors=True)
+    return resumed
+
+
+def _OpenCheckpoint(checkDir, signature, resume):
+    '''
+    Returns the set of (row, column) offsets of the blocks finished by an earlier run
+        if resuming a run with the same signature.  Otherwise starts a new, empty 
+        checkpoint in checkDir and returns an empty set.  The checkpoint is the
+        signature ("state.json"), a compressed array of each finished block, and a
+        list of the finished blocks ("tiles.txt") that is appended to after each 
+        block's array is saved.
+    '''
+    import os, json, shutil
+    stateFile = os.path.join(checkDir, "state.json")
+    tilesFile = os.path.join(checkDir, "tiles.txt")
+    signature = json.loads(json.dumps(signature))
+    if resume and os.path.exists(stateFile) and os.path.exists(tilesFile):
+        with open(stateFile) as f:
+            state = json.load(f)
+        if state == signature:
+            done = set()
+            with open(tilesFile) as f:
+                for line in f:
+                    # A line cut short by a crash doesn't count
+                    if line.endswith("\n"):
+                        done.add(tuple([int(x) for x in line.split(",")]))
+            return done
+    shutil.rmtree(checkDir, ignore_errors=True)
+    os.makedirs(checkDir)
+    with open(stateFile, "w") as f:
+        json.dump(signature, f)
+    open(tilesFile, "w").close()
+    return set()
+
+
+def _SaveTile(checkDir, window, tally):
+    '''
+    Saves a finished block in the checkpoint, then records it as finished.
+    '''
+    import os
+    from gapanalysis import cache
+    cache.SaveArray(checkDir, "tile_{0}_{1}".format(window[0], window[1]), tally)
+    with open(os.path.join(checkDir, "tiles.txt"), "a") as f:
+        f.write("{0},{1}\n".format(window[0], window[1]))
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def _LoadTile(checkDir, window):
+    '''
+    Loads a finished block from the checkpoint.
+    '''
+    from gapanalysis import cache
+    return cache.LoadArray(checkDir, "tile_{0}_{1}".format(window[0], window[1]))
+
+
+def _Snapshots(paths, weights, CONUSExtent, window, intervalSize, intDir, readers=2):
+    '''
+    Adds habitat maps one by one to a window of the CONUS extent and saves the 
+        running tally as "Intermediate_N.tif", with a RAT, whenever the arcpy engine
+        would save an intermediate raster.  Yields the path of each one saved.
+    '''
+    import numpy as np
+    from gapanalysis import blocks
+    grid, counterValues = blocks.CONUSGrid(CONUSExtent)
+    window = tuple([int(x) for x in window])
+    windowGrid = blocks.SubGrid(grid, window)
+    tally = blocks.CounterWindow(grid, counterValues, window, "int64")
+    if weights is not None:
+        fixed = _FixedWeights(weights)
+        tally <<= _FixedBits
+    counter = 1
+    habmaps = blocks.PrefetchWindows([(path, window) for path in paths], grid,
+                                     readers=readers)
+    for i, habmap in enumerate(habmaps):
+        habmap = habmap.astype(np.int64)
+        tally += habmap if weights is None else habmap*fixed[i]
+        counter += 1
+        if counter - 1 in range(0, 2000, intervalSize):
+            if weights is None:
+                out, dtype = tally.astype(np.uint16), "uint16"
+            else:
+                out, dtype = _FixedRound(tally), "int32"
+            snapshot = intDir + "/Intermediate_{0}.tif".format(counter)
+            dst = blocks.CreateRaster(snapshot, windowGrid, dtype)
+            try:
+                blocks.WriteWindow(dst, windowGrid, (0, 0, window[2], window[3]), out)
+            finally:
+                dst.close()
+            values, counts = np.unique(out, return_counts=True)
+            blocks.WriteVAT(snapshot, values, counts)
+            yield snapshot
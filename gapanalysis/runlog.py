@@ -0,0 +1,205 @@
+# -*- coding: utf-8 -*-
+"""
+A module for logging runs of the package's functions.  A RunLog buffers the lines of
+a log instead of opening the log file for each one, times the stages of a run (such
+as reading, computing, writing, building RATs, and updating tables), and counts 
+things like cells processed and bytes read and written.  When the run is finished,
+a JSON summary of these metrics is saved next to the log.
+"""
+import atexit, contextlib
+
+# Run logs that haven't been closed, and may have lines that haven't been written
+# yet.  The references keep a log whose run raised from being collected before
+# its lines are written.
+_OpenLogs = set()
+
+
+class Metrics(object):
+    '''
+    Stage timers and counters for a run or a part of one.  Metrics are plain data, 
+        so worker processes can return theirs to be merged into the run's.
+
+    Example:
+    >>> metrics = Metrics()
+    >>> with metrics.Stage("read"):
+    ...     data = src.read(1)
+    >>> metrics.Count("bytes read", data.nbytes)
+    >>> metrics.Summary()
+    {'stages': {'read': {'seconds': 0.52, 'calls': 1}}, 'counters': {'bytes read':
+     16777216}}
+    '''
+    def __init__(self):
+        self.stages = {}
+        self.counters = {}
+
+    @contextlib.contextmanager
+    def Stage(self, name):
+        '''
+        (string) -> context manager
+
+        Times the code under a "with" statement as part of a stage.  A stage can be
+            timed any number of times; its seconds and calls add up.
+        '''
+        import time
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.AddTime(name, time.time() - start)
+
+    def AddTime(self, name, seconds, calls=1):
+        '''
+        (string, number, [integer]) -> None
+
+        Adds seconds to a stage.
+        '''
+        stage = self.stages.setdefault(name, [0., 0])
+        stage[0] += seconds
+        stage[1] += calls
+
+    def Count(self, name, n=1):
+        '''
+        (string, [number]) -> None
+
+        Adds n to a counter.
+        '''
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def Merge(self, other):
+        '''
+        (Metrics) -> None
+
+        Adds the stage times and counts of other Metrics, such as those returned by 
+            a worker process, to these.  None is ignored.
+        '''
+        if other is None:
+            return
+        for name, (seconds, calls) in other.stages.items():
+            self.AddTime(name, seconds, calls)
+        for name, n in other.counters.items():
+            self.Count(name, n)
+
+    def Summary(self):
+        '''
+        () -> dictionary
+
+        Returns the stage times (seconds and calls) and counters as a dictionary.
+        '''
+        return {"stages": dict([(name, {"seconds": s[0], "calls": s[1]})
+                                for name, s in self.stages.items()]),
+                "counters": dict(self.counters)}
+
+
+class RunLog(Metrics):
+    '''
+    The log of one run of a function, with the run's Metrics.  Call it with a line
+        to log.  The line is printed right away, but lines are written to the log
+        file in batches, every flushLines lines or flushSeconds seconds, whichever
+        comes first, and when the log is closed or Python exits.  Close the log at
+        the end of the run, in a "finally" clause so that it's closed if the run
+        raises, to add the run's metrics summary to the metrics file.  Closing it
+        again does nothing.
+
+    Arguments:
+    log -- Path to the text log file.  Lines are appended to it.
+    name -- Name of the function being run, for the metrics summary.
+    metrics -- Path to the JSON metrics file, a list with a summary of each run.  
+        Defaults to the log's path with "_metrics.json" in place of its extension.
+    echo -- False to not print lines.
+    flushLines -- Number of lines to buffer before writing them.
+    flushSeconds -- Longest time to keep lines in the buffer.
+
+    Example:
+    >>> __Log = RunLog("C:/analyses/log.txt", "MapRichness")
+    >>> __Log("Summing")
+    Summing
+    >>> with __Log.Stage("write"):
+    ...     blocks.WriteWindow(dst, grid, window, tally)
+    >>> __Log.Count("cells", tally.size)
+    >>> __Log.Close()["stages"]["write"]
+    {'seconds': 0.21, 'calls': 1}
+    '''
+    def __init__(self, log, name=None, metrics=None, echo=True, flushLines=100,
+                 flushSeconds=5.):
+        import os, time, datetime
+        Metrics.__init__(self)
+        self.log = log
+        self.name = name
+        self.metrics = metrics or os.path.splitext(log)[0] + "_metrics.json"
+        self.echo = echo
+        self.flushLines = flushLines
+        self.flushSeconds = flushSeconds
+        self.started = datetime.datetime.now()
+        self._lines = []
+        self._flushed = time.time()
+        self._summary = None
+        _OpenLogs.add(self)
+
+    def __call__(self, content):
+        import time
+        if self.echo:
+            print(content)
+        self._lines.append(content + "\n")
+        if len(self._lines) >= self.flushLines or \
+           time.time() - self._flushed >= self.flushSeconds:
+            self.Flush()
+
+    def Flush(self):
+        '''
+        () -> None
+
+        Writes buffered lines to the log file.
+        '''
+        import time
+        if self._lines:
+            with open(self.log, "a") as f:
+                f.write("".join(self._lines))
+            self._lines = []
+        self._flushed = time.time()
+
+    def Close(self, **extra):
+        '''
+        ([keyword arguments]) -> dictionary
+
+        Writes buffered lines, then adds a summary of the run to the metrics file:
+            the function name, log, start and finish times, seconds, stage times, 
+            counters, and any extra keyword arguments.  Returns the summary.  If 
+            the log is already closed, returns the summary it was closed with.
+        '''
+        import os, json, datetime
+        if self._summary is not None:
+            return self._summary
+        self.Flush()
+        finished = datetime.datetime.now()
+        summary = self.Summary()
+        summary.update({"function": self.name, "log": os.path.abspath(self.log),
+                        "started": self.started.strftime("%Y-%m-%d %H:%M:%S"),
+                        "finished": finished.strftime("%Y-%m-%d %H:%M:%S"),
+                        "seconds": (finished - self.started).total_seconds()})
+        summary.update(extra)
+        runs = []
+        if os.path.exists(self.metrics):
+            try:
+                with open(self.metrics) as f:
+                    runs = json.load(f)
+            except ValueError:
+                runs = []
+        runs.append(summary)
+        with open(self.metrics, "w") as f:
+            json.dump(runs, f, indent=1, sort_keys=True)
+        _OpenLogs.discard(self)
+        self._summary = summary
+        return summary
+
+
+@atexit.register
+def _FlushAll():
+    '''
+    Writes the buffered lines of logs that weren't closed, such as those of a run 
+        that raised an exception.
+    '''
+    for runLog in list(_OpenLogs):
+        try:
+            runLog.Flush()
+        except Exception:
+            pass
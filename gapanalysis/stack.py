@@ -0,0 +1,455 @@
+# -*- coding: utf-8 -*-
+"""
+A module for keeping species' seasonal habitat maps in a bit-packed, memory-mapped
+"habitat stack" so that richness, and the habitat that species share, can be
+calculated for any group of species without reading the habitat map GeoTIFFs again.
+"""
+
+# Bytes of packed maps that CoOccurrence combines with one species' at a time; 
+# small enough to stay in the CPU's cache
+_CoOccurrenceBytes = 64*1024
+
+
+class HabitatStack(object):
+    '''
+    A directory of bit-packed habitat maps.  Each species' seasonal (0/1) map is
+        read once, clipped to the bounding box of its habitat, packed 8 cells to a
+        byte with numpy.packbits, and saved as a raw file that is memory-mapped when
+        needed.  Counter pixels in the top left corner are kept separately so that
+        they don't stretch the bounding box to the whole CONUS extent.  An index of
+        the packed maps is kept in "stack.json" in the stack directory.
+
+    Arguments:
+    stackDir -- Directory to save the packed maps and index in.  It will be created
+        if it doesn't exist, and an existing stack in it will be reused.
+    CONUSExtent -- The CONUS extent raster (conus_ext_cnt.tif) that defines the grid
+        and location of the counter pixels.
+
+    Example:
+    >>> hs = HabitatStack("C:/data/stack", "C:/data/conus_ext_cnt.tif")
+    >>> hs.Add(["bAMROx", "mSEWEx"], "C:/Data/Model/Output/", "Summer")
+    >>> hs.Richness(["bAMROx"], "Summer", "C:/data/AMRO_Richness.tif")
+    'C:/data/AMRO_Richness.tif'
+    '''
+    def __init__(self, stackDir, CONUSExtent):
+        import os, json
+        from gapanalysis import blocks
+        self.stackDir = stackDir
+        self.CONUSExtent = CONUSExtent
+        self.grid, self.counterValues = blocks.CONUSGrid(CONUSExtent)
+        self._index = os.path.join(stackDir, "stack.json")
+        self._maps = {}
+        if not os.path.exists(stackDir):
+            os.makedirs(stackDir)
+        # An index that was being swapped in when a process died
+        if not os.path.exists(self._index) and os.path.exists(self._index + ".tmp"):
+            os.rename(self._index + ".tmp", self._index)
+        if os.path.exists(self._index):
+            with open(self._index) as f:
+                self.entries = json.load(f)
+        else:
+            self.entries = {}
+
+    def _Save(self):
+        import os, json
+        with open(self._index + ".tmp", "w") as f:
+            json.dump(self.entries, f, indent=1, sort_keys=True)
+        if os.path.exists(self._index):
+            os.remove(self._index)
+        os.rename(self._index + ".tmp", self._index)
+
+    def _Bits(self, sp, season):
+        # Packed map file of an index entry.  Stacks from before entries named
+        # their file used sp + ".bits".
+        import os
+        entry = self.Entry(sp, season)
+        return os.path.join(self.stackDir, season, entry.get("bits", sp + ".bits"))
+
+    def Species(self, season):
+        '''
+        (string) -> list
+
+        Returns a sorted list of the species in the stack for a season.
+        '''
+        return sorted(self.entries.get(season, {}).keys())
+
+    def Entry(self, sp, season):
+        '''
+        (string, string) -> dictionary
+
+        Returns the index entry for a species' seasonal map: the source raster and its
+            modification time and size, the window of the packed bounding box in the
+            grid, the counter pixel values, and the number of habitat cells (without
+            counter pixels).  Raises a KeyError if the map isn't in the stack.
+        '''
+        return self.entries[season][sp]
+
+    def Add(self, spp, modelDir, season, blockSize=4096):
+        '''
+        (list, string, string, [integer]) -> list
+
+        Packs the seasonal habitat maps of species into the stack.  Maps that are
+            already in the stack are skipped unless the source file has changed.
+            Each map is packed to a new file and the index is saved after each
+            species, so the stack stays usable if Add is interrupted, and running 
+            Add again picks up where it left off.  Returns a list of the species 
+            that were packed.
+
+        Arguments:
+        spp -- A list of GAP species codes.
+        modelDir -- The directory holding the "Summer", "Winter", and "Any"
+            subdirectories of binary habitat maps, as for richness.MapRichness.  
+            Sparse habitat maps from data.MakeSparse can be used too.
+        season -- "Summer", "Winter", or "Any".
+        blockSize -- Height and width, in cells, of the blocks read at a time.
+        '''
+        import os, numpy as np, rasterio
+        from gapanalysis import blocks
+        grid = self.grid
+        seasonDir = os.path.join(self.stackDir, season)
+        if not os.path.exists(seasonDir):
+            os.makedirs(seasonDir)
+        entries = self.entries.setdefault(season, {})
+        packed = []
+        for sp in spp:
+            path = os.path.abspath(blocks.FindRaster(modelDir + season + "/", sp))
+            stat = os.stat(path)
+            old = entries.get(sp)
+            if old is not None and os.path.abspath(old["source"]) == path and \
+               old["mtime"] == stat.st_mtime and old["size"] == stat.st_size:
+                continue
+            with rasterio.open(path) as src:
+                srcWindow = blocks.SourceWindow(src, grid)
+                # Find the bounding box of the habitat, ignoring counter pixels
+                counter = np.zeros(grid.counter[2:] if grid.counter else (0, 0),
+                                   dtype=np.uint8)
+                rows, cols = [], []
+                for window in blocks.BlockWindows(grid, blockSize):
+                    if not blocks.NeedsWindow(window, srcWindow, grid):
+                        continue
+                    data = blocks.ReadWindow(src, grid, window)
+                    if grid.counter is not None:
+                        overlap = blocks.Intersect(window, grid.counter)
+                        if overlap is not None:
+                            r, c = overlap[0] - window[0], overlap[1] - window[1]
+                            part = data[r:r + overlap[2], c:c + overlap[3]]
+                            r, c = (overlap[0] - grid.counter[0], 
+                                    overlap[1] - grid.counter[1])
+                            counter[r:r + overlap[2], c:c + overlap[3]] = part
+                            part[:] = 0
+                    r = np.nonzero(data.any(axis=1))[0]
+                    c = np.nonzero(data.any(axis=0))[0]
+                    if len(r) > 0:
+                        rows += [window[0] + r[0], window[0] + r[-1]]
+                        cols += [window[1] + c[0], window[1] + c[-1]]
+                # Align the box to whole bytes of the grid so maps can be combined
+                # byte by byte
+                if rows:
+                    col0 = min(cols) - min(cols) % 8
+                    col1 = max(cols) + 1
+                    col1 += (8 - col1 % 8) % 8
+                    box = (int(min(rows)), int(col0), int(max(rows) - min(rows) + 1),
+                           int(col1 - col0))
+                else:
+                    box = (0, 0, 0, 0)
+                # A new file, so the old one stays valid until the index changes
+                version = old.get("version", 0) + 1 if old is not None else 1
+                bitsName = "{0}.{1}.bits".format(sp, version)
+                bits = os.path.join(seasonDir, bitsName)
+                count = 0
+                if box[2] > 0:
+                    mm = np.memmap(bits, dtype=np.uint8, mode="w+",
+                                   shape=(box[2], box[3]//8))
+                    for row in range(box[0], box[0] + box[2], blockSize):
+                        window = (row, box[1], min(blockSize, box[0] + box[2] - row),
+                                  box[3])
+                        data = blocks.ReadWindow(src, grid, window)
+                        if grid.counter is not None:
+                            overlap = blocks.Intersect(window, grid.counter)
+                            if overlap is not None:
+                                data[overlap[0] - window[0]:
+                                     overlap[0] - window[0] + overlap[2],
+                                     overlap[1] - window[1]:
+                                     overlap[1] - window[1] + overlap[3]] = 0
+                        data = (data > 0).astype(np.uint8)
+                        count += int(data.sum())
+                        mm[row - box[0]:row - box[0] + window[2]] = np.packbits(data,
+                                                                               axis=1)
+                    mm.flush()
+                    del mm
+            oldBits = self._Bits(sp, season) if old is not None else None
+            self._maps.pop((season, sp), None)
+            entries[sp] = {"source": path, "mtime": stat.st_mtime,
+                           "size": stat.st_size, "window": list(box),
+                           "counter": counter.tolist(), "count": count,
+                           "bits": bitsName, "version": version}
+            self._Save()
+            if oldBits is not None and os.path.exists(oldBits):
+                os.remove(oldBits)
+            packed.append(sp)
+        return packed
+
+    def Map(self, sp, season):
+        '''
+        (string, string) -> numpy memmap or None
+
+        Returns the packed (read only, memory-mapped) bounding box of a species'
+            seasonal map, or None if the species has no habitat.
+        '''
+        import os, numpy as np
+        key = (season, sp)
+        if key not in self._maps:
+            box = self.Entry(sp, season)["window"]
+            if box[2] == 0:
+                self._maps[key] = None
+            else:
+                self._maps[key] = np.memmap(self._Bits(sp, season), dtype=np.uint8,
+                                            mode="r", shape=(box[2], box[3]//8))
+        return self._maps[key]
+
+    def RichnessBlock(self, spp, season, window):
+        '''
+        (list, string, tuple) -> numpy array
+
+        Returns the richness (uint16) of a window of the grid for a list of species.
+            The window's column offset and width must be multiples of 8, except at
+            the right edge of the grid.  Packed maps are summed with bitwise adders,
+            8 cells at a time, into bit planes of a binary counter, which are only
+            unpacked at the end.  Counter pixels are the CONUS extent's plus those of
+            each species, as in richness.MapRichness.
+        '''
+        import numpy as np
+        from gapanalysis import blocks
+        row, col, height, width = window
+        nBytes = (width + 7)//8
+        planes = []
+        for sp in spp:
+            box = tuple(self.Entry(sp, season)["window"])
+            overlap = blocks.Intersect(window, box) if box[2] else None
+            if overlap is None:
+                continue
+            packed = self.Map(sp, season)
+            b0 = (overlap[1] - box[1])//8
+            b1 = (overlap[1] + overlap[3] - box[1] + 7)//8
+            carry = packed[overlap[0] - box[0]:overlap[0] - box[0] + overlap[2], b0:b1]
+            rows = slice(overlap[0] - row, overlap[0] - row + overlap[2])
+            cols = slice((overlap[1] - col)//8, (overlap[1] - col)//8 + b1 - b0)
+            # Ripple carry add of the packed map to the bit planes
+            for plane in planes:
+                part = plane[rows, cols]
+                nextCarry = part & carry
+                part ^= carry
+                carry = nextCarry
+                if not carry.any():
+                    break
+            else:
+                planes.append(np.zeros((height, nBytes), dtype=np.uint8))
+                planes[-1][rows, cols] = carry
+        tally = np.zeros((height, nBytes*8), dtype=np.uint16)
+        for k, plane in enumerate(planes):
+            tally += np.unpackbits(plane, axis=1).astype(np.uint16) << k
+        tally = tally[:, :width]
+        # Add the counter pixels
+        grid = self.grid
+        if grid.counter is not None:
+            overlap = blocks.Intersect(window, grid.counter)
+            if overlap is not None:
+                counter = self.counterValues.astype(np.uint16)
+                for sp in spp:
+                    counter += np.array(self.Entry(sp, season)["counter"],
+                                        dtype=np.uint16)
+                r, c = overlap[0] - grid.counter[0], overlap[1] - grid.counter[1]
+                tally[overlap[0] - row:overlap[0] - row + overlap[2],
+                      overlap[1] - col:overlap[1] - col + overlap[3]] += \
+                    counter[r:r + overlap[2], c:c + overlap[3]]
+        return tally
+
+    def Richness(self, spp, season, outRaster, blockSize=4096):
+        '''
+        (list, string, string, [integer]) -> string
+
+        Saves a richness raster for a list of species from the stack, with a RAT.
+            The result is the same as that of richness.MapRichness without weights.
+            Returns the path to the raster.
+
+        Arguments:
+        spp -- A list of GAP species codes that are in the stack for the season.
+        season -- "Summer", "Winter", or "Any".
+        outRaster -- Path for the richness GeoTIFF.
+        blockSize -- Height and width, in cells, of the blocks processed at a time.
+            Rounded up to a multiple of 8.
+        '''
+        import numpy as np
+        from gapanalysis import blocks
+        missing = [sp for sp in spp if sp not in self.entries.get(season, {})]
+        if missing:
+            raise KeyError("Not in the {0} stack: {1}".format(season, missing))
+        blockSize += (8 - blockSize % 8) % 8
+        hist = None
+        dst = blocks.CreateRaster(outRaster, self.grid, "uint16")
+        try:
+            for window in blocks.BlockWindows(self.grid, blockSize):
+                tally = self.RichnessBlock(spp, season, window)
+                blocks.WriteWindow(dst, self.grid, window, tally)
+                hist = blocks.AddHistogram(hist, tally)
+        finally:
+            dst.close()
+        values = np.nonzero(hist)[0]
+        blocks.WriteVAT(outRaster, values, hist[values])
+        return outRaster
+
+    def CoOccurrence(self, spp, season, blockSize=4096, workers=1):
+        '''
+        (list, string, [integer], [integer]) -> pandas DataFrame
+
+        Returns the number of habitat cells that each pair of species share in a 
+            season, as a DataFrame with a row and a column for each species.  The
+            diagonal is each species' number of habitat cells.  Counter pixels 
+            aren't counted.  The grid is split into tiles, and in each tile the 
+            packed maps of every pair of species are combined with a bitwise and, 8
+            cells to a byte, and the set bits are counted 64 at a time.  Each 
+            species is compared with groups of the others whose bounding boxes 
+            overlap its own close together, a few numpy operations per group, and
+            pairs whose boxes don't overlap are skipped.
+
+        Arguments:
+        spp -- A list of GAP species codes that are in the stack for the season.
+        season -- "Summer", "Winter", or "Any".
+        blockSize -- Height and width, in cells, of the tiles.  Rounded up to a 
+            multiple of 8.  The packed tiles of the species in a tile are held in 
+            memory at once.
+        workers -- Number of processes that compare tiles.  On Windows, 
+            call CoOccurrence from under "if __name__ == '__main__':" when using 
+            more than 1 worker.
+
+        Example:
+        >>> hs.CoOccurrence(["bAMROx", "mSEWEx", "aAMTOx"], "Summer")
+                 bAMROx  mSEWEx  aAMTOx
+        bAMROx  2719472   40873  391120
+        mSEWEx    40873   80303       0
+        aAMTOx   391120       0  912467
+        '''
+        import multiprocessing, numpy as np, pandas as pd
+        from gapanalysis import blocks
+        missing = [sp for sp in spp if sp not in self.entries.get(season, {})]
+        if missing:
+            raise KeyError("Not in the {0} stack: {1}".format(season, missing))
+        blockSize += (8 - blockSize % 8) % 8
+        boxes = [tuple(self.Entry(sp, season)["window"]) for sp in spp]
+        files = [self._Bits(sp, season) for sp in spp]
+        # Only tiles where at least two boxes overlap have pairs to count
+        jobs = []
+        for tile in blocks.BlockWindows(self.grid, blockSize):
+            inTile = [box for box in boxes if box[2] and blocks.Intersect(tile, box)]
+            if len(inTile) > 1:
+                jobs.append((files, boxes, tile))
+        shared = np.zeros((len(spp), len(spp)), dtype=np.int64)
+        if workers > 1 and len(jobs) > 1:
+            pool = multiprocessing.Pool(workers)
+            results = pool.imap_unordered(_CoOccurrenceTile, jobs)
+        else:
+            pool = None
+            results = (_CoOccurrenceTile(job) for job in jobs)
+        try:
+            for i, j, counts in results:
+                np.add.at(shared, (i, j), counts)
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+        # Pairs were only counted once
+        shared += shared.T
+        shared[np.diag_indices(len(spp))] = [self.Entry(sp, season)["count"] 
+                                             for sp in spp]
+        return pd.DataFrame(shared, index=spp, columns=spp)
+
+
+def _CoOccurrenceTile(args):
+    '''
+    Counts the habitat cells shared by each pair of species (i < j) in one tile for
+        HabitatStack.CoOccurrence.  Returns arrays of i, j, and the counts of the 
+        pairs that share any.  The species' packed maps are stacked into one array
+        for the tile.  The later species whose boxes overlap each species' are found
+        at once, and are combined with it in groups of up to _CoOccurrenceBytes 
+        whose overlaps are close together, so that the interpreter's work grows
+        with the number of groups rather than with every pair of species.  Set bits
+        are counted 64 at a time with the SWAR (SIMD within a register) popcount.
+    '''
+    import numpy as np
+    from gapanalysis import blocks
+    files, boxes, tile = args
+    m1, m2, m4, h01 = [np.uint64(m) for m in (0x5555555555555555, 0x3333333333333333,
+                                              0x0f0f0f0f0f0f0f0f, 0x0101010101010101)]
+    one, two, four, fiftySix = [np.uint64(n) for n in (1, 2, 4, 56)]
+    present = [(i, blocks.Intersect(tile, box)) for i, box in enumerate(boxes) 
+               if box[2]]
+    present = [(i, overlap) for i, overlap in present if overlap is not None]
+    # The tile of each species' packed map, in rows of whole 64 bit words, with
+    # zeros outside of its box
+    nWords = ((tile[3] + 7)//8 + 7)//8
+    packedTile = np.zeros((len(present), tile[2], nWords*8), dtype=np.uint8)
+    for k, (i, overlap) in enumerate(present):
+        box = boxes[i]
+        packed = np.memmap(files[i], dtype=np.uint8, mode="r",
+                           shape=(box[2], box[3]//8))
+        b0, nBytes = (overlap[1] - box[1])//8, (overlap[3] + 7)//8
+        t0 = (overlap[1] - tile[1])//8
+        packedTile[k, overlap[0] - tile[0]:overlap[0] - tile[0] + overlap[2], 
+                   t0:t0 + nBytes] = packed[overlap[0] - box[0]:
+                                            overlap[0] - box[0] + overlap[2],
+                                            b0:b0 + nBytes]
+        del packed
+    words = packedTile.view(np.uint64)
+    # The overlaps of each species' part of the tile with the later species' parts
+    parts = np.array([overlap for i, overlap in present], 
+                     dtype=np.int64).reshape(-1, 4)
+    top, left = parts[:, 0], parts[:, 1]
+    bottom, right = top + parts[:, 2], left + parts[:, 3]
+    iAll, jAll, countAll = [], [], []
+    for k, (i, a) in enumerate(present):
+        r0, c0 = np.maximum(top[k + 1:], a[0]), np.maximum(left[k + 1:], a[1])
+        r1 = np.minimum(bottom[k + 1:], a[0] + a[2])
+        c1 = np.minimum(right[k + 1:], a[1] + a[3])
+        later = np.nonzero((r0 < r1) & (c0 < c1))[0]
+        both = sorted([((int(r0[m]), int(c0[m]), int(r1[m] - r0[m]), 
+                         int(c1[m] - c0[m])), k + 1 + int(m)) for m in later])
+        # Group the later species whose overlaps with species i are close together;
+        # a group's bounding box is at most half again the area of its overlaps
+        groups, group, union, area = [], [], None, 0
+        for o, m in both:
+            grown = o if union is None else blocks.Union(union, o)
+            if group and (2*grown[2]*grown[3] > 3*(area + o[2]*o[3]) or
+                          len(group)*grown[2]*grown[3] > 8*_CoOccurrenceBytes):
+                groups.append((group, union))
+                grown, group, area = o, [], 0
+            group.append(m)
+            union, area = grown, area + o[2]*o[3]
+        if group:
+            groups.append((group, union))
+        for others, box in groups:
+            rows = slice(box[0] - tile[0], box[0] - tile[0] + box[2])
+            w0, w1 = (box[1] - tile[1])//64, (box[1] - tile[1] + box[3] + 63)//64
+            v = words[others, rows, w0:w1]
+            v &= words[k, rows, w0:w1]
+            # In place, to not allocate a new array for each step
+            t = v >> one
+            t &= m1
+            v -= t
+            np.right_shift(v, two, out=t)
+            t &= m2
+            v &= m2
+            v += t
+            np.right_shift(v, four, out=t)
+            v += t
+            v &= m4
+            v *= h01
+            v >>= fiftySix
+            counts = v.reshape(len(others), -1).sum(axis=1)
+            shared = counts > 0
+            iAll.append(np.repeat(i, shared.sum()))
+            jAll.append(np.array([present[m][0] for m in others])[shared])
+            countAll.append(counts[shared].astype(np.int64))
+    if not countAll:
+        empty = np.zeros(0, dtype=np.int64)
+        return empty, empty, empty
+    return np.concatenate(iAll), np.concatenate(jAll), np.concatenate(countAll)
@@ -0,0 +1,111 @@
+'''
+Small rasters for the tests, written on a CONUS-like grid (30 m Albers cells with
+    3x3 counter pixels in the top left corner).
+'''
+import os
+import numpy as np
+from rasterio.crs import CRS
+from gapanalysis import blocks
+
+
+def Grid(height, width):
+    '''
+    (integer, integer) -> Grid
+
+    Returns a grid of the given size with the CONUS extent's top left corner.
+    '''
+    return blocks.Grid(-2361915.0, 3177735.0, 30.0, height, width,
+                       CRS.from_epsg(5070).to_wkt(), (0, 0, 3, 3))
+
+
+def WriteRaster(raster, array, grid, window=None, nodata=None, nbits=None):
+    '''
+    (string, numpy array, Grid, [tuple], [number], [integer]) -> string
+
+    Saves an array as a raster covering a window (row, column, height, width) of
+        the grid, or all of it, with a RAT of the cells other than nodata.
+        Returns the path.
+    '''
+    if window is None:
+        window = (0, 0, grid.height, grid.width)
+    subGrid = blocks.SubGrid(grid, window)
+    dst = blocks.CreateRaster(raster, subGrid, array.dtype.name, nbits=nbits,
+                              nodata=nodata)
+    try:
+        blocks.WriteWindow(dst, subGrid, (0, 0) + array.shape, array)
+    finally:
+        dst.close()
+    cells = array[array != nodata] if nodata is not None else array
+    values, counts = np.unique(cells, return_counts=True)
+    blocks.WriteVAT(raster, values, counts)
+    return raster
+
+
+def CONUSExtent(dataDir, grid):
+    '''
+    (string, Grid) -> string
+
+    Saves a CONUS extent raster for the grid: zeros, with 1 in the counter pixels.
+    '''
+    array = np.zeros((grid.height, grid.width), dtype=np.uint8)
+    array[:3, :3] = 1
+    return WriteRaster(os.path.join(dataDir, "conus_ext_cnt.tif"), array, grid,
+                       nbits=1)
+
+
+def RangeMaps(rangeDir, grid, nSpecies, seed):
+    '''
+    (string, Grid, integer, integer) -> list, dictionary
+
+    Saves range extent habitat maps (values 1-3, and nodata 255) of random boxes
+        of the grid, the first of them covering the counter pixels.  Returns the
+        species codes and a dictionary of each map expanded to the whole grid,
+        with 0 outside of the box and for nodata.
+    '''
+    rng = np.random.RandomState(seed)
+    spp, full = [], {}
+    for i in range(nSpecies):
+        sp = "bTST{0:02d}x".format(i)
+        h = rng.randint(1, grid.height + 1)
+        w = rng.randint(1, grid.width + 1)
+        if i == 0:
+            row, col = 0, 0
+        else:
+            row = rng.randint(0, grid.height - h + 1)
+            col = rng.randint(0, grid.width - w + 1)
+        array = rng.choice([255, 1, 2, 3], (h, w)).astype(np.uint8)
+        WriteRaster(rangeDir + sp + ".tif", array, grid, (row, col, h, w),
+                    nodata=255)
+        full[sp] = np.zeros((grid.height, grid.width), dtype=np.uint8)
+        full[sp][row:row + h, col:col + w] = np.where(array == 255, 0, array)
+        spp.append(sp)
+    return spp, full
+
+
+def SeasonalMaps(modelDir, season, grid, nSpecies, seed):
+    '''
+    (string, string, Grid, integer, integer) -> list, dictionary
+
+    Saves CONUS extent 0/1 habitat maps of random habitat, with 1 in the counter
+        pixels like data.Make01Seasonal's, to modelDir + season.  The last map has
+        no habitat.  Returns the species codes and a dictionary of the maps,
+        without the counter pixels.
+    '''
+    rng = np.random.RandomState(seed)
+    seasonDir = os.path.join(modelDir, season)
+    if not os.path.exists(seasonDir):
+        os.makedirs(seasonDir)
+    spp, maps = [], {}
+    for i in range(nSpecies):
+        sp = "bTST{0:02d}x".format(i)
+        habitat = (rng.random_sample((grid.height, grid.width)) <
+                   rng.uniform(0.05, 0.6)).astype(np.uint8)
+        habitat[:3, :3] = 0
+        if i == nSpecies - 1:
+            habitat[:] = 0
+        array = habitat.copy()
+        array[:3, :3] = 1
+        WriteRaster(os.path.join(seasonDir, sp + ".tif"), array, grid, nbits=1)
+        spp.append(sp)
+        maps[sp] = habitat
+    return spp, maps
@@ -0,0 +1,135 @@
+'''
+Tests of gapanalysis.blocks, compared with the rasters read whole with rasterio.
+'''
+import os, json, shutil, tempfile, threading, unittest
+import numpy as np
+from gapanalysis import blocks
+from gapanalysis.test import fixtures
+
+
+class TestCONUSGrid(unittest.TestCase):
+    def setUp(self):
+        self.workDir = tempfile.mkdtemp()
+        self.grid = fixtures.Grid(80, 100)
+        self.raster = fixtures.CONUSExtent(self.workDir, self.grid)
+        blocks._CONUSGrids.clear()
+
+    def tearDown(self):
+        blocks._CONUSGrids.clear()
+        shutil.rmtree(self.workDir, ignore_errors=True)
+
+    def AssertGrid(self, grid, counterValues, counter, values):
+        self.assertEqual(grid.counter, counter)
+        self.assertEqual((grid.height, grid.width), (self.grid.height, self.grid.width))
+        np.testing.assert_array_equal(counterValues, values)
+
+    def test_Sidecar(self):
+        grid, counterValues = blocks.CONUSGrid(self.raster)
+        self.AssertGrid(grid, counterValues, (0, 0, 3, 3), np.ones((3, 3)))
+        self.assertTrue(os.path.exists(self.raster + ".grid.json"))
+        # Another process reads the sidecar instead of the raster
+        blocks._CONUSGrids.clear()
+        rasterGrid = blocks.RasterGrid
+        def Fail(raster):
+            raise AssertionError("read " + raster)
+        blocks.RasterGrid = Fail
+        try:
+            self.assertEqual(blocks.CONUSGrid(self.raster)[0], grid)
+        finally:
+            blocks.RasterGrid = rasterGrid
+
+    def test_Stale(self):
+        blocks.CONUSGrid(self.raster)
+        # The raster is replaced with one with a larger counter, of 2s
+        array = np.zeros((self.grid.height, self.grid.width), dtype=np.uint8)
+        array[:4, :5] = 2
+        fixtures.WriteRaster(self.raster, array, self.grid)
+        stat = os.stat(self.raster)
+        os.utime(self.raster, (stat.st_atime, stat.st_mtime + 10))
+        # Neither the saved grid of this process nor the sidecar is used
+        grid, counterValues = blocks.CONUSGrid(self.raster)
+        self.AssertGrid(grid, counterValues, (0, 0, 4, 5), 2*np.ones((4, 5)))
+        blocks._CONUSGrids.clear()
+        with open(self.raster + ".grid.json") as f:
+            self.assertEqual(json.load(f)["grid"]["counter"], [0, 0, 4, 5])
+        grid, counterValues = blocks.CONUSGrid(self.raster)
+        self.AssertGrid(grid, counterValues, (0, 0, 4, 5), 2*np.ones((4, 5)))
+
+    def test_Corrupt(self):
+        # A sidecar cut short is worked out again
+        with open(self.raster + ".grid.json", "w") as f:
+            f.write('{"stamp": [')
+        grid, counterValues = blocks.CONUSGrid(self.raster)
+        self.AssertGrid(grid, counterValues, (0, 0, 3, 3), np.ones((3, 3)))
+
+
+class TestPrefetchWindows(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.workDir = tempfile.mkdtemp()
+        cls.grid = fixtures.Grid(100, 120)
+        rng = np.random.RandomState(11)
+        cls.arrays, cls.rasters = [], []
+        for i in range(3):
+            array = rng.randint(0, 200, (100, 120)).astype(np.uint8)
+            cls.arrays.append(array)
+            cls.rasters.append(fixtures.WriteRaster(
+                os.path.join(cls.workDir, "r{0}.tif".format(i)), array, cls.grid))
+        # Windows of the rasters in turn, so threads switch datasets
+        windows = blocks.BlockWindows(cls.grid, 32)
+        cls.jobs = [(r, w) for w in windows for r in cls.rasters]
+        cls.expected = [cls.arrays[cls.rasters.index(r)][w[0]:w[0] + w[2],
+                                                         w[1]:w[1] + w[3]]
+                        for r, w in cls.jobs]
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.workDir, ignore_errors=True)
+
+    def test_Order(self):
+        for readers in (0, 1, 4):
+            results = list(blocks.PrefetchWindows(self.jobs, self.grid,
+                                                  readers=readers))
+            self.assertEqual(len(results), len(self.expected))
+            for result, expected in zip(results, self.expected):
+                np.testing.assert_array_equal(result, expected)
+
+    def test_MemoryCap(self):
+        # Count the windows, and their bytes, read but not yet yielded
+        readWindow = blocks.ReadWindow
+        state = {"windows": 0, "bytes": 0, "most": 0, "mostBytes": 0}
+        lock = threading.Lock()
+        def Read(src, grid, window, fill=0):
+            with lock:
+                state["windows"] += 1
+                state["bytes"] += window[2]*window[3]
+                state["most"] = max(state["most"], state["windows"])
+                state["mostBytes"] = max(state["mostBytes"], state["bytes"])
+            return readWindow(src, grid, window, fill)
+        def Consume(reads):
+            for i, result in enumerate(reads):
+                with lock:
+                    state["windows"] -= 1
+                    state["bytes"] -= result.size
+                np.testing.assert_array_equal(result, self.expected[i])
+        blocks.ReadWindow = Read
+        try:
+            # Room for two 32x32 windows of one byte cells
+            Consume(blocks.PrefetchWindows(self.jobs, self.grid, readers=4,
+                                           maxBytes=2*32*32))
+            self.assertLessEqual(state["mostBytes"], 2*32*32)
+            self.assertGreater(state["most"], 1)
+            # Too little room for any still reads one window ahead
+            state["most"] = 0
+            Consume(blocks.PrefetchWindows(self.jobs, self.grid, readers=4,
+                                           maxBytes=1))
+            self.assertEqual(state["most"], 1)
+            # Without a limit, up to twice as many windows as readers
+            state["most"] = 0
+            Consume(blocks.PrefetchWindows(self.jobs, self.grid, readers=2))
+            self.assertLessEqual(state["most"], 4)
+        finally:
+            blocks.ReadWindow = readWindow
+
+if __name__ == "__main__":
+    unittest.main()
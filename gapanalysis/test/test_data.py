@@ -0,0 +1,221 @@
+'''
+Tests of the numpy engines of gapanalysis.data, compared with habitat maps expanded
+    cell by cell.
+'''
+import os, json, shutil, tempfile, unittest
+import numpy as np, rasterio
+from gapanalysis import blocks, data
+from gapanalysis.test import fixtures
+
+SEASONS = {"Summer": (1, 3), "Winter": (2, 3), "Any": (1, 2, 3)}
+
+
+class TestExpand(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.workDir = tempfile.mkdtemp()
+        cls.grid = fixtures.Grid(140, 190)
+        cls.dataDir = os.path.join(cls.workDir, "data") + "/"
+        os.makedirs(cls.dataDir)
+        cls.CONUSExtent = fixtures.CONUSExtent(cls.dataDir, cls.grid)
+        cls.spp, cls.full = fixtures.RangeMaps(cls.dataDir, cls.grid, 4, seed=1)
+        cls.rasters = [sp + ".tif" for sp in cls.spp]
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.workDir, ignore_errors=True)
+
+    def AssertRaster(self, path, expected):
+        with rasterio.open(path) as src:
+            np.testing.assert_array_equal(src.read(1), expected)
+        # The RAT matches the cells
+        vat = blocks.ReadVAT(path)
+        values, counts = np.unique(expected, return_counts=True)
+        np.testing.assert_array_equal(vat["VALUE"], values)
+        np.testing.assert_array_equal(vat["COUNT"], counts)
+
+    def test_Make01Seasonal(self):
+        for workers in (1, 2):
+            outDir = os.path.join(self.workDir, "seasonal_{0}".format(workers)) + "/"
+            data.Make01Seasonal(self.rasters, ["Summer", "Winter", "Any"],
+                                self.dataDir, outDir, self.CONUSExtent,
+                                log=outDir + "log.txt", engine="numpy",
+                                workers=workers, blockSize=64)
+            for sp in self.spp:
+                full = self.full[sp]
+                for season, values in SEASONS.items():
+                    expected = np.in1d(full, values).reshape(full.shape)
+                    expected = expected.astype(np.uint8)
+                    expected[:3, :3] = 1
+                    self.AssertRaster(outDir + season + "/" + sp + ".tif", expected)
+
+    def test_Make0123(self):
+        outDir = os.path.join(self.workDir, "0123") + "/"
+        data.Make0123(self.rasters, self.CONUSExtent, self.dataDir, outDir,
+                      log=outDir + "log.txt", engine="numpy", blockSize=64)
+        sparseDir = os.path.join(self.workDir, "sparse") + "/"
+        data.MakeSparse(self.rasters, ["0123"], self.dataDir, sparseDir,
+                        self.CONUSExtent, blockSize=64, log=sparseDir + "log.txt")
+        whole = (0, 0, self.grid.height, self.grid.width)
+        for sp in self.spp:
+            # The counter value is added, up to the 3 that 2 bit cells hold
+            expected = self.full[sp].copy()
+            expected[:3, :3] = np.minimum(expected[:3, :3] + 1, 3)
+            self.AssertRaster(outDir + "0123/" + sp + ".tif", expected)
+            with rasterio.open(sparseDir + "0123/" + sp + ".tif") as src:
+                np.testing.assert_array_equal(
+                    blocks.ReadWindow(src, self.grid, whole), expected)
+
+
+class TestMakeSparse(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.workDir = tempfile.mkdtemp()
+        cls.grid = fixtures.Grid(140, 190)
+        cls.dataDir = os.path.join(cls.workDir, "data") + "/"
+        os.makedirs(cls.dataDir)
+        cls.CONUSExtent = fixtures.CONUSExtent(cls.dataDir, cls.grid)
+        cls.spp, cls.full = fixtures.RangeMaps(cls.dataDir, cls.grid, 4, seed=1)
+        cls.rasters = [sp + ".tif" for sp in cls.spp]
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.workDir, ignore_errors=True)
+
+    def Expected(self, sp, season):
+        '''
+        Returns the CONUS extent map that Make01Seasonal or Make0123 would make.
+        '''
+        full = self.full[sp]
+        if season == "0123":
+            expected = full.copy()
+            expected[:3, :3] = np.minimum(expected[:3, :3] + 1, 3)
+        else:
+            expected = np.in1d(full, SEASONS[season]).reshape(full.shape)
+            expected = expected.astype(np.uint8)
+            expected[:3, :3] = 1
+        return expected
+
+    def test_ReadBack(self):
+        outDir = os.path.join(self.workDir, "sparse") + "/"
+        data.MakeSparse(self.rasters, ["Summer", "Winter", "Any", "0123"],
+                        self.dataDir, outDir, self.CONUSExtent, blockSize=64,
+                        log=outDir + "log.txt")
+        whole = (0, 0, self.grid.height, self.grid.width)
+        for sp in self.spp:
+            for season in ["Summer", "Winter", "Any", "0123"]:
+                path = outDir + season + "/" + sp + ".tif"
+                expected = self.Expected(sp, season)
+                # Sparse maps read back as the CONUS extent maps
+                with rasterio.open(path) as src:
+                    np.testing.assert_array_equal(
+                        blocks.ReadWindow(src, self.grid, whole), expected)
+                if season != "0123":
+                    self.assertEqual(blocks.HabitatCount(path), expected.sum())
+
+    def test_Failure(self):
+        # The Winter table can't be written, after Summer's was
+        outDir = os.path.join(self.workDir, "failure") + "/"
+        os.makedirs(outDir + "Winter/" + self.rasters[0] + ".vat.dbf")
+        data.MakeSparse(self.rasters[:1], ["Summer", "Winter", "Any"], self.dataDir,
+                        outDir, self.CONUSExtent, blockSize=64,
+                        log=outDir + "log.txt")
+        with open(outDir + "log.txt") as log:
+            lines = [l.strip() for l in log if self.rasters[0] in l]
+        self.assertFalse(lines[0].endswith("FAILED"))
+        self.assertIn("/Summer/", lines[0])
+        self.assertEqual([l.endswith(",FAILED") for l in lines[1:]], [True, True])
+
+
+class TestCheckHabMaps(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.workDir = tempfile.mkdtemp()
+        grid = fixtures.Grid(90, 110)
+        rng = np.random.RandomState(9)
+        habitat = rng.randint(0, 4, (90, 110)).astype(np.uint8)
+        Path = lambda name: os.path.join(cls.workDir, name + ".tif")
+        cls.good = fixtures.WriteRaster(Path("good"), habitat, grid, nodata=0, nbits=2)
+        cls.noNodata = fixtures.WriteRaster(Path("noNodata"), habitat, grid, nbits=2)
+        cls.wrongNodata = fixtures.WriteRaster(Path("wrongNodata"), habitat, grid,
+                                               nodata=2, nbits=2)
+        overMax = habitat.copy()
+        overMax[0, :5] = 7
+        cls.overMax = fixtures.WriteRaster(Path("overMax"), overMax, grid, nodata=0)
+        cls.rasters = [cls.good, cls.noNodata, cls.wrongNodata, cls.overMax]
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.workDir, ignore_errors=True)
+
+    def Check(self, **kwargs):
+        return data.CheckHabMaps(self.rasters, engine="numpy", workers=2, **kwargs)
+
+    def test_Numpy(self):
+        errors = self.Check()
+        self.assertEqual(errors["NoNoDataValue"], [self.noNodata])
+        self.assertEqual(errors["WrongNoDataValue"], [self.wrongNodata])
+        self.assertEqual(errors["WrongPixelType"], [self.overMax])
+        self.assertEqual(errors["WrongMaximum"], [self.overMax])
+        self.assertEqual(errors["overMax"], [os.path.basename(self.overMax)])
+        for key in ("WrongProjection", "WrongFormat", "BadCount", "CursorProblem",
+                    "NoRows", "Zeros"):
+            self.assertEqual(errors[key], [])
+
+    def test_Cache(self):
+        cache = os.path.join(self.workDir, "cache.json")
+        report = os.path.join(self.workDir, "report.json")
+        first = self.Check(cache=cache, report=report)
+        with open(report) as f:
+            self.assertFalse(any([r["cached"]
+                                  for r in json.load(f)["rasters"].values()]))
+        # Unchanged rasters come from the cache, with the same errors
+        self.assertEqual(self.Check(cache=cache, report=report), first)
+        with open(report) as f:
+            self.assertTrue(all([r["cached"]
+                                 for r in json.load(f)["rasters"].values()]))
+        # A raster whose table changed is checked again
+        stat = os.stat(self.good + ".vat.dbf")
+        os.utime(self.good + ".vat.dbf", (stat.st_atime, stat.st_mtime + 10))
+        self.Check(cache=cache, report=report)
+        with open(report) as f:
+            rasters = json.load(f)["rasters"]
+        self.assertEqual([r for r in self.rasters if not rasters[r]["cached"]],
+                         [self.good])
+
+    def test_Deep(self):
+        grid = fixtures.Grid(90, 110)
+        habitat = np.random.RandomState(10).randint(0, 4, (90, 110)).astype(np.uint8)
+        good = fixtures.WriteRaster(os.path.join(self.workDir, "deepGood.tif"),
+                                    habitat, grid, nodata=0, nbits=2)
+        # A table that undercounts the 3s
+        stale = fixtures.WriteRaster(os.path.join(self.workDir, "deepStale.tif"),
+                                     habitat, grid, nodata=0, nbits=2)
+        values, counts = np.unique(habitat[habitat != 0], return_counts=True)
+        blocks.WriteVAT(stale, values, counts - np.array([0, 0, 1]))
+        # Cells over the maximum of 3, that the table doesn't show
+        badHabitat = habitat.copy()
+        badHabitat[5, :4] = 6
+        bad = fixtures.WriteRaster(os.path.join(self.workDir, "deepBad.tif"),
+                                   badHabitat, grid, nodata=0, nbits=3)
+        blocks.WriteVAT(bad, values, counts)
+        errors = data.CheckHabMaps([good, stale, bad], engine="numpy", deep=True,
+                                   workers=2, blockSize=32)
+        # Table problems are listed by raster name
+        self.assertEqual(errors["RATMismatch"], ["deepStale.tif", "deepBad.tif"])
+        self.assertEqual(errors["BadPixels"], [bad])
+        # The tables were rebuilt from the cells
+        for raster, cells in ((stale, habitat), (bad, badHabitat)):
+            vat = blocks.ReadVAT(raster)
+            values, counts = np.unique(cells[cells != 0], return_counts=True)
+            np.testing.assert_array_equal(vat["VALUE"], values)
+            np.testing.assert_array_equal(vat["COUNT"], counts)
+        # So that checking again finds only the bad cells
+        errors = data.CheckHabMaps([good, stale, bad], engine="numpy", deep=True,
+                                   blockSize=32)
+        self.assertEqual(errors["RATMismatch"], [])
+        self.assertEqual(errors["BadPixels"], [bad])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,125 @@
+'''
+Tests of the numpy engine of gapanalysis.habitat, compared with cells counted one
+    zone at a time.
+'''
+import os, shutil, tempfile, unittest
+import numpy as np, pandas as pd
+from gapanalysis import data, habitat
+from gapanalysis.test import fixtures
+
+COLUMNS = ["NonHabitatPixels", "SummerPixels", "WinterPixels", "AllYearPixels"]
+
+
+class TestPercentOverlay(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.workDir = tempfile.mkdtemp()
+        cls.grid = fixtures.Grid(150, 180)
+        cls.dataDir = os.path.join(cls.workDir, "data") + "/"
+        os.makedirs(cls.dataDir)
+        cls.CONUSExtent = fixtures.CONUSExtent(cls.dataDir, cls.grid)
+        cls.spp, cls.full = fixtures.RangeMaps(cls.dataDir, cls.grid, 4, seed=3)
+        cls.rasters = [sp + ".tif" for sp in cls.spp]
+        cls.zones = np.random.RandomState(3).randint(1, 5, (150, 180)).astype(np.uint16)
+        cls.zoneFile = fixtures.WriteRaster(cls.dataDir + "zones.tif", cls.zones,
+                                            cls.grid)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.workDir, ignore_errors=True)
+
+    def Expected(self, hab, inExtent):
+        '''
+        Returns a dictionary of the (non-habitat, summer, winter, year-round) cell
+            counts of a habitat map in each zone.
+        '''
+        counts = {}
+        for zone in np.unique(self.zones):
+            inZone = (self.zones == zone) & inExtent
+            counts[zone] = (int((inZone & (hab == 0)).sum()),
+                            int((inZone & ((hab == 1) | (hab == 3))).sum()),
+                            int((inZone & ((hab == 2) | (hab == 3))).sum()),
+                            int((inZone & (hab == 3)).sum()))
+        return counts
+
+    def Overlay(self, name, habDir, extent, blockSize=64, habmapList=None,
+                **kwargs):
+        outDir = os.path.join(self.workDir, name)
+        return habitat.PercentOverlay(self.zoneFile, "zones", "VALUE",
+                                      habmapList or self.rasters,
+                                      habDir, outDir,
+                                      os.path.join(outDir, "scratch") + "/",
+                                      self.CONUSExtent, extent=extent,
+                                      engine="numpy", blockSize=blockSize,
+                                      **kwargs)
+
+    def AssertCounts(self, df, expected):
+        for raster, counts in expected.items():
+            for zone, row in counts.items():
+                self.assertEqual(tuple(df.loc[(raster, zone)][COLUMNS]), row)
+
+    def test_Counts(self):
+        for extent in ("habMap", "zoneFile"):
+            df = self.Overlay(extent, self.dataDir, extent)
+            expected = {}
+            for sp, raster in zip(self.spp, self.rasters):
+                inExtent = np.ones(self.zones.shape, dtype=bool)
+                if extent == "habMap":
+                    # The range maps' boxes, where the fixtures put values 1-3
+                    inExtent = self.full[sp] > 0
+                    rows, cols = np.nonzero(inExtent)
+                    inExtent[rows.min():rows.max() + 1,
+                             cols.min():cols.max() + 1] = True
+                expected[raster] = self.Expected(self.full[sp], inExtent)
+            self.AssertCounts(df, expected)
+
+    def test_Sparse(self):
+        # Sparse maps count the same as the expanded maps they stand for
+        expandedDir = os.path.join(self.workDir, "expanded") + "/"
+        data.Make0123(self.rasters, self.CONUSExtent, self.dataDir, expandedDir,
+                      log=expandedDir + "log.txt", engine="numpy", blockSize=64)
+        sparseDir = os.path.join(self.workDir, "sparse") + "/"
+        data.MakeSparse(self.rasters, ["0123"], self.dataDir, sparseDir,
+                        self.CONUSExtent, blockSize=64, log=sparseDir + "log.txt")
+        expanded = self.Overlay("expanded_overlay", expandedDir + "0123/",
+                                "zoneFile")
+        sparse = self.Overlay("sparse_overlay", sparseDir + "0123/", "zoneFile")
+        self.assertTrue(expanded[COLUMNS].equals(sparse[COLUMNS]))
+        expected = {}
+        for sp, raster in zip(self.spp, self.rasters):
+            hab = self.full[sp].copy()
+            hab[:3, :3] = np.minimum(hab[:3, :3] + 1, 3)
+            expected[raster] = self.Expected(hab, np.ones(hab.shape, dtype=bool))
+        self.AssertCounts(sparse, expected)
+
+    def test_ZoneCache(self):
+        cacheDir = os.path.join(self.workDir, "zoneCache")
+        first = self.Overlay("cache_1", self.dataDir, "habMap", zoneCache=cacheDir)
+        self.assertEqual(len(os.listdir(cacheDir)), 1)
+        # The second run reads the zones from the cache entry
+        second = self.Overlay("cache_2", self.dataDir, "habMap", zoneCache=cacheDir)
+        self.assertEqual(len(os.listdir(cacheDir)), 1)
+        self.assertTrue(first[COLUMNS].equals(second[COLUMNS]))
+        # Blocks of another size are another entry
+        self.Overlay("cache_3", self.dataDir, "habMap", zoneCache=cacheDir,
+                     blockSize=32)
+        self.assertEqual(len(os.listdir(cacheDir)), 2)
+
+    def test_Master(self):
+        outDir = os.path.join(self.workDir, "master")
+        master = os.path.join(outDir, "Percent_in_zones_Master.csv")
+        self.Overlay("master", self.dataDir, "habMap", habmapList=self.rasters[:2])
+        # Running the same species again changes no rows, so the master table
+        # isn't rewritten
+        os.utime(master, (0, 0))
+        self.Overlay("master", self.dataDir, "habMap", habmapList=self.rasters[:2])
+        self.assertEqual(os.stat(master).st_mtime, 0)
+        # New species are added to it
+        self.Overlay("master", self.dataDir, "habMap")
+        self.assertNotEqual(os.stat(master).st_mtime, 0)
+        species = set(pd.read_csv(master)["GeoTiff"])
+        self.assertEqual(species, set(self.rasters))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,107 @@
+'''
+Tests of the numpy engines of gapanalysis.landcover, compared with land cover
+    reclassified cell by cell.
+'''
+import os, shutil, tempfile, unittest
+import numpy as np, rasterio
+from gapanalysis import blocks, landcover
+from gapanalysis.test import fixtures
+
+CODES = [4101, 4102, 7101, 7102, 9000]
+GROUPS = {"Forest": [4101, 4102], "Grass": [7101, 7102], "Mixed": [4102, 7101]}
+
+
+class TestReclass(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.workDir = tempfile.mkdtemp()
+        cls.grid = fixtures.Grid(110, 130)
+        rng = np.random.RandomState(7)
+        cls.lc = rng.choice(CODES + [65535], (110, 130)).astype(np.uint16)
+        cls.lcPath = fixtures.WriteRaster(os.path.join(cls.workDir, "lc.tif"), cls.lc,
+                                          cls.grid, nodata=65535)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.workDir, ignore_errors=True)
+
+    def AssertRaster(self, path, expected, nodata):
+        with rasterio.open(path) as src:
+            self.assertEqual(src.nodata, nodata)
+            np.testing.assert_array_equal(src.read(1), expected)
+        cells = expected[expected != nodata]
+        values, counts = np.unique(cells, return_counts=True)
+        vat = blocks.ReadVAT(path)
+        np.testing.assert_array_equal(vat["VALUE"], values)
+        np.testing.assert_array_equal(vat["COUNT"], counts)
+
+    def test_ReclassLandCover(self):
+        outDir = os.path.join(self.workDir, "reclass") + "/"
+        result = landcover.ReclassLandCover([4101, 4102], 2, "Forest", outDir,
+                                            self.lcPath, "1.0", engine="numpy",
+                                            jobs=[([7101], 300, "Grass")],
+                                            blockSize=64)
+        self.assertEqual(result, outDir + "Forest.tif")
+        # Other map units and land cover nodata are nodata
+        expected = np.where(np.in1d(self.lc, [4101, 4102]).reshape(self.lc.shape),
+                            2, 255)
+        self.AssertRaster(result, expected, 255)
+        expected = np.where(self.lc == 7101, 300, 65535)
+        self.AssertRaster(outDir + "Grass.tif", expected, 65535)
+        # Without jobs, the same kind of result
+        result = landcover.ReclassLandCover([9000], 1, "Other", outDir, self.lcPath,
+                                            "1.0", engine="numpy", blockSize=64)
+        self.assertEqual(result, outDir + "Other.tif")
+
+    def test_ReclassPass(self):
+        # Signed land cover, with codes below 0
+        lc = np.random.RandomState(8).randint(-5, 5, (70, 90)).astype(np.int16)
+        lcPath = fixtures.WriteRaster(os.path.join(self.workDir, "signed.tif"), lc,
+                                      self.grid, window=(0, 0, 70, 90), nodata=-5)
+        outputs = [(os.path.join(self.workDir, "pass_{0}.tif".format(k)),
+                    mapping, 0, "uint8", 255, {})
+                   for k, mapping in enumerate([{-4: 1, 3: 1}, {-1: 7, 0: 8}])]
+        results = landcover._ReclassPass(lcPath, outputs, 32, workers=2)
+        for (path, mapping, default, dtype, nodata, tags), (values, counts) in \
+                zip(outputs, results):
+            expected = np.array([mapping.get(v, 0) for v in lc.ravel()])
+            expected = np.where(lc.ravel() == -5, 255, expected).reshape(lc.shape)
+            self.AssertRaster(path, expected, 255)
+            cells = expected[expected != 255]
+            np.testing.assert_array_equal(values, np.unique(cells))
+            np.testing.assert_array_equal(counts, np.unique(cells,
+                                                            return_counts=True)[1])
+
+    def test_BatchReclass(self):
+        nodata = self.lc == 65535
+        outDir = os.path.join(self.workDir, "batch") + "/"
+        paths = landcover.BatchReclass(GROUPS, outDir, self.lcPath, "1.0", workers=2,
+                                       blockSize=48)
+        self.assertEqual(sorted(paths), sorted(GROUPS))
+        for keyword, MUs in GROUPS.items():
+            expected = np.in1d(self.lc, MUs).reshape(self.lc.shape).astype(np.uint8)
+            expected[nodata] = 255
+            self.AssertRaster(paths[keyword], expected, 255)
+
+    def test_Packed(self):
+        outDir = os.path.join(self.workDir, "packed") + "/"
+        path = landcover.BatchReclass(GROUPS, outDir, self.lcPath, "1.0",
+                                      packed="groups", blockSize=48)
+        self.assertEqual(path, outDir + "groups.tif")
+        # Bit k is set for the kth keyword in sorted order
+        keywords = sorted(GROUPS)
+        expected = np.zeros(self.lc.shape, dtype=np.uint8)
+        for k, keyword in enumerate(keywords):
+            inGroup = np.in1d(self.lc, GROUPS[keyword]).reshape(self.lc.shape)
+            expected[inGroup] |= 2**k
+        expected[self.lc == 65535] = 255
+        self.AssertRaster(path, expected, 255)
+        with rasterio.open(path) as src:
+            tags = src.tags()
+        self.assertEqual(tags["GAP_LAYERS"], ",".join(keywords))
+        self.assertEqual([int(c) for c in tags["GAP_LAYER_COUNTS"].split(",")],
+                         [int(np.in1d(self.lc, GROUPS[k]).sum()) for k in keywords])
+
+
+if __name__ == "__main__":
+    unittest.main()
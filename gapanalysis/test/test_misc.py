@@ -0,0 +1,148 @@
+'''
+Tests of gapanalysis.misc's raster attribute table (RAT) and statistics functions,
+    compared with the cells read with rasterio.
+'''
+import os, shutil, tempfile, unittest
+import numpy as np, rasterio
+from gapanalysis import blocks, misc
+from gapanalysis.test import fixtures
+
+
+class TestRAT(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.workDir = tempfile.mkdtemp()
+        grid = fixtures.Grid(120, 140)
+        rng = np.random.RandomState(5)
+        values = rng.randint(0, 40, (120, 140)).astype(np.uint16)
+        values[rng.random_sample(values.shape) < 0.1] = 65535
+        cls.rasters = [
+            fixtures.WriteRaster(os.path.join(cls.workDir, "values.tif"), values,
+                                 grid, nodata=65535),
+            fixtures.CONUSExtent(cls.workDir, grid)]
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.workDir, ignore_errors=True)
+
+    def Cells(self, raster):
+        with rasterio.open(raster) as src:
+            cells = src.read(1)
+            if src.nodata is not None:
+                cells = cells[cells != src.nodata]
+        return cells.ravel()
+
+    def test_RoundTrip(self):
+        for raster in self.rasters:
+            values, counts = np.unique(self.Cells(raster), return_counts=True)
+            RAT = misc.ReadRAT(raster)
+            np.testing.assert_array_equal(RAT["VALUE"], values)
+            np.testing.assert_array_equal(RAT["COUNT"], counts)
+            df = misc.RATtoDataFrame(raster)
+            np.testing.assert_array_equal(df.index.values, values)
+            np.testing.assert_array_equal(df["cell_count"].values, counts)
+            # Writing the table again gives the same table back
+            copy = os.path.join(self.workDir, "copy.tif")
+            shutil.copy(raster, copy)
+            blocks.WriteVAT(copy, RAT["VALUE"], RAT["COUNT"])
+            vat = blocks.ReadVAT(copy)
+            np.testing.assert_array_equal(vat["VALUE"], values)
+            np.testing.assert_array_equal(vat["COUNT"], counts)
+
+    def test_RATStats(self):
+        percentiles = [5, 25, 50, 95]
+        for raster in self.rasters:
+            cells = np.sort(self.Cells(raster))
+            result = misc.RATStats(raster, percentiles)
+            self.assertAlmostEqual(result["mean"], cells.mean())
+            self.assertAlmostEqual(result["standard_deviation"], cells.std())
+            self.assertEqual(result["range"], (cells.min(), cells.max()))
+            for p in percentiles:
+                # The lowest value with at least p percent of the cells at or below
+                position = int(np.ceil(len(cells)*p/100.)) - 1
+                self.assertEqual(result[str(p) + "th"], cells[max(position, 0)])
+            result = misc.RATStats(raster, percentiles, interpolation="linear")
+            for p in percentiles:
+                self.assertAlmostEqual(result[str(p) + "th"],
+                                       np.percentile(cells, p))
+        # Dropping the zeros and the highest value (e.g., counter pixels)
+        cells = self.Cells(self.rasters[0])
+        cells = np.sort(cells[(cells > 0) & (cells < cells.max())])
+        result = misc.RATStats(self.rasters[0], [50], dropMax=True, dropZero=True)
+        self.assertAlmostEqual(result["mean"], cells.mean())
+        self.assertEqual(result["50th"], cells[int(np.ceil(len(cells)*0.5)) - 1])
+        # A list of rasters, with a list of percentiles for each
+        results = misc.RATStats(self.rasters, [[50], [90]], dropMax=True)
+        self.assertEqual(results[1]["range"], (0, 0))
+        self.assertEqual(results[1]["90th"], 0)
+
+class TestRasterStats(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.workDir = tempfile.mkdtemp()
+        grid = fixtures.Grid(130, 150)
+        rng = np.random.RandomState(6)
+        values = rng.randint(0, 60, (130, 150)).astype(np.uint16)
+        values[rng.random_sample(values.shape) < 0.1] = 65535
+        cls.integer = fixtures.WriteRaster(os.path.join(cls.workDir, "integer.tif"),
+                                           values, grid, nodata=65535)
+        cls.cells = values[values != 65535].astype(float)
+        cls.floating = fixtures.WriteRaster(os.path.join(cls.workDir, "float.tif"),
+                                            rng.random_sample((130, 150)
+                                                              ).astype(np.float32),
+                                            grid)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.workDir, ignore_errors=True)
+
+    def test_Numpy(self):
+        percentiles = [10, 50, 90]
+        result = misc.RasterStats(self.integer, "numpy", percentiles, blockSize=64)
+        cells = np.sort(self.cells)
+        self.assertEqual(result["count"], len(cells))
+        self.assertAlmostEqual(result["mean"], cells.mean())
+        self.assertAlmostEqual(result["standard_deviation"], cells.std())
+        self.assertEqual(result["range"], (cells.min(), cells.max()))
+        self.assertAlmostEqual(result["coefficient_of_variation"],
+                               100*cells.std()/cells.mean())
+        values, counts = np.unique(cells, return_counts=True)
+        np.testing.assert_array_equal(result["histogram"][0], values)
+        np.testing.assert_array_equal(result["histogram"][1], counts)
+        for p in percentiles:
+            position = int(np.ceil(len(cells)*p/100.)) - 1
+            self.assertEqual(result[str(p) + "th"], cells[position])
+        # Floating point rasters have no histogram or percentiles
+        with rasterio.open(self.floating) as src:
+            cells = src.read(1).astype(float)
+        result = misc.RasterStats(self.floating, "numpy", percentiles, blockSize=64)
+        self.assertAlmostEqual(result["mean"], cells.mean(), places=5)
+        self.assertAlmostEqual(result["standard_deviation"], cells.std(), places=5)
+        self.assertIsNone(result["histogram"])
+        self.assertIsNone(result["50th"])
+
+    def test_SavedStats(self):
+        raster = os.path.join(self.workDir, "saved.tif")
+        shutil.copy(self.integer, raster)
+        first = misc.RasterStats(raster, "numpy", [50], saveStats=True, blockSize=64)
+        self.assertTrue(os.path.exists(raster + ".aux.xml"))
+        # The saved statistics are reused instead of reading the raster
+        streamStats = misc._StreamStats
+        def Fail(raster, blockSize):
+            raise AssertionError("read " + raster)
+        misc._StreamStats = Fail
+        try:
+            second = misc.RasterStats([raster], "numpy", [50])[0]
+            for key in ("mean", "standard_deviation", "range", "count", "50th"):
+                self.assertAlmostEqual(second[key], first[key])
+            # Until the raster changes
+            stat = os.stat(raster)
+            os.utime(raster, (stat.st_atime, stat.st_mtime + 10))
+            with self.assertRaises(AssertionError):
+                misc.RasterStats(raster, "numpy", [50])
+        finally:
+            misc._StreamStats = streamStats
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,228 @@
+'''
+Tests of the numpy engine of gapanalysis.richness, compared with richness summed
+    cell by cell.
+'''
+import os, json, shutil, tempfile, unittest
+import numpy as np, rasterio
+from scipy import stats
+from gapanalysis import blocks, richness
+from gapanalysis.test import fixtures
+
+
+class TestMapRichness(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.workDir = tempfile.mkdtemp()
+        cls.grid = fixtures.Grid(150, 170)
+        dataDir = os.path.join(cls.workDir, "data")
+        os.makedirs(dataDir)
+        cls.CONUSExtent = fixtures.CONUSExtent(dataDir, cls.grid)
+        cls.modelDir = os.path.join(cls.workDir, "model") + "/"
+        cls.spp, cls.maps = fixtures.SeasonalMaps(cls.modelDir, "Summer", cls.grid,
+                                                  6, seed=2)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.workDir, ignore_errors=True)
+
+    def Expected(self, weight):
+        '''
+        Returns the richness that MapRichness should make, summed species by
+            species in floating point.
+        '''
+        tally = np.zeros((self.grid.height, self.grid.width))
+        tally[:3, :3] = 1
+        # Each habitat map has 1 in the counter pixels too
+        maps = [self.maps[sp].copy() for sp in self.spp]
+        for m in maps:
+            m[:3, :3] = 1
+        if weight == "None":
+            return (tally + sum(maps)).astype(np.int64)
+        counts = np.array([m.sum() for m in maps], dtype=float)
+        if weight == "area":
+            weights = counts - 9
+        else:
+            weights = 100.*stats.rankdata(counts, method="average")/len(counts)
+        for m, w in zip(maps, weights):
+            # Species with no habitat add nothing
+            if w:
+                tally += m/w
+        return np.floor(tally*10000 + 0.5).astype(np.int64)
+
+    def Richness(self, name, weight, spp=None, workers=1, **kwargs):
+        raster, table = richness.MapRichness(spp or self.spp, "g",
+                                             os.path.join(self.workDir, name),
+                                             self.modelDir, "Summer", 5,
+                                             self.CONUSExtent, weight=weight,
+                                             engine="numpy", blockSize=64,
+                                             workers=workers, **kwargs)
+        with rasterio.open(raster) as src:
+            return raster, src.read(1)
+
+    def test_Unweighted(self):
+        expected = self.Expected("None")
+        raster, result = self.Richness("unweighted", "None")
+        np.testing.assert_array_equal(result, expected)
+        vat = blocks.ReadVAT(raster)
+        values, counts = np.unique(expected, return_counts=True)
+        np.testing.assert_array_equal(vat["VALUE"], values)
+        np.testing.assert_array_equal(vat["COUNT"], counts)
+
+    def test_Weighted(self):
+        for weight in ("area", "percentile"):
+            raster, result = self.Richness(weight, weight)
+            # Fixed point sums round the same as floating point ones, give or take
+            # the last digit
+            self.assertLessEqual(np.abs(result - self.Expected(weight)).max(), 1)
+        # The area weight of the species with no habitat is logged, not divided by
+        with open(os.path.join(self.workDir, "area", "g", "Log_g.txt")) as log:
+            self.assertIn("value = 0 (no habitat)", log.read())
+
+    def test_Workers(self):
+        # Row bands summed in separate processes stitch into the same raster
+        for weight in ("None", "percentile"):
+            one = self.Richness("workers_1_" + weight, weight)[1]
+            three = self.Richness("workers_3_" + weight, weight, workers=3)[1]
+            np.testing.assert_array_equal(three, one)
+
+    def test_Resume(self):
+        uninterrupted = self.Richness("uninterrupted", "area")[1]
+        # Count the blocks summed, and stop the run after the 4th of 9
+        richnessBlock = richness._RichnessBlock
+        summed = []
+        def Block(*args, **kwargs):
+            if len(summed) == stop:
+                raise KeyboardInterrupt
+            summed.append(args[1])
+            return richnessBlock(*args, **kwargs)
+        richness._RichnessBlock = Block
+        try:
+            stop = 4
+            with self.assertRaises(KeyboardInterrupt):
+                self.Richness("resumed", "area", resume=True)
+            # The resumed run sums only the blocks that weren't finished
+            stop, summed = None, []
+            resumed = self.Richness("resumed", "area", resume=True)[1]
+            self.assertEqual(len(summed), 5)
+            np.testing.assert_array_equal(resumed, uninterrupted)
+            with open(os.path.join(self.workDir, "resumed", "g", "Log_g.txt")) as log:
+                self.assertIn("Resumed with 4 blocks", log.read())
+            # A changed map discards the checkpoint
+            stop, summed = 4, []
+            with self.assertRaises(KeyboardInterrupt):
+                self.Richness("changed", "area", resume=True)
+            path = self.modelDir + "Summer/" + self.spp[0] + ".tif"
+            stat = os.stat(path)
+            os.utime(path, (stat.st_atime, stat.st_mtime + 10))
+            stop, summed = None, []
+            self.Richness("changed", "area", resume=True)
+            self.assertEqual(len(summed), 9)
+        finally:
+            richness._RichnessBlock = richnessBlock
+
+    def test_Failure(self):
+        # A map that can't be read fails the run instead of returning a raster
+        with open(self.modelDir + "Summer/bBADx.tif", "w") as bad:
+            bad.write("not a raster")
+        try:
+            with self.assertRaises(Exception):
+                self.Richness("failure", "None", self.spp + ["bBADx"])
+        finally:
+            os.remove(self.modelDir + "Summer/bBADx.tif")
+        self.assertFalse(os.path.exists(os.path.join(self.workDir, "failure", "g",
+                                                     "g_Richness.tif")))
+        # The failed run is still summarized, once
+        with open(os.path.join(self.workDir, "failure", "g",
+                               "Log_g_metrics.json")) as f:
+            runs = json.load(f)
+        self.assertEqual([r["function"] for r in runs], ["MapRichness"])
+
+
+class TestUpdateRichness(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.workDir = tempfile.mkdtemp()
+        cls.grid = fixtures.Grid(140, 200)
+        dataDir = os.path.join(cls.workDir, "data")
+        os.makedirs(dataDir)
+        cls.CONUSExtent = fixtures.CONUSExtent(dataDir, cls.grid)
+        cls.modelDir = os.path.join(cls.workDir, "model") + "/"
+        cls.spp = fixtures.SeasonalMaps(cls.modelDir, "Summer", cls.grid, 8, 
+                                        seed=12)[0]
+        # The species that change have habitat in a corner of the grid, so only
+        # some blocks are updated
+        cls.Boxed(cls.spp[1], (90, 130, 50, 70), 1)
+        cls.Boxed(cls.spp[2], (0, 100, 40, 60), 2)
+        cls.Boxed(cls.spp[5], (100, 0, 40, 50), 5)
+        # The maps as they were, then a revised map of the replaced species
+        cls.oldModelDir = os.path.join(cls.workDir, "old") + "/"
+        shutil.copytree(cls.modelDir, cls.oldModelDir)
+        cls.Boxed(cls.spp[2], (10, 110, 40, 60), 22)
+        # The last species has no habitat
+        cls.old = cls.spp[:5] + cls.spp[7:]
+        cls.new = [sp for sp in cls.old if sp != cls.spp[1]] + [cls.spp[5]]
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.workDir, ignore_errors=True)
+
+    @classmethod
+    def Boxed(cls, sp, box, seed):
+        '''
+        Saves a habitat map with random habitat in a box (row, column, height, width).
+        '''
+        row, col, h, w = box
+        array = np.zeros((cls.grid.height, cls.grid.width), dtype=np.uint8)
+        array[row:row + h, col:col + w] = \
+            np.random.RandomState(seed).random_sample((h, w)) < 0.4
+        array[:3, :3] = 1
+        fixtures.WriteRaster(cls.modelDir + "Summer/" + sp + ".tif", array, cls.grid,
+                             nbits=1)
+
+    def Read(self, raster):
+        with rasterio.open(raster) as src:
+            cells = src.read(1)
+        vat = blocks.ReadVAT(raster)
+        return cells, vat["VALUE"], vat["COUNT"]
+
+    def Map(self, name, spp, modelDir, weight):
+        return richness.MapRichness(spp, "g", os.path.join(self.workDir, name),
+                                    modelDir, "Summer", 5, self.CONUSExtent,
+                                    weight=weight, engine="numpy", blockSize=48)[0]
+
+    def test_Update(self):
+        for weight in ("None", "area", "percentile"):
+            outLoc = os.path.join(self.workDir, "update_" + weight)
+            self.Map("update_" + weight, self.old, self.oldModelDir, weight)
+            raster, table = richness.UpdateRichness("g", outLoc, self.modelDir,
+                                                    "Summer", self.CONUSExtent,
+                                                    add=[self.spp[5]],
+                                                    remove=[self.spp[1]],
+                                                    replace=[self.spp[2]],
+                                                    weight=weight,
+                                                    oldModelDir=self.oldModelDir,
+                                                    blockSize=48)
+            fresh = self.Map("fresh_" + weight, self.new, self.modelDir, weight)
+            for updated, expected in zip(self.Read(raster), self.Read(fresh)):
+                np.testing.assert_array_equal(updated, expected)
+            self.assertEqual(richness._ReadSpeciesTable(table)[0], self.new)
+        # Unweighted richness is updated where the changed maps reach
+        with open(os.path.join(self.workDir, "update_None", "g", "Log_g.txt")) as log:
+            self.assertIn("Updating 11 of 15 blocks", log.read())
+
+    def test_MissingOldMap(self):
+        # Without the old map, every block is summed again, to the same result
+        outLoc = os.path.join(self.workDir, "missing")
+        self.Map("missing", self.old, self.oldModelDir, "None")
+        raster = richness.UpdateRichness("g", outLoc, self.modelDir, "Summer",
+                                         self.CONUSExtent, replace=[self.spp[2]],
+                                         blockSize=48)[0]
+        expected = self.Map("missing_fresh", self.old, self.modelDir, "None")
+        for updated, fresh in zip(self.Read(raster), self.Read(expected)):
+            np.testing.assert_array_equal(updated, fresh)
+        with open(os.path.join(outLoc, "g", "Log_g.txt")) as log:
+            self.assertIn("summing every block", log.read())
+
+
+if __name__ == "__main__":
+    unittest.main()
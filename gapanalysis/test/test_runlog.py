@@ -0,0 +1,75 @@
+'''
+Tests of gapanalysis.runlog's buffered logs and metrics summaries.
+'''
+import os, json, shutil, tempfile, unittest
+from gapanalysis import runlog
+
+
+class TestRunLog(unittest.TestCase):
+    def setUp(self):
+        self.workDir = tempfile.mkdtemp()
+        self.log = os.path.join(self.workDir, "log.txt")
+
+    def tearDown(self):
+        shutil.rmtree(self.workDir, ignore_errors=True)
+
+    def Lines(self):
+        with open(self.log) as f:
+            return f.read().splitlines()
+
+    def test_Buffer(self):
+        log = runlog.RunLog(self.log, "Test", echo=False, flushLines=3,
+                            flushSeconds=60)
+        log("one")
+        log("two")
+        self.assertFalse(os.path.exists(self.log))
+        log("three")
+        self.assertEqual(self.Lines(), ["one", "two", "three"])
+        log("four")
+        log.Close()
+        self.assertEqual(self.Lines(), ["one", "two", "three", "four"])
+        self.assertNotIn(log, runlog._OpenLogs)
+
+    def test_Metrics(self):
+        log = runlog.RunLog(self.log, "Test", echo=False)
+        with log.Stage("read"):
+            pass
+        with log.Stage("read"):
+            pass
+        log.Count("cells", 10)
+        worker = runlog.Metrics()
+        worker.AddTime("read", 2.)
+        worker.Count("cells", 5)
+        log.Merge(worker)
+        summary = log.Close(engine="numpy", species=3)
+        self.assertEqual(log.metrics, os.path.join(self.workDir, "log_metrics.json"))
+        with open(log.metrics) as f:
+            runs = json.load(f)
+        self.assertEqual(len(runs), 1)
+        run = runs[0]
+        self.assertEqual(run["function"], "Test")
+        self.assertEqual(run["log"], os.path.abspath(self.log))
+        self.assertEqual((run["engine"], run["species"]), ("numpy", 3))
+        self.assertEqual(run["stages"]["read"]["calls"], 3)
+        self.assertGreaterEqual(run["stages"]["read"]["seconds"], 2.)
+        self.assertEqual(run["counters"], {"cells": 15})
+        self.assertEqual(summary["counters"], run["counters"])
+        # Closing again neither adds a run nor changes the summary
+        self.assertEqual(log.Close(species=4), summary)
+        # Later runs are added to the same file
+        runlog.RunLog(self.log, "Again", echo=False).Close()
+        with open(log.metrics) as f:
+            self.assertEqual([r["function"] for r in json.load(f)],
+                             ["Test", "Again"])
+
+    def test_CorruptMetrics(self):
+        # A metrics file cut short is started again rather than failing the run
+        with open(os.path.join(self.workDir, "log_metrics.json"), "w") as f:
+            f.write('[{"function": ')
+        runlog.RunLog(self.log, "Test", echo=False).Close()
+        with open(os.path.join(self.workDir, "log_metrics.json")) as f:
+            self.assertEqual(len(json.load(f)), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,111 @@
+'''
+Tests of gapanalysis.stack, compared with richness summed cell by cell.
+'''
+import os, shutil, tempfile, unittest
+import numpy as np, rasterio
+from gapanalysis import blocks, stack
+from gapanalysis.test import fixtures
+
+
+class TestHabitatStack(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.workDir = tempfile.mkdtemp()
+        cls.grid = fixtures.Grid(130, 203)
+        dataDir = os.path.join(cls.workDir, "data")
+        os.makedirs(dataDir)
+        cls.CONUSExtent = fixtures.CONUSExtent(dataDir, cls.grid)
+        cls.modelDir = os.path.join(cls.workDir, "model") + "/"
+        cls.spp, cls.maps = fixtures.SeasonalMaps(cls.modelDir, "Any", cls.grid, 6,
+                                                  seed=4)
+        cls.stack = stack.HabitatStack(os.path.join(cls.workDir, "stack"),
+                                       cls.CONUSExtent)
+        cls.stack.Add(cls.spp, cls.modelDir, "Any", blockSize=64)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.workDir, ignore_errors=True)
+
+    def test_Richness(self):
+        # The CONUS extent's counter pixels and each species'
+        expected = sum(self.maps.values()).astype(np.int64)
+        expected[:3, :3] += 1 + len(self.spp)
+        raster = self.stack.Richness(self.spp, "Any",
+                                     os.path.join(self.workDir, "richness.tif"),
+                                     blockSize=64)
+        with rasterio.open(raster) as src:
+            np.testing.assert_array_equal(src.read(1), expected)
+        vat = blocks.ReadVAT(raster)
+        values, counts = np.unique(expected, return_counts=True)
+        np.testing.assert_array_equal(vat["VALUE"], values)
+        np.testing.assert_array_equal(vat["COUNT"], counts)
+        for sp in self.spp:
+            self.assertEqual(self.stack.Entry(sp, "Any")["count"],
+                             self.maps[sp].sum())
+
+    def test_Add(self):
+        stackDir = os.path.join(self.workDir, "add")
+        hs = stack.HabitatStack(stackDir, self.CONUSExtent)
+        # An interrupted Add keeps the species packed before it stopped
+        with self.assertRaises(IOError):
+            hs.Add(self.spp[:2] + ["bMISSx"], self.modelDir, "Any", blockSize=64)
+        hs = stack.HabitatStack(stackDir, self.CONUSExtent)
+        self.assertEqual(hs.Species("Any"), self.spp[:2])
+        # Unchanged maps are skipped, however the model directory is written
+        relative = os.path.relpath(self.modelDir) + "/"
+        self.assertEqual(hs.Add(self.spp, relative, "Any", blockSize=64),
+                         self.spp[2:])
+        self.assertEqual(hs.Add(self.spp, self.modelDir, "Any", blockSize=64), [])
+        # A changed map is packed to a new file, and the old one is deleted
+        sp = self.spp[0]
+        old = hs._Bits(sp, "Any")
+        path = self.modelDir + "Any/" + sp + ".tif"
+        stat = os.stat(path)
+        os.utime(path, (stat.st_atime, stat.st_mtime + 10))
+        self.assertEqual(hs.Add(self.spp, self.modelDir, "Any", blockSize=64), [sp])
+        self.assertNotEqual(hs._Bits(sp, "Any"), old)
+        self.assertFalse(os.path.exists(old))
+        self.assertTrue(os.path.exists(hs._Bits(sp, "Any")))
+        bits = [f for f in os.listdir(os.path.join(stackDir, "Any"))
+                if f.endswith(".bits")]
+        # The last species has no habitat, so no file
+        self.assertEqual(len(bits), len(self.spp) - 1)
+
+    def test_CoOccurrence(self):
+        # Summer maps with habitat in boxes: two that overlap, one apart from them,
+        # and one alone in the bottom right corner
+        boxes = [(0, 0, 60, 80), (30, 50, 60, 90), (70, 0, 50, 40),
+                 (110, 180, 20, 23)]
+        rng = np.random.RandomState(14)
+        spp, maps = [], {}
+        if not os.path.exists(self.modelDir + "Summer"):
+            os.makedirs(self.modelDir + "Summer")
+        for i, (row, col, h, w) in enumerate(boxes):
+            sp = "bBOX{0}x".format(i)
+            habitat = np.zeros((self.grid.height, self.grid.width), dtype=np.uint8)
+            habitat[row:row + h, col:col + w] = rng.random_sample((h, w)) < 0.5
+            habitat[:3, :3] = 0
+            array = habitat.copy()
+            array[:3, :3] = 1
+            fixtures.WriteRaster(self.modelDir + "Summer/" + sp + ".tif", array,
+                                 self.grid, nbits=1)
+            spp.append(sp)
+            maps[sp] = habitat
+        self.stack.Add(spp, self.modelDir, "Summer", blockSize=64)
+        for season, seasonSpp, seasonMaps in (("Any", self.spp, self.maps),
+                                              ("Summer", spp, maps)):
+            # Counter pixels are left out of the maps
+            M = np.array([seasonMaps[sp].ravel() for sp in seasonSpp],
+                         dtype=np.int64)
+            expected = M.dot(M.T)
+            for blockSize, workers in ((64, 1), (36, 2), (256, 1), (48, 3)):
+                shared = self.stack.CoOccurrence(seasonSpp, season, blockSize,
+                                                 workers)
+                self.assertEqual(list(shared.index), seasonSpp)
+                np.testing.assert_array_equal(shared.values, expected)
+        with self.assertRaises(KeyError):
+            self.stack.CoOccurrence(spp + ["bMISSx"], "Summer")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -13,7 +13,7 @@ setup(
     author='Nathan M. Tarr',
     author_email='nmtarr@ncsu.edu',
     
-    scripts=['bin/Update_Help_Files.py'],
+    scripts=['bin/Update_Help_Files.py', 'bin/Run_Benchmarks.py'],
     
     url='https://github.com/nmtarr/GAPAnalysis',
     